@@ -0,0 +1,112 @@
+""" Benchmark of the compiled inference graphs (speaker_model.export_compiled)
+    against the eager models: times the inference of a single utterance of
+    every length of --seq_lens on CPU, with the graph loaded back with
+    load_model as synthesize.py does, and reports the max abs difference
+    between both outputs.
+
+    The graph of every model is exported once (traced with --trace_len
+    frames), so the first call of every length also reports whether a new
+    length triggers any re-tracing/re-compiling cost.
+
+    python benchmarks/compiled_bench.py --seq_lens 100 300 1000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import timeit
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import numpy as np
+import torch
+from musa.models import acoustic_rnn, acoustic_satt, duration_rnn, load_model
+
+
+def build_model(name, opts, speakers):
+    if name == 'rnn':
+        return acoustic_rnn(opts.num_inputs, opts.emb_size, opts.rnn_size,
+                            opts.rnn_layers, 0., speakers=speakers)
+    if name == 'dur':
+        return duration_rnn(opts.num_inputs, 1, opts.emb_size, opts.rnn_size,
+                            opts.rnn_layers, 0., sigmoid_out=True,
+                            speakers=speakers)
+    return acoustic_satt(opts.num_inputs, emb_size=opts.emb_size,
+                         d_model=opts.emb_size, d_ff=2 * opts.emb_size,
+                         N=opts.satt_layers, h=4, dropout=0.,
+                         speakers=speakers)
+
+def build_utterance(opts, seq_len):
+    lab = torch.rand(seq_len, 1, opts.num_inputs)
+    spk = torch.full((seq_len, 1), opts.num_spks - 1, dtype=torch.long)
+    return lab, spk
+
+def time_fn(fn, steps):
+    beg_t = timeit.default_timer()
+    for _ in range(steps):
+        fn()
+    return (timeit.default_timer() - beg_t) / steps
+
+def time_infer(model, lab, spk, opts):
+    """ First call and median inference times [s] """
+    def infer():
+        with torch.no_grad():
+            model.inference_forward(lab, spk)
+
+    first_t = time_fn(infer, 1)
+    for _ in range(opts.warmup):
+        infer()
+    infer_ts = [time_fn(infer, opts.steps) for _ in range(opts.rounds)]
+    return first_t, np.median(infer_ts)
+
+def main(opts):
+    torch.set_num_threads(opts.num_threads)
+    speakers = [str(spk) for spk in range(opts.num_spks)]
+    print('{:>6s} {:>6s} {:>13s} {:>13s} {:>8s} {:>14s} '
+          '{:>10s}'.format('model', 'len', 'eager ms', 'compiled ms',
+                           'speedup', '1st call ms', 'max diff'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in opts.models:
+            torch.manual_seed(opts.seed)
+            model = build_model(name, opts, speakers)
+            model.eval()
+            graph_file = os.path.join(tmp_dir, '{}.pt'.format(name))
+            model.export_compiled(graph_file, example_len=opts.trace_len)
+            compiled = load_model(graph_file)
+            for seq_len in opts.seq_lens:
+                lab, spk = build_utterance(opts, seq_len)
+                _, eager_t = time_infer(model, lab, spk, opts)
+                first_t, comp_t = time_infer(compiled, lab, spk, opts)
+                with torch.no_grad():
+                    diff = (model.inference_forward(lab, spk) - \
+                            compiled.inference_forward(lab, spk)).abs().max()
+                print('{:>6s} {:>6d} {:>13.2f} {:>13.2f} {:>7.2f}x {:>14.2f} '
+                      '{:>10.2e}'.format(name, seq_len, eager_t * 1e3,
+                                         comp_t * 1e3, eager_t / comp_t,
+                                         first_t * 1e3, diff.item()))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', type=str, nargs='+',
+                        default=['rnn', 'dur', 'satt'])
+    parser.add_argument('--seq_lens', type=int, nargs='+',
+                        default=[100, 300, 1000],
+                        help='Utterance lengths timed (Def: 100 300 1000).')
+    parser.add_argument('--trace_len', type=int, default=100,
+                        help='Length of the example utterance the graphs '
+                             'are traced with (Def: 100).')
+    parser.add_argument('--num_inputs', type=int, default=55)
+    parser.add_argument('--num_spks', type=int, default=4)
+    parser.add_argument('--emb_size', type=int, default=128)
+    parser.add_argument('--rnn_size', type=int, default=128)
+    parser.add_argument('--rnn_layers', type=int, default=1)
+    parser.add_argument('--satt_layers', type=int, default=2)
+    parser.add_argument('--steps', type=int, default=5,
+                        help='Inferences timed per round (Def: 5).')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='Timed rounds, the median is reported '
+                             '(Def: 5).')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--num_threads', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1991)
+
+    opts = parser.parse_args()
+    main(opts)
@@ -0,0 +1,149 @@
+""" Micro-benchmark of a train step (forward, backward and update) with
+    the time-major batches of the collaters against the former layout:
+    batch-major batches transposed to time-major in the epoch functions,
+    and the input embedding running batch-major in between.
+
+    python benchmarks/layout_bench.py --batch_size 16 --seq_len 100
+"""
+import argparse
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from musa.models import acoustic_rnn, acoustic_satt, duration_rnn
+
+
+def legacy_embedding(model):
+    """ Replay the former round-trip of forward_input_embedding:
+        time-major inputs are transposed to batch-major, projected and
+        transposed back to time-major
+    """
+    forward_emb = model.forward_input_embedding
+    def forward_input_embedding(dling_features, speaker_idx):
+        x = forward_emb(dling_features.transpose(0, 1),
+                        speaker_idx.transpose(0, 1))
+        return x.transpose(0, 1)
+    model.forward_input_embedding = forward_input_embedding
+
+def build_model(name, opts, speakers):
+    if name == 'rnn':
+        return acoustic_rnn(opts.num_inputs, opts.emb_size, opts.rnn_size,
+                            opts.rnn_layers, 0., speakers=speakers)
+    if name == 'dur':
+        return duration_rnn(opts.num_inputs, 1, opts.emb_size, opts.rnn_size,
+                            opts.rnn_layers, 0., sigmoid_out=True,
+                            speakers=speakers)
+    return acoustic_satt(opts.num_inputs, emb_size=opts.emb_size,
+                         d_model=opts.emb_size, d_ff=2 * opts.emb_size,
+                         N=opts.satt_layers, h=4, dropout=0.,
+                         speakers=speakers)
+
+def forward(name, model, lab_b, spk_b):
+    if name == 'satt':
+        return model(lab_b, speaker_idx=spk_b)
+    return model(lab_b, None, speaker_idx=spk_b)[0]
+
+def build_step(name, opts, legacy):
+    """ Train step closure over a model and a random batch, in the
+        time-major layout or replaying the legacy one
+    """
+    torch.manual_seed(opts.seed)
+    speakers = [str(spk) for spk in range(opts.num_spks)]
+    model = build_model(name, opts, speakers)
+    if legacy:
+        legacy_embedding(model)
+    num_outputs = 1 if name == 'dur' else model.num_outputs
+    opti = optim.Adam(model.parameters(), lr=1e-4)
+    criterion = nn.MSELoss()
+    T, B = opts.seq_len, opts.batch_size
+    spk = torch.randint(0, opts.num_spks, (B,))
+    if legacy:
+        # as collated before: batch-major
+        spk_b = spk.view(B, 1).repeat(1, T)
+        lab_b = torch.rand(B, T, opts.num_inputs)
+        out_b = torch.rand(B, T, num_outputs)
+    else:
+        spk_b = spk.view(1, B).repeat(T, 1)
+        lab_b = torch.rand(T, B, opts.num_inputs)
+        out_b = torch.rand(T, B, num_outputs)
+    if opts.cuda:
+        model.cuda()
+        spk_b, lab_b, out_b = spk_b.cuda(), lab_b.cuda(), out_b.cuda()
+
+    def step():
+        spk_s, lab_s, out_s = spk_b, lab_b, out_b
+        if legacy:
+            # the former transposes of the epoch functions
+            spk_s = spk_s.transpose(0, 1)
+            lab_s = lab_s.transpose(0, 1)
+            out_s = out_s.transpose(0, 1)
+        opti.zero_grad()
+        y = forward(name, model, lab_s, spk_s)
+        loss = criterion(y, out_s)
+        loss.backward()
+        opti.step()
+    return step
+
+def time_steps(step, steps, cuda=False):
+    if cuda:
+        torch.cuda.synchronize()
+    beg_t = timeit.default_timer()
+    for _ in range(steps):
+        step()
+    if cuda:
+        torch.cuda.synchronize()
+    return (timeit.default_timer() - beg_t) / steps
+
+def main(opts):
+    torch.set_num_threads(opts.num_threads)
+    results = []
+    for name in opts.models:
+        legacy_step = build_step(name, opts, legacy=True)
+        tmajor_step = build_step(name, opts, legacy=False)
+        for _ in range(opts.warmup):
+            legacy_step()
+            tmajor_step()
+        # interleave the rounds so that both layouts see the same noise
+        legacy_ts = []
+        tmajor_ts = []
+        for _ in range(opts.rounds):
+            legacy_ts.append(time_steps(legacy_step, opts.steps, opts.cuda))
+            tmajor_ts.append(time_steps(tmajor_step, opts.steps, opts.cuda))
+        results.append((name, np.median(legacy_ts), np.median(tmajor_ts)))
+    print('{:>6s} {:>12s} {:>14s} {:>8s}'.format('model', 'legacy ms',
+                                                  'time-major ms',
+                                                  'saving'))
+    for name, legacy_t, tmajor_t in results:
+        print('{:>6s} {:>12.2f} {:>14.2f} {:>7.1f}%'.format(name,
+                                                           legacy_t * 1e3,
+                                                           tmajor_t * 1e3,
+                                                           100. * (legacy_t - tmajor_t) / legacy_t))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', type=str, nargs='+',
+                        default=['rnn', 'dur', 'satt'])
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--seq_len', type=int, default=100)
+    parser.add_argument('--num_inputs', type=int, default=55)
+    parser.add_argument('--num_spks', type=int, default=4)
+    parser.add_argument('--emb_size', type=int, default=128)
+    parser.add_argument('--rnn_size', type=int, default=128)
+    parser.add_argument('--rnn_layers', type=int, default=1)
+    parser.add_argument('--satt_layers', type=int, default=2)
+    parser.add_argument('--steps', type=int, default=5,
+                        help='Train steps timed per round (Def: 5).')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='Interleaved rounds of every layout, the '
+                             'median is reported (Def: 5).')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--num_threads', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1991)
+    parser.add_argument('--cuda', default=False, action='store_true')
+
+    opts = parser.parse_args()
+    main(opts)
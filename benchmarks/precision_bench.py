@@ -0,0 +1,225 @@
+""" Benchmark of the bf16 autocast (--precision bf16) against float32:
+    times a train step (forward, backward and update) and an inference
+    forward of every model, and checks the accuracy of bf16 with the
+    objective metrics of the eval epochs:
+
+      * bf16 inference of a model vs its float32 inference (MCD and F0
+        RMSE for the aco models, RMSE for the dur one).
+      * a model fitted in bf16 vs the same model fitted in float32 to
+        the same batch, both evaluated against its groundtruth.
+
+    Predictions are de-normalized with the stats of the first speaker of
+    --cfg_spk, or with typical ranges of the ahocoder features if it is
+    not given.
+
+    python benchmarks/precision_bench.py --batch_size 16 --seq_len 100
+"""
+import argparse
+import copy
+import os
+import pickle
+import sys
+import timeit
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from musa.models import acoustic_rnn, acoustic_satt, duration_rnn
+from musa.metrics import AcoMetricAccumulator, DurMetricAccumulator
+from musa.utils import precision_autocast
+
+
+def default_stats():
+    """ Min-max stats of 40 cc, fv, lf0 and uv, and durs [s] """
+    aco_min = np.array([-5.] * 40 + [1000., np.log(50.), 0.])
+    aco_max = np.array([5.] * 40 + [8000., np.log(400.), 1.])
+    return {'min':aco_min, 'max':aco_max}, {'min':0.01, 'max':0.4}
+
+def load_stats(cfg_spk):
+    if cfg_spk is None:
+        return default_stats()
+    with open(cfg_spk, 'rb') as cfg_f:
+        cfg = pickle.load(cfg_f)
+    spk_cfg = next(iter(cfg.values()))
+    return spk_cfg['aco_stats'], spk_cfg['dur_stats']
+
+def build_model(name, opts, speakers):
+    if name == 'rnn':
+        return acoustic_rnn(opts.num_inputs, opts.emb_size, opts.rnn_size,
+                            opts.rnn_layers, 0., speakers=speakers)
+    if name == 'dur':
+        return duration_rnn(opts.num_inputs, 1, opts.emb_size, opts.rnn_size,
+                            opts.rnn_layers, 0., sigmoid_out=True,
+                            speakers=speakers)
+    return acoustic_satt(opts.num_inputs, emb_size=opts.emb_size,
+                         d_model=opts.emb_size, d_ff=2 * opts.emb_size,
+                         N=opts.satt_layers, h=4, dropout=0.,
+                         speakers=speakers)
+
+def forward(name, model, lab_b, spk_b, precision):
+    with precision_autocast(precision):
+        if name == 'satt':
+            y = model(lab_b, speaker_idx=spk_b)
+        else:
+            y = model(lab_b, None, speaker_idx=spk_b)[0]
+    return y.float()
+
+def build_batch(name, opts):
+    T, B = opts.seq_len, opts.batch_size
+    spk = torch.randint(0, opts.num_spks, (B,))
+    spk_b = spk.view(1, B).repeat(T, 1)
+    lab_b = torch.rand(T, B, opts.num_inputs)
+    if name == 'dur':
+        out_b = torch.rand(T, B, 1)
+    else:
+        out_b = torch.rand(T, B, 43)
+        # binary uv as in the aco targets
+        out_b[:, :, -1] = torch.round(out_b[:, :, -1])
+    return spk_b, lab_b, out_b
+
+def train_step(name, model, opti, batch, precision):
+    spk_b, lab_b, out_b = batch
+    opti.zero_grad()
+    y = forward(name, model, lab_b, spk_b, precision)
+    loss = nn.functional.mse_loss(y, out_b)
+    loss.backward()
+    opti.step()
+    return loss.item()
+
+def time_fn(fn, steps):
+    beg_t = timeit.default_timer()
+    for _ in range(steps):
+        fn()
+    return (timeit.default_timer() - beg_t) / steps
+
+def time_model(name, opts, speakers, batch, precision):
+    """ Median train step and inference times [s] """
+    torch.manual_seed(opts.seed)
+    model = build_model(name, opts, speakers)
+    opti = optim.Adam(model.parameters(), lr=1e-4)
+    spk_b, lab_b, _ = batch
+
+    def step():
+        train_step(name, model, opti, batch, precision)
+
+    def infer():
+        with torch.no_grad():
+            forward(name, model, lab_b, spk_b, precision)
+
+    for _ in range(opts.warmup):
+        step()
+        infer()
+    step_ts = [time_fn(step, opts.steps) for _ in range(opts.rounds)]
+    infer_ts = [time_fn(infer, opts.steps) for _ in range(opts.rounds)]
+    return np.median(step_ts), np.median(infer_ts)
+
+def compare(name, y, gtruth, spk_b, aco_stats, dur_stats, num_spks):
+    """ Objective metrics of y against gtruth (both normalized and
+        time-major): (MCD [dB], F0 RMSE [Hz]) or (RMSE [ms],)
+    """
+    T, B = spk_b.size()
+    slen_b = torch.full((B,), T, dtype=torch.long)
+    sil_b = torch.zeros(T, B)
+    if name == 'dur':
+        metrics = DurMetricAccumulator(dict((spk, dur_stats)
+                                            for spk in range(num_spks)))
+        metrics.update(y.squeeze(-1), gtruth.squeeze(-1), slen_b, spk_b,
+                       sil_b)
+        return (metrics.dur_rmse()[0] * 1e3,)
+    metrics = AcoMetricAccumulator(dict((spk, {'aco':aco_stats})
+                                        for spk in range(num_spks)))
+    metrics.update(y, gtruth, slen_b, spk_b, sil_b)
+    return metrics.mcd()['total'], metrics.f0_rmse()[0]
+
+def check_accuracy(name, opts, speakers, batch, aco_stats, dur_stats):
+    spk_b, lab_b, out_b = batch
+    torch.manual_seed(opts.seed)
+    init_model = build_model(name, opts, speakers)
+    fitted = {}
+    for precision in ['fp32', 'bf16']:
+        model = copy.deepcopy(init_model)
+        opti = optim.Adam(model.parameters(), lr=opts.lr)
+        for _ in range(opts.fit_steps):
+            train_step(name, model, opti, batch, precision)
+        model.eval()
+        fitted[precision] = model
+    preds = {}
+    with torch.no_grad():
+        for precision in ['fp32', 'bf16']:
+            preds[precision] = forward(name, fitted[precision], lab_b, spk_b,
+                                       precision)
+        # bf16 inference of the float32 fitted model
+        bf16_infer = forward(name, fitted['fp32'], lab_b, spk_b, 'bf16')
+    return {'infer':compare(name, bf16_infer, preds['fp32'], spk_b,
+                            aco_stats, dur_stats, opts.num_spks),
+            'fp32':compare(name, preds['fp32'], out_b, spk_b,
+                           aco_stats, dur_stats, opts.num_spks),
+            'bf16':compare(name, preds['bf16'], out_b, spk_b,
+                           aco_stats, dur_stats, opts.num_spks)}
+
+def format_metrics(name, res):
+    if name == 'dur':
+        return 'RMSE {:.3f} ms'.format(*res)
+    return 'MCD {:.4f} dB, F0 RMSE {:.3f} Hz'.format(*res)
+
+def main(opts):
+    torch.set_num_threads(opts.num_threads)
+    aco_stats, dur_stats = load_stats(opts.cfg_spk)
+    speakers = [str(spk) for spk in range(opts.num_spks)]
+    print('{:>6s} {:>13s} {:>13s} {:>8s} {:>13s} {:>13s} '
+          '{:>8s}'.format('model', 'fp32 step ms', 'bf16 step ms',
+                          'speedup', 'fp32 infer ms', 'bf16 infer ms',
+                          'speedup'))
+    accuracy = []
+    for name in opts.models:
+        torch.manual_seed(opts.seed)
+        batch = build_batch(name, opts)
+        fp32_step, fp32_infer = time_model(name, opts, speakers, batch, 'fp32')
+        bf16_step, bf16_infer = time_model(name, opts, speakers, batch, 'bf16')
+        print('{:>6s} {:>13.2f} {:>13.2f} {:>7.2f}x {:>13.2f} {:>13.2f} '
+              '{:>7.2f}x'.format(name, fp32_step * 1e3, bf16_step * 1e3,
+                                 fp32_step / bf16_step, fp32_infer * 1e3,
+                                 bf16_infer * 1e3, fp32_infer / bf16_infer))
+        if opts.fit_steps > 0:
+            accuracy.append((name, check_accuracy(name, opts, speakers, batch,
+                                                  aco_stats, dur_stats)))
+    for name, res in accuracy:
+        print('-- {} ({} fit steps)'.format(name, opts.fit_steps))
+        print('   bf16 vs fp32 inference: ' + format_metrics(name,
+                                                             res['infer']))
+        print('   fp32 fitted vs gtruth:  ' + format_metrics(name,
+                                                             res['fp32']))
+        print('   bf16 fitted vs gtruth:  ' + format_metrics(name,
+                                                             res['bf16']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', type=str, nargs='+',
+                        default=['rnn', 'dur', 'satt'])
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--seq_len', type=int, default=100)
+    parser.add_argument('--num_inputs', type=int, default=55)
+    parser.add_argument('--num_spks', type=int, default=4)
+    parser.add_argument('--emb_size', type=int, default=128)
+    parser.add_argument('--rnn_size', type=int, default=128)
+    parser.add_argument('--rnn_layers', type=int, default=1)
+    parser.add_argument('--satt_layers', type=int, default=2)
+    parser.add_argument('--steps', type=int, default=5,
+                        help='Steps timed per round (Def: 5).')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='Timed rounds, the median is reported '
+                             '(Def: 5).')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--fit_steps', type=int, default=100,
+                        help='Train steps fitting the models of the '
+                             'accuracy check. 0 skips it (Def: 100).')
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--cfg_spk', type=str, default=None,
+                        help='Speakers cfg with the de-normalization '
+                             'stats (Def: None, typical ranges).')
+    parser.add_argument('--num_threads', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1991)
+
+    opts = parser.parse_args()
+    main(opts)
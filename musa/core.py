@@ -2,6 +2,7 @@ import torch
 from torch.autograd import Variable
 import torch.nn.functional as F
 from .utils import *
+from .metrics import *
 from .datasets.utils import label_parser, label_encoder, tstamps_to_dur
 try:
     import ahoproc_tools
@@ -21,71 +22,214 @@ def train_engine(model, dloader, opt, log_freq, train_fn, train_criterion,
                  epochs, save_path, model_savename, tr_opts={}, eval_fn=None, 
                  val_dloader=None, eval_stats=None, eval_target=None, 
                  eval_patience=None, cuda=False, va_opts={}, log_writer=None,
-                 opt_scheduler=None):
+                 opt_scheduler=None, keep_last=None, keep_best=1,
+                 snapshot_every=0, resume=False, eval_every=0,
+                 eval_batches=None, full_eval_every=1):
+    """ Train for some epochs, evaluating and checkpointing the model
+        after every one of them
+
+        # Arguments
+            keep_last: num of latest epoch checkpoints kept (all if None).
+            keep_best: num of best eval_target checkpoints kept.
+            snapshot_every: the full training state (model, optimizer,
+                            scheduler, RNGs, engine counters and the
+                            state of the epoch function) is written at
+                            the end of every epoch, and also every
+                            snapshot_every train batches if > 0.
+            resume: continue from the last training state written in
+                    save_path (right after its batch).
+            eval_every: if > 0, the model is also evaluated every
+                        eval_every train steps (without histograms nor
+                        audio logs) and checkpointed (e<epoch>_s<step>).
+                        The patience, the opt_scheduler and the best
+                        checkpoints then follow these step evaluations
+                        (their scores are saved as step_<key>).
+            eval_batches: num of validation batches (a fixed subset,
+                          evenly spaced, see subset_loader) of the step
+                          evaluations. All of them if None.
+            full_eval_every: the full validation runs at the end of
+                             every full_eval_every epochs (0 for never).
+
+        # Returns
+            The best eval_target score (inf if there is none) and whether
+            the training ran out of patience.
+    """
     tr_loss = {}
     va_loss = {}
     min_va_loss = np.inf
     patience=eval_patience
-    for epoch in range(epochs):
-        best_model = False
-        tr_e_loss = train_fn(model, dloader, opt, log_freq, epoch,
-                             criterion=train_criterion,
-                             cuda=cuda, tr_opts=tr_opts.copy(),
-                             log_writer=log_writer)
-        for k, v in tr_e_loss.items():
-            if k not in tr_loss:
-                tr_loss[k] = [v]
+    if eval_fn:
+        if val_dloader is None:
+            raise ValueError('Train engine: please specify '
+                             'a validation data loader!')
+        if eval_target and eval_patience is None:
+            raise ValueError('Train engine: Need a patience '
+                             'factor to be specified '
+                             'whem eval_target is given')
+    num_batches = len(dloader)
+    # loader of the step evaluations
+    va_subset = None
+    if eval_fn and eval_every > 0:
+        va_subset = val_dloader
+        if eval_batches is not None:
+            va_subset = subset_loader(val_dloader, eval_batches)
+            print('Evaluating {} validation batches every {} train '
+                  'steps'.format(len(va_subset), eval_every))
+    # checkpoints are written in background, keeping the last and best
+    ckpts = CheckpointManager(save_path, model_savename,
+                              keep_last=keep_last, keep_best=keep_best)
+
+    def train_state(epoch, batch, epoch_rng, epoch_state=None):
+        return {'epoch':epoch, 'batch':batch,
+                'epoch_rng':epoch_rng, 'rng':get_rng_state(cuda),
+                'epoch_state':epoch_state,
+                'model':model.state_dict(), 'opt':opt.state_dict(),
+                'opt_scheduler':None if opt_scheduler is None else \
+                                opt_scheduler.state_dict(),
+                'tr_loss':tr_loss, 'va_loss':va_loss,
+                'min_va_loss':min_va_loss, 'patience':patience}
+
+    def validate(epoch, va_dloader, step=None):
+        """ Evaluate the model (within the epoch if step is given) and
+            return its eval_target score, or None if the patience does
+            not follow these evaluations, and whether it is out of
+            patience
+        """
+        nonlocal min_va_loss, patience
+        # the step evaluations are not logged in detail
+        val_scores = eval_fn(model, va_dloader, 
+                             epoch, cuda=cuda,
+                             stats=eval_stats,
+                             va_opts=va_opts.copy(),
+                             log_writer=log_writer if step is None else None)
+        if not eval_target:
+            return None, False
+        prefix = '' if step is None else 'step_'
+        for k, v in val_scores.items():
+            if prefix + k not in va_loss:
+                va_loss[prefix + k] = [v]
             else:
-                tr_loss[k].append(v)
-        if eval_fn:
-            if val_dloader is None:
-                raise ValueError('Train engine: please specify '
-                                 'a validation data loader!')
-            val_scores = eval_fn(model, val_dloader, 
-                                 epoch, cuda=cuda,
-                                 stats=eval_stats,
-                                 va_opts=va_opts.copy(),
+                va_loss[prefix + k].append(v)
+        va_score = val_scores[eval_target]
+        if step is not None:
+            print('Step {} val {}: {:.3f}'.format(step, eval_target,
+                                                   va_score))
+            write_scalar_log(va_score, 'step_' + eval_target, step,
+                             log_writer)
+        if (step is not None) != (va_subset is not None):
+            # only the scheduled evaluations are tracked: the step ones
+            # if there are any, the full ones otherwise
+            return None, False
+        if opt_scheduler is not None:
+            opt_scheduler.step(va_score)
+        # we have a target key to do early stopping upon it
+        if va_score < min_va_loss:
+            print('Val loss improved {:.3f} -> {:.3f}'
+                  ''.format(min_va_loss, va_score))
+            min_va_loss = va_score
+            patience = eval_patience
+        else:
+            patience -= 1
+            print('Val loss did not improve. Curr '
+                  'patience: {}/{}'.format(patience,
+                                           eval_patience))
+            if patience == 0:
+                print('Out of patience. Ending training.')
+                return va_score, True
+        return va_score, False
+
+    beg_epoch = 0
+    epoch_resume = None
+    if resume:
+        state = ckpts.load_state()
+        if state is None:
+            print('No training state to resume in {}, starting from '
+                  'scratch'.format(save_path))
+        else:
+            print('Resuming training from epoch {}, batch '
+                  '{}'.format(state['epoch'], state['batch']))
+            model.load_state_dict(state['model'])
+            opt.load_state_dict(state['opt'])
+            if opt_scheduler is not None:
+                opt_scheduler.load_state_dict(state['opt_scheduler'])
+            tr_loss = state['tr_loss']
+            va_loss = state['va_loss']
+            min_va_loss = state['min_va_loss']
+            patience = state['patience']
+            beg_epoch = state['epoch']
+            # RNGs as they were at the beginning of the epoch, so that
+            # the loader draws the same batches
+            set_rng_state(state['epoch_rng'])
+            if state['batch'] > 0:
+                epoch_resume = {'batch':state['batch'],
+                                'epoch_state':state['epoch_state'],
+                                'rng':state['rng']}
+    stop = False
+    try:
+        for epoch in range(beg_epoch, epochs):
+            va_score = None
+            epoch_rng = get_rng_state(cuda)
+            e_tr_opts = tr_opts.copy()
+            if snapshot_every > 0 or va_subset is not None:
+                def step_fn(batch, epoch_state, epoch=epoch,
+                            epoch_rng=epoch_rng):
+                    nonlocal stop
+                    step = epoch * num_batches + batch
+                    if va_subset is not None and step % eval_every == 0:
+                        step_score, stop = validate(epoch, va_subset,
+                                                    step=step)
+                        model.train()
+                        if stop:
+                            return True
+                        ckpts.save(model, epoch, val_score=step_score,
+                                   step=step)
+                    if snapshot_every > 0 and batch % snapshot_every == 0 \
+                       and batch < num_batches:
+                        ckpts.save_state(train_state(epoch, batch,
+                                                     epoch_rng, epoch_state))
+                    return False
+                e_tr_opts['step_fn'] = step_fn
+            if epoch_resume is not None:
+                e_tr_opts['resume'] = epoch_resume
+                epoch_resume = None
+            tr_e_loss = train_fn(model, dloader, opt, log_freq, epoch,
+                                 criterion=train_criterion,
+                                 cuda=cuda, tr_opts=e_tr_opts,
                                  log_writer=log_writer)
-            if eval_target:
-                if eval_patience is None:
-                    raise ValueError('Train engine: Need a patience '
-                                     'factor to be specified '
-                                     'whem eval_target is given')
-                for k, v in val_scores.items():
-                    if k not in va_loss:
-                        va_loss[k] = [v]
-                    else:
-                        va_loss[k].append(v)
-                if opt_scheduler is not None:
-                    opt_scheduler.step(val_scores[eval_target])
-                # we have a target key to do early stopping upon it
-                if val_scores[eval_target] < min_va_loss:
-                    print('Val loss improved {:.3f} -> {:.3f}'
-                          ''.format(min_va_loss, val_scores[eval_target]))
-                    min_va_loss = val_scores[eval_target]
-                    best_model = True
-                    patience = eval_patience
+            if stop:
+                break
+            for k, v in tr_e_loss.items():
+                if k not in tr_loss:
+                    tr_loss[k] = [v]
                 else:
-                    patience -= 1
-                    print('Val loss did not improve. Curr '
-                          'patience: {}/{}'.format(patience,
-                                                   eval_patience))
-                    if patience == 0:
-                        print('Out of patience. Ending training.')
-                        break
-        model.save(save_path, model_savename, epoch,
-                   best_val=best_model)
-        for k, v in tr_loss.items():
-            #print('Saving training loss ', k)
-            np.save(os.path.join(save_path, k), v)
-        if eval_target:
-            for k, v in va_loss.items():
-                #print('Saving val score ', k)
+                    tr_loss[k].append(v)
+            if eval_fn and full_eval_every > 0 and \
+               (epoch + 1) % full_eval_every == 0:
+                va_score, stop = validate(epoch, val_dloader)
+                if stop:
+                    break
+            ckpts.save(model, epoch, val_score=va_score)
+            for k, v in tr_loss.items():
+                #print('Saving training loss ', k)
                 np.save(os.path.join(save_path, k), v)
+            if eval_target:
+                for k, v in va_loss.items():
+                    #print('Saving val score ', k)
+                    np.save(os.path.join(save_path, k), v)
+            # the next epoch starts from here
+            next_rng = get_rng_state(cuda)
+            ckpts.save_state(train_state(epoch + 1, 0, next_rng))
+    finally:
+        # wait for the pending checkpoint writes (also when interrupted,
+        # so that the last training state can be resumed)
+        ckpts.close()
+    if ckpts.best() is not None:
+        print('Best checkpoint: ', os.path.join(save_path, ckpts.best()))
+    return min_va_loss, stop
 
 def synthesize(dur_model, aco_model, spk_id, spk2durstats, spk2acostats,
                save_path, out_fname, codebooks, lab_file, ogmios_fmt=True, 
-               cuda=False, force_dur=False, pf=1):
+               cuda=False, force_dur=False, pf=1, precision='fp32'):
     beg_t = timeit.default_timer()
     if not force_dur:
         dur_model.eval()
@@ -107,11 +251,12 @@ def synthesize(dur_model, aco_model, spk_id, spk2durstats, spk2acostats,
     lab_codes = np.array(lab_codes, dtype=np.float32)
     print('lab_codes tensor shape: ', lab_codes.shape)
     # prepare input data
-    lab_codes = Variable(torch.from_numpy(lab_codes).unsqueeze(0))
-    lab_codes = lab_codes.transpose(0, 1)
+    # time-major (T, 1, F)
+    lab_codes = Variable(torch.from_numpy(lab_codes).unsqueeze(1))
     if spk_id is not None:
-        spk_id = Variable(torch.LongTensor([spk_id] * lab_codes.size(0)))
-        spk_id = spk_id.view(lab_codes.size(0), 1, 1)
+        # time-major (T, 1)
+        spk_id = torch.LongTensor([spk_id] * lab_codes.size(0))
+        spk_id = spk_id.view(lab_codes.size(0), 1)
     if cuda:
         lab_codes = lab_codes.cuda()
         if spk_id is not None:
@@ -129,19 +274,21 @@ def synthesize(dur_model, aco_model, spk_id, spk2durstats, spk2acostats,
                 (durstats['max'] - durstats['min'])
     else:
         # predict durs
-        ndurs, _ = dur_model(lab_codes, None, spk_id)
+        with torch.no_grad(), precision_autocast(precision, cuda):
+            ndurs = dur_model.inference_forward(lab_codes, spk_id)
+        ndurs = ndurs.float()
         min_dur = durstats['min']
         max_dur = durstats['max']
-        dur = ndurs * min_dur - max_dur + min_dur
+        dur = ndurs * (max_dur - min_dur) + min_dur
 
     # build acoustic batch
     aco_inputs = []
     # go over time dur by dur
     for t in range(ndurs.size(0)):
-        ndur = np.asscalar(ndurs[t, :, :].cpu().data.numpy())
+        ndur = ndurs[t, :, :].item()
         # go over all windows within this dur
         reldur_c = 0.
-        dur_t = np.asscalar(dur[t, :, :].cpu().data.numpy())
+        dur_t = dur[t, :, :].item()
         while reldur_c <= dur_t:
             n_reldur = float(reldur_c) / dur_t
             # every 5ms, shift. TODO: change hardcode to allow speed variation
@@ -154,9 +301,13 @@ def synthesize(dur_model, aco_model, spk_id, spk2durstats, spk2acostats,
     #print('aco_inputs size: ', aco_inputs.size())
     if cuda:
         aco_inputs = aco_inputs.cuda()
-    yt, hstate, ostate = aco_model(aco_inputs,
-                                   None, None,
-                                   spk_id)
+    aco_spk = None
+    if spk_id is not None:
+        # speaker ids at the acoustic frame rate
+        aco_spk = spk_id[:1].repeat(aco_seqlen, 1)
+    with torch.no_grad(), precision_autocast(precision, cuda):
+        yt = aco_model.inference_forward(aco_inputs, aco_spk)
+    yt = yt.float()
     #np.save('synth_aco_inputs.npy', aco_inputs.squeeze(1).cpu().data.numpy())
     #np.save('synth_aco_outputs.npy', yt.squeeze(1).cpu().data.numpy())
     acostats = spk2acostats[spk_int]
@@ -178,11 +329,11 @@ def synthesize(dur_model, aco_model, spk_id, spk2durstats, spk2acostats,
                                                     len(fv))
     # write the output ahocoder files
     write_aco_file(os.path.join(save_path, 
-                                '{}.cc'.format(out_fname), mfcc))
+                                '{}.cc'.format(out_fname)), mfcc)
     write_aco_file(os.path.join(save_path, 
-                                '{}.lf0'.format(out_fname), lf0))
+                                '{}.lf0'.format(out_fname)), lf0)
     write_aco_file(os.path.join(save_path, 
-                                '{}.fv'.format(out_fname), fv))
+                                '{}.fv'.format(out_fname)), fv)
     aco2wav(os.path.join(save_path, out_fname))
     end_t = timeit.default_timer()
     print('[*] Synthesis completed into file: {}.wav .\n'
@@ -192,7 +343,8 @@ def synthesize(dur_model, aco_model, spk_id, spk2durstats, spk2acostats,
 
 def att_synthesize(dur_model, aco_model, spk_id, spk2durstats, spk2acostats,
                    save_path, out_fname, codebooks, lab_file, ogmios_fmt=True, 
-                   cuda=False, force_dur=False, pf=1):
+                   cuda=False, force_dur=False, pf=1,
+                   precision='fp32'):
     beg_t = timeit.default_timer()
     if not force_dur:
         dur_model.eval()
@@ -214,11 +366,12 @@ def att_synthesize(dur_model, aco_model, spk_id, spk2durstats, spk2acostats,
     lab_codes = np.array(lab_codes, dtype=np.float32)
     print('lab_codes tensor shape: ', lab_codes.shape)
     # prepare input data
-    lab_codes = Variable(torch.from_numpy(lab_codes).unsqueeze(0))
-    lab_codes = lab_codes.transpose(0, 1)
+    # time-major (T, 1, F)
+    lab_codes = Variable(torch.from_numpy(lab_codes).unsqueeze(1))
     if spk_id is not None:
-        spk_id = Variable(torch.LongTensor([spk_id] * lab_codes.size(0)))
-        spk_id = spk_id.view(lab_codes.size(0), 1, 1)
+        # time-major (T, 1)
+        spk_id = torch.LongTensor([spk_id] * lab_codes.size(0))
+        spk_id = spk_id.view(lab_codes.size(0), 1)
     if cuda:
         lab_codes = lab_codes.cuda()
         if spk_id is not None:
@@ -236,19 +389,21 @@ def att_synthesize(dur_model, aco_model, spk_id, spk2durstats, spk2acostats,
                 (durstats['max'] - durstats['min'])
     else:
         # predict durs
-        ndurs, _ = dur_model(lab_codes, None, spk_id)
+        with torch.no_grad(), precision_autocast(precision, cuda):
+            ndurs = dur_model.inference_forward(lab_codes, spk_id)
+        ndurs = ndurs.float()
         min_dur = durstats['min']
         max_dur = durstats['max']
-        dur = ndurs * min_dur - max_dur + min_dur
+        dur = ndurs * (max_dur - min_dur) + min_dur
 
     # build acoustic batch
     aco_inputs = []
     # go over time dur by dur
     for t in range(ndurs.size(0)):
-        ndur = np.asscalar(ndurs[t, :, :].cpu().data.numpy())
+        ndur = ndurs[t, :, :].item()
         # go over all windows within this dur
         reldur_c = 0.
-        dur_t = np.asscalar(dur[t, :, :].cpu().data.numpy())
+        dur_t = dur[t, :, :].item()
         while reldur_c < dur_t:
             n_reldur = float(reldur_c) / dur_t
             # every 5ms, shift. TODO: change hardcode to allow speed variation
@@ -260,8 +415,13 @@ def att_synthesize(dur_model, aco_model, spk_id, spk2durstats, spk2acostats,
     aco_inputs = aco_inputs.view(aco_seqlen, 1, -1)
     if cuda:
         aco_inputs = aco_inputs.cuda()
-    with torch.no_grad():
-        yt = aco_model(aco_inputs, speaker_idx=spk_id)
+    aco_spk = None
+    if spk_id is not None:
+        # speaker ids at the acoustic frame rate
+        aco_spk = spk_id[:1].repeat(aco_seqlen, 1)
+    with torch.no_grad(), precision_autocast(precision, cuda):
+        yt = aco_model.inference_forward(aco_inputs, aco_spk)
+    yt = yt.float()
     print('yt size: ', yt.size())
     acostats = spk2acostats[spk_int]
     min_aco = acostats['min']
@@ -309,6 +469,18 @@ def train_aco_epoch(model, dloader, opt, log_freq, epoch_idx,
     idx2spk = None
     if 'idx2spk' in tr_opts:
         idx2spk = tr_opts.pop('idx2spk')
+    # num of batches staged ahead by a background thread
+    prefetch = 0
+    if 'prefetch' in tr_opts:
+        prefetch = tr_opts.pop('prefetch')
+    # precision of the forward passes (fp32 or bf16 autocast)
+    precision = 'fp32'
+    if 'precision' in tr_opts:
+        precision = tr_opts.pop('precision')
+    # train MCD is accumulated every metric_every batches (0 skips it)
+    metric_every = 1
+    if 'metric_every' in tr_opts:
+        metric_every = tr_opts.pop('metric_every')
     mulout = False
     round_N = 1
     if 'mulout' in tr_opts:
@@ -318,6 +490,23 @@ def train_aco_epoch(model, dloader, opt, log_freq, epoch_idx,
         if idx2spk is None:
             raise ValueError('Specify a idx2spk in training opts '
                              'when using MO.')
+    # packed MO batches (MOSampler with pack_rounds) are whole rounds,
+    # their rows are routed to the output of their speaker
+    mo_packed = False
+    if 'mo_packed' in tr_opts:
+        mo_packed = tr_opts.pop('mo_packed')
+        round_N = 1
+        if mo_packed and not mulout:
+            raise ValueError('Packed MO batches require MO training.')
+    # step_fn(batch, epoch_state) is called after every batch (see
+    # train_engine) and ends the epoch if it returns True, and resume
+    # holds the epoch state to continue from
+    step_fn = None
+    if 'step_fn' in tr_opts:
+        step_fn = tr_opts.pop('step_fn')
+    resume = None
+    if 'resume' in tr_opts:
+        resume = tr_opts.pop('resume')
     assert len(tr_opts) == 0, 'unrecognized params passed in: '\
                               '{}'.format(tr_opts.keys())
     epoch_losses = {}
@@ -326,25 +515,64 @@ def train_aco_epoch(model, dloader, opt, log_freq, epoch_idx,
     # keep stateful references by spk idx
     spk2hid_states = {}
     spk2out_states = {}
-    if mulout:
-        # keep track of the losses per round to make a proper log
-        # when MO is running 
-        spk_loss_batch = {}
+    # states of the rows of packed MO batches, and their speakers
+    packed_states = None
+    # losses and metrics stay in the device until they are logged
+    losses = LossAccumulator()
+    tr_metrics = None
+    if metric_every > 0:
+        assert spk2acostats is not None
+        # MO metrics are reported per speaker (keyed by name)
+        tr_metrics = AcoMetricAccumulator(spk2acostats, idx2spk)
+    beg_batch = 0
+    resume_rng = None
+    if resume is not None:
+        # continue the epoch right after the snapshot batch
+        beg_batch = resume['batch']
+        # RNG as it was after the snapshot batch, restored once the
+        # skipped batches replayed the loader draws
+        resume_rng = resume['rng']
+        epoch_state = resume['epoch_state']
+        spk2hid_states = epoch_state['spk2hid_states']
+        spk2out_states = epoch_state['spk2out_states']
+        packed_states = epoch_state['packed_states']
+        losses.load_state_dict(epoch_state['losses'])
+        if tr_metrics is not None:
+            tr_metrics.load_state_dict(epoch_state['tr_metrics'])
+        epoch_losses = epoch_state['epoch_losses']
+        global_step += beg_batch
 
-    for b_idx, batch in enumerate(dloader):
+    # batches come time-major (as collated) and already in the device,
+    # MO ones with the speakers of their rows read before staging them
+    batches = DevicePrefetcher(dloader, cuda, depth=prefetch,
+                               skip=beg_batch, host_spks=mulout,
+                               rng=resume_rng)
+    for b_idx, batch in enumerate(batches, start=beg_batch):
+        if mulout:
+            batch, batch_spks = batch
         # decompose the batch into the sub-batches
-        spk_b, lab_b, aco_b, slen_b, ph_b = batch
-        # build batch of curr_ph to filter out results without sil phones
-        # size of curr_ph_b [bsize, seqlen]
-        curr_ph_b = [[ph[2] for ph in ph_s] for ph_s in ph_b]
-        # convert all into variables and transpose (we want time-major)
-        spk_b = spk_b.transpose(0,1)
-        spk_name = idx2spk[spk_b.data[0,0].item()]
-        lab_b = lab_b.transpose(0,1)
-        aco_b = aco_b.transpose(0,1)
+        spk_b, lab_b, aco_b, slen_b, ph_b, sil_b = batch
+        # sil_b [seqlen, bsize] flags the silence frames (filtered out
+        # of the masked metrics)
+        spk_name = None
+        row_spks = None
+        if mo_packed:
+            # speaker of every row, which picks its output
+            row_spks = [idx2spk[spk] for spk in batch_spks]
+        elif mulout:
+            # MO batches have a single speaker, which picks the output
+            spk_name = idx2spk[batch_spks[0]]
         # get curr batch size
         curr_bsz = spk_b.size(1)
-        if spk_name not in spk2hid_states:
+        if mo_packed and packed_states is None:
+            hid_state = model.init_hidden_state(curr_bsz)
+            out_state = model.init_output_state(curr_bsz, packed=True)
+        elif mo_packed:
+            # every speaker carries on its rows (detached)
+            hid_state, out_state, state_spks = packed_states
+            hid_state = repack_rows(hid_state, state_spks, row_spks)
+            out_state = repack_rows(out_state, state_spks, row_spks)
+        elif spk_name not in spk2hid_states:
             # initialize hidden states for this (hidden and out) speaker
             #print('Initializing states of spk ', spk_name)
             hid_state = model.init_hidden_state(curr_bsz)
@@ -358,16 +586,20 @@ def train_aco_epoch(model, dloader, opt, log_freq, epoch_idx,
             hid_state = repackage_hidden(hid_state, curr_bsz)
             out_state = repackage_hidden(out_state, curr_bsz)
         if cuda:
-            spk_b = var_to_cuda(spk_b)
-            lab_b = var_to_cuda(lab_b)
-            aco_b = var_to_cuda(aco_b)
-            slen_b = var_to_cuda(slen_b)
             hid_state = var_to_cuda(hid_state)
             out_state = var_to_cuda(out_state)
         #print(list(out_state.keys()))
         #print('lab_b size: ', lab_b.size())
         # forward through model
-        y, hid_state, out_state = model(lab_b, hid_state, out_state, speaker_idx=spk_b)
+        with precision_autocast(precision, cuda):
+            if mo_packed:
+                y, hid_state, out_state = model(lab_b, hid_state, out_state,
+                                                speaker_idx=spk_b,
+                                                out_spks=row_spks)
+                packed_states = (hid_state, out_state, row_spks)
+            else:
+                y, hid_state, out_state = model(lab_b, hid_state, out_state,
+                                                speaker_idx=spk_b)
         if isinstance(y, dict):
             # we have a MO model, pick the right spk
             y = y[spk_name]
@@ -375,39 +607,8 @@ def train_aco_epoch(model, dloader, opt, log_freq, epoch_idx,
             # save its states
             spk2hid_states[spk_name] = hid_state
             spk2out_states[spk_name] = out_state
-        y = y.squeeze(-1)
-        loss = criterion(y, aco_b)
-        if mulout:
-            spk_loss_batch[idx2spk[spk_b[0,0].cpu().data[0]]] = loss.data[0]
-
-        if criterion != F.nll_loss:
-            # TODO: add the aco eval
-            preds = None
-            gtruths = None
-            seqlens = None
-            spks = None
-            # make the silence mask
-            sil_mask = None
-            preds, gtruths, \
-            spks, sil_mask = predict_masked_mcd(y, aco_b, slen_b, 
-                                                spk_b, curr_ph_b,
-                                                preds, gtruths,
-                                                spks, sil_mask,
-                                                'pau')
-            #print('Tr After batch preds shape: ', preds.shape)
-            #print('Tr After batch gtruths shape: ', gtruths.shape)
-            #print('Tr After batch sil_mask shape: ', sil_mask.shape)
-            # denorm with normalization stats
-            assert spk2acostats is not None
-            preds, gtruths = denorm_aco_preds_gtruth(preds, gtruths,
-                                                     spks, spk2acostats)
-            #print('preds[:20] = ', preds[:20])
-            #print('gtruths[:20] = ', gtruths[:20])
-            #print('pred min: {}, max: {}'.format(preds.min(), preds.max()))
-            #print('gtruths min: {}, max: {}'.format(gtruths.min(), gtruths.max()))
-            nosil_aco_mcd = mcd(preds[:,:40] * sil_mask, gtruths[:,:40] * sil_mask)
-        else:
-            nosil_aco_mcd = None
+        # loss and metrics in float32
+        y = y.squeeze(-1).float()
         # compute loss
         if criterion == F.nll_loss:
             raise NotImplementedError('No nll_loss possible')
@@ -416,11 +617,17 @@ def train_aco_epoch(model, dloader, opt, log_freq, epoch_idx,
             #q_classes = True
         #print('y size: ', y.size())
         #print('aco_b: ', aco_b.size())
-        if mulout:
-            #print('Keeping {} spk loss'
-            #      ' {:.4f}'.format(idx2spk[spk_b[0,0].cpu().data[0]],
-            #                                          loss.data[0]))
-            spk_loss_batch[idx2spk[spk_b[0,0].item()]] = loss.data[0]
+        loss = criterion(y, aco_b)
+        if tr_metrics is not None and b_idx % metric_every == 0:
+            tr_metrics.update(y.detach(), aco_b, slen_b, spk_b, sil_b)
+        if mo_packed:
+            for spk, spk_loss in packed_spk_losses(criterion, y, aco_b,
+                                                   row_spks).items():
+                losses.add(spk_loss, spk)
+        elif mulout:
+            losses.add(loss, spk_name)
+        else:
+            losses.add(loss)
                 
         #print('batch {:4d}: loss: {:.5f}'.format(b_idx + 1, loss.data[0]))
         opt.zero_grad()
@@ -432,9 +639,15 @@ def train_aco_epoch(model, dloader, opt, log_freq, epoch_idx,
             log_mesg = 'batch {:4d}/{:4d} (epoch {:3d})'.format(b_idx + 1,
                                                                 num_batches,
                                                                 epoch_idx)
+            # mean losses since the last log (single sync)
+            tr_losses = losses.means()
+            nosil_aco_mcd = None
+            if tr_metrics is not None and tr_metrics.num_frames > 0:
+                nosil_aco_mcd = tr_metrics.mcd(nosil=True)
+                tr_metrics.reset()
             if mulout:
                 log_mesg += ' MO losses: ('
-                for mok, moloss in spk_loss_batch.items():
+                for mok, moloss in tr_losses.items():
                     log_mesg += '{}:{:.3f},'.format(mok, moloss)
                     loss_mo_name = 'mo-{}_tr_loss'.format(mok)
                     if loss_mo_name not in epoch_losses:
@@ -443,23 +656,48 @@ def train_aco_epoch(model, dloader, opt, log_freq, epoch_idx,
                     write_scalar_log(moloss, loss_mo_name,
                                      global_step, log_writer)
                 log_mesg = log_mesg[:-1] + ')'
+                if nosil_aco_mcd is not None:
+                    log_mesg += ' MO MCD: ('
+                    for mok, momcd in nosil_aco_mcd.items():
+                        if mok == 'total':
+                            continue
+                        log_mesg += '{}:{:.3f},'.format(mok, momcd)
+                        mcd_mo_name = 'mo-{}_tr_mcd'.format(mok)
+                        if mcd_mo_name not in epoch_losses:
+                            epoch_losses[mcd_mo_name] = []
+                        epoch_losses[mcd_mo_name].append(momcd)
+                        write_scalar_log(momcd, mcd_mo_name,
+                                         global_step, log_writer)
+                    log_mesg = log_mesg[:-1] + ') dB'
             else:
-                log_mesg += ' loss {:.5f}'.format(loss.item())
+                tr_loss = tr_losses['tr_loss']
+                log_mesg += ' loss {:.5f}'.format(tr_loss)
                 if nosil_aco_mcd is not None:
+                    nosil_aco_mcd = nosil_aco_mcd['total']
                     log_mesg += ', MCD {:.5f} dB'.format(nosil_aco_mcd)
                 if 'tr_loss' not in epoch_losses:
                     epoch_losses['tr_loss'] = []
-                    if nosil_aco_mcd:
-                        epoch_losses['tr_mcd'] = []
-                epoch_losses['tr_loss'].append(loss.item())
-                write_scalar_log(loss.item(), 'tr_loss',
+                epoch_losses['tr_loss'].append(tr_loss)
+                write_scalar_log(tr_loss, 'tr_loss',
                                  global_step, log_writer)
-                if nosil_aco_mcd:
+                if nosil_aco_mcd is not None:
+                    if 'tr_mcd' not in epoch_losses:
+                        epoch_losses['tr_mcd'] = []
                     epoch_losses['tr_mcd'].append(nosil_aco_mcd)
                     write_scalar_log(nosil_aco_mcd, 'tr_mcd',
                                      global_step, log_writer)
             print(log_mesg)
         global_step += 1
+        if step_fn is not None and \
+           step_fn(b_idx + 1, {'spk2hid_states':spk2hid_states,
+                               'spk2out_states':spk2out_states,
+                               'packed_states':packed_states,
+                               'losses':losses.state_dict(),
+                               'tr_metrics':None if tr_metrics is None else \
+                                            tr_metrics.state_dict(),
+                               'epoch_losses':epoch_losses}):
+            # out of patience
+            break
     end_log = '-- Finished epoch {:4d}, mean losses:'.format(epoch_idx)
     if isinstance(epoch_losses, dict):
         for k, val in epoch_losses.items():
@@ -486,6 +724,18 @@ def train_dur_epoch(model, dloader, opt, log_freq, epoch_idx,
     idx2spk = None
     if 'idx2spk' in tr_opts:
         idx2spk = tr_opts.pop('idx2spk')
+    # num of batches staged ahead by a background thread
+    prefetch = 0
+    if 'prefetch' in tr_opts:
+        prefetch = tr_opts.pop('prefetch')
+    # precision of the forward passes (fp32 or bf16 autocast)
+    precision = 'fp32'
+    if 'precision' in tr_opts:
+        precision = tr_opts.pop('precision')
+    # train RMSE is accumulated every metric_every batches (0 skips it)
+    metric_every = 1
+    if 'metric_every' in tr_opts:
+        metric_every = tr_opts.pop('metric_every')
     mulout = False
     round_N = 1
     if 'mulout' in tr_opts:
@@ -495,24 +745,76 @@ def train_dur_epoch(model, dloader, opt, log_freq, epoch_idx,
         if idx2spk is None:
             raise ValueError('Specify a idx2spk in training opts '
                              'when using MO.')
+    # packed MO batches (MOSampler with pack_rounds) are whole rounds,
+    # their rows are routed to the output of their speaker
+    mo_packed = False
+    if 'mo_packed' in tr_opts:
+        mo_packed = tr_opts.pop('mo_packed')
+        round_N = 1
+        if mo_packed and not mulout:
+            raise ValueError('Packed MO batches require MO training.')
+        if mo_packed and criterion == F.nll_loss:
+            raise NotImplementedError('Packed MO batches are not supported '
+                                      'with quantized durations.')
+    # step_fn(batch, epoch_state) is called after every batch (see
+    # train_engine) and ends the epoch if it returns True, and resume
+    # holds the epoch state to continue from
+    step_fn = None
+    if 'step_fn' in tr_opts:
+        step_fn = tr_opts.pop('step_fn')
+    resume = None
+    if 'resume' in tr_opts:
+        resume = tr_opts.pop('resume')
     assert len(tr_opts) == 0, 'unrecognized params passed in: '\
                               '{}'.format(tr_opts.keys())
     epoch_losses = {}
     num_batches = len(dloader)
-    if mulout:
-        # keep track of the losses per round to make a proper log
-        # when MO is running 
-        spk_loss_batch = {}
-    for b_idx, batch in enumerate(dloader):
+    # losses and metrics stay in the device until they are logged
+    losses = LossAccumulator()
+    tr_metrics = None
+    if metric_every > 0 and criterion != F.nll_loss:
+        assert spk2durstats is not None
+        # MO metrics are reported per speaker (keyed by name)
+        tr_metrics = DurMetricAccumulator(spk2durstats, idx2spk)
+    states = None
+    # speakers of the state rows of packed MO batches
+    state_spks = None
+    beg_batch = 0
+    resume_rng = None
+    if resume is not None:
+        # continue the epoch right after the snapshot batch
+        beg_batch = resume['batch']
+        # RNG as it was after the snapshot batch, restored once the
+        # skipped batches replayed the loader draws
+        resume_rng = resume['rng']
+        epoch_state = resume['epoch_state']
+        states = epoch_state['states']
+        state_spks = epoch_state['state_spks']
+        losses.load_state_dict(epoch_state['losses'])
+        if tr_metrics is not None:
+            tr_metrics.load_state_dict(epoch_state['tr_metrics'])
+        epoch_losses = epoch_state['epoch_losses']
+        global_step += beg_batch
+    # batches come time-major (as collated) and already in the device,
+    # MO ones with the speakers of their rows read before staging them
+    batches = DevicePrefetcher(dloader, cuda, depth=prefetch,
+                               skip=beg_batch, host_spks=mulout,
+                               rng=resume_rng)
+    for b_idx, batch in enumerate(batches, start=beg_batch):
+        if mulout:
+            batch, batch_spks = batch
         # decompose the batch into the sub-batches
-        spk_b, lab_b, dur_b, slen_b, ph_b = batch
-        # build batch of curr_ph to filter out results without sil phones
-        # size of curr_ph_b [bsize, seqlen]
-        curr_ph_b = [[ph[2] for ph in ph_s] for ph_s in ph_b]
-        # convert all into variables and transpose (we want time-major)
-        spk_b = spk_b.transpose(0,1)
-        lab_b = lab_b.transpose(0,1)
-        dur_b = dur_b.transpose(0,1)
+        spk_b, lab_b, dur_b, slen_b, ph_b, sil_b = batch
+        # sil_b [seqlen, bsize] flags the silence frames (filtered out
+        # of the masked metrics)
+        spk_name = None
+        row_spks = None
+        if mo_packed:
+            # speaker of every row, which picks its output
+            row_spks = [idx2spk[spk] for spk in batch_spks]
+        elif mulout:
+            # MO batches have a single speaker, which picks the output
+            spk_name = idx2spk[batch_spks[0]]
         # get curr batch size
         curr_bsz = spk_b.size(1)
         if (stateful and b_idx == 0) or not stateful:
@@ -525,65 +827,47 @@ def train_dur_epoch(model, dloader, opt, log_freq, epoch_idx,
             #      '{}'.format(epoch_idx, b_idx))
             #print('states: ', states)
             # copy last states
-            states = tuple(st.detach() for st in states)
+            if mo_packed:
+                # every speaker carries on its rows
+                states = repack_rows(states, state_spks, row_spks)
+            else:
+                states = tuple(st.detach().float() for st in states)
             #states = repackage_hidden(states, curr_bsz)
         if cuda:
-            spk_b = var_to_cuda(spk_b)
-            lab_b = var_to_cuda(lab_b)
-            dur_b = var_to_cuda(dur_b)
-            slen_b = var_to_cuda(slen_b)
             states = var_to_cuda(states)
         # forward through model
-        y, states = model(lab_b, states, speaker_idx=spk_b)
+        with precision_autocast(precision, cuda):
+            if mo_packed:
+                y, states = model(lab_b, states, speaker_idx=spk_b,
+                                  out_spks=row_spks)
+                state_spks = row_spks
+            else:
+                y, states = model(lab_b, states, speaker_idx=spk_b)
         if isinstance(y, dict):
             # we have a MO model, pick the right spk
-            spk_name = idx2spk[spk_b.cpu().data[0,0]]
             # print('Extracting y prediction for MO spk ', spk_name)
             y = y[spk_name]
         q_classes = False
         #print('y size: ', y.size())
         #print('states[0] size: ', states[0].size())
-        y = y.squeeze(-1)
-        if criterion != F.nll_loss:
-            preds = None
-            gtruths = None
-            seqlens = None
-            spks = None
-            # make the silence mask
-            sil_mask = None
-            preds, gtruths, \
-            spks, sil_mask = predict_masked_rmse(y, dur_b, slen_b, 
-                                                 spk_b, curr_ph_b,
-                                                 preds, gtruths,
-                                                 spks, sil_mask,
-                                                 'pau',
-                                                 q_classes)
-            #print('Tr After batch preds shape: ', preds.shape)
-            #print('Tr After batch gtruths shape: ', gtruths.shape)
-            #print('Tr After batch sil_mask shape: ', sil_mask.shape)
-            # denorm with normalization stats
-            assert spk2durstats is not None
-            preds, gtruths = denorm_dur_preds_gtruth(preds, gtruths,
-                                                     spks, spk2durstats,
-                                                     q_classes)
-            #print('preds[:20] = ', preds[:20])
-            #print('gtruths[:20] = ', gtruths[:20])
-            #print('pred min: {}, max: {}'.format(preds.min(), preds.max()))
-            #print('gtruths min: {}, max: {}'.format(gtruths.min(), gtruths.max()))
-            nosil_dur_rmse = rmse(preds * sil_mask, gtruths * sil_mask) * 1e3
-        else:
-            nosil_dur_rmse = None
+        # loss and metrics in float32
+        y = y.squeeze(-1).float()
+        if tr_metrics is not None and b_idx % metric_every == 0:
+            tr_metrics.update(y.detach(), dur_b, slen_b, spk_b, sil_b)
         # compute loss
         if criterion == F.nll_loss:
             y = y.view(-1, y.size(-1))
             dur_b = dur_b.view(-1)
             q_classes = True
         loss = criterion(y, dur_b)
-        if mulout:
-            #print('Keeping {} spk loss'
-            #      ' {:.4f}'.format(idx2spk[spk_b[0,0].cpu().data[0]],
-            #                                          loss.data[0]))
-            spk_loss_batch[idx2spk[spk_b[0,0].cpu().data[0]]] = loss.data[0]
+        if mo_packed:
+            for spk, spk_loss in packed_spk_losses(criterion, y, dur_b,
+                                                   row_spks).items():
+                losses.add(spk_loss, spk)
+        elif mulout:
+            losses.add(loss, spk_name)
+        else:
+            losses.add(loss)
                 
         #print('batch {:4d}: loss: {:.5f}'.format(b_idx + 1, loss.data[0]))
         opt.zero_grad()
@@ -595,34 +879,64 @@ def train_dur_epoch(model, dloader, opt, log_freq, epoch_idx,
             log_mesg = 'batch {:4d}/{:4d} (epoch {:3d})'.format(b_idx + 1,
                                                                 num_batches,
                                                                 epoch_idx)
+            # mean losses since the last log (single sync)
+            tr_losses = losses.means()
+            nosil_dur_rmse = None
+            spk_dur_rmse = None
+            if tr_metrics is not None and tr_metrics.num_frames > 0:
+                nosil_dur_rmse, spk_dur_rmse = tr_metrics.dur_rmse(nosil=True)
+                nosil_dur_rmse = nosil_dur_rmse * 1e3
+                tr_metrics.reset()
             if mulout:
                 log_mesg += ' MO losses: ('
-                for mok, moloss in spk_loss_batch.items():
+                for mok, moloss in tr_losses.items():
                     log_mesg += '{}:{:.3f},'.format(mok, moloss)
                     loss_mo_name = 'mo-{}_tr_loss'.format(mok)
                     if loss_mo_name not in epoch_losses:
                         epoch_losses[loss_mo_name] = []
                     epoch_losses[loss_mo_name].append(moloss)
                 log_mesg = log_mesg[:-1] + ')'
+                if spk_dur_rmse is not None:
+                    log_mesg += ' MO rmse: ('
+                    for mok, mormse in spk_dur_rmse.items():
+                        mormse = mormse * 1e3
+                        log_mesg += '{}:{:.3f},'.format(mok, mormse)
+                        rmse_mo_name = 'mo-{}_tr_rmse'.format(mok)
+                        if rmse_mo_name not in epoch_losses:
+                            epoch_losses[rmse_mo_name] = []
+                        epoch_losses[rmse_mo_name].append(mormse)
+                        write_scalar_log(mormse, rmse_mo_name,
+                                         global_step, log_writer)
+                    log_mesg = log_mesg[:-1] + ') ms'
             else:
-                log_mesg += ' loss {:.5f}'.format(loss.data[0])
+                tr_loss = tr_losses['tr_loss']
+                log_mesg += ' loss {:.5f}'.format(tr_loss)
                 if nosil_dur_rmse is not None:
                     log_mesg += ', rmse {:.5f} ms'.format(nosil_dur_rmse)
                 if 'tr_loss' not in epoch_losses:
                     epoch_losses['tr_loss'] = []
-                    if nosil_dur_rmse:
-                        epoch_losses['tr_rmse'] = []
-                epoch_losses['tr_loss'].append(loss.data[0])
-                write_scalar_log(loss.data[0], 'tr_loss',
+                epoch_losses['tr_loss'].append(tr_loss)
+                write_scalar_log(tr_loss, 'tr_loss',
                                  global_step, log_writer)
                 write_histogram_log(dur_b, 'train/dur', global_step, 
                                     log_writer)
-                if nosil_dur_rmse:
+                if nosil_dur_rmse is not None:
+                    if 'tr_rmse' not in epoch_losses:
+                        epoch_losses['tr_rmse'] = []
                     epoch_losses['tr_rmse'].append(nosil_dur_rmse)
                     write_scalar_log(nosil_dur_rmse, 'tr_nosil_dur_rmse',
                                      global_step, log_writer)
             print(log_mesg)
         global_step += 1
+        if step_fn is not None and \
+           step_fn(b_idx + 1, {'states':states if stateful else None,
+                               'state_spks':state_spks,
+                               'losses':losses.state_dict(),
+                               'tr_metrics':None if tr_metrics is None else \
+                                            tr_metrics.state_dict(),
+                               'epoch_losses':epoch_losses}):
+            # out of patience
+            break
     end_log = '-- Finished epoch {:4d}, mean losses:'.format(epoch_idx)
     for k, val in epoch_losses.items():
         end_log += ' ({} : {:.5f})'.format(k, np.mean(val))
@@ -641,6 +955,10 @@ def eval_aco_epoch(model, dloader, epoch_idx, cuda=False,
         idx2spk = None
         if 'idx2spk' in va_opts:
             idx2spk = va_opts.pop('idx2spk')
+        # precision of the forward passes (fp32 or bf16 autocast)
+        precision = 'fp32'
+        if 'precision' in va_opts:
+            precision = va_opts.pop('precision')
         mulout = False
         if 'mulout' in va_opts:
             print('Multi-Output aco evaluation')
@@ -651,47 +969,29 @@ def eval_aco_epoch(model, dloader, epoch_idx, cuda=False,
         assert len(va_opts) == 0, 'unrecognized params passed in: '\
                                   '{}'.format(va_opts.keys())
         spk2acostats=stats
-        preds = None
-        gtruths = None
-        seqlens = None
-        spks = None
-        # make the silence mask
-        sil_mask = None
-        all_phones = []
+        assert spk2acostats is not None
+        # masked metric sums are accumulated in the device, frames are
+        # only sampled for the histograms and the audio when logging
+        hist_frames = 0
+        audio_frames = 0
+        if log_writer is not None:
+            hist_frames = 20000
+            # 10 s of 5 ms frames
+            audio_frames = 2000
+        metrics = AcoMetricAccumulator(spk2acostats, idx2spk,
+                                       hist_frames=hist_frames,
+                                       audio_frames=audio_frames)
         # keep stateful references by spk idx
         spk2hid_states = {}
         spk2out_states = {}
         for b_idx, batch in enumerate(dloader):
             # decompose the batch into the sub-batches
-            spk_b, lab_b, aco_b, slen_b, ph_b = batch
-            #print('aco_b size: ', aco_b.size())
-            #print('aco_b size: ', aco_b.size())
-            #print('ph_b: ', ph_b)
-            # build batch of curr_ph to filter out results without sil phones
-            # size of curr_ph_b [bsize, seqlen]
-            curr_ph_b = []
-            for ph_s in ph_b:
-                phone_seq = []
-                for ph in ph_s:
-                    phone_seq.append(ph[2])
-                    all_phones.append(ph[2])
-                curr_ph_b.append(phone_seq)
-                #curr_ph_b = [[ph[2] for ph in ph_s] for ph_s in ph_b]
-            #print('len(curr_ph_b): ', len(curr_ph_b))
-            #print('len(curr_ph_b[0]): ', len(curr_ph_b[0]))
-            # convert all into variables and transpose (we want time-major)
-            # TODO: write temporally lab_b adn aco_b to compare to synth
-            # batches for aco objective eval mismatch
-            aco_b_npy = aco_b.data.numpy()
-            lab_b_npy = lab_b.data.numpy()
-            #np.save('eval_aco_{}.npy'.format(b_idx),
-            #        aco_b_npy)
-            #np.save('eval_lab_{}.npy'.format(b_idx),
-            #        lab_b_npy)
-            spk_b = spk_b.transpose(0,1)
-            spk_name = idx2spk[spk_b.cpu().data[0,0].item()]
-            lab_b = lab_b.transpose(0,1)
-            aco_b = aco_b.transpose(0,1)
+            spk_b, lab_b, aco_b, slen_b, ph_b, sil_b = batch
+            # sil_b [seqlen, bsize] flags the silence frames (filtered out
+            # of the masked metrics)
+            # batches hold a single speaker, read from the host-side
+            # batch before the device copy
+            spk_name = idx2spk[spk_b[0, 0].item()]
             # get curr batch size
             curr_bsz = spk_b.size(1)
             # TODO: atm it is NOT stateful
@@ -716,13 +1016,10 @@ def eval_aco_epoch(model, dloader, epoch_idx, cuda=False,
                 hid_state = var_to_cuda(hid_state)
                 out_state = var_to_cuda(out_state)
             # forward through model
-            y, hid_state, out_state = model(lab_b, hid_state, 
-                                            out_state, 
-                                            speaker_idx=spk_b)
-            spk_npy = spk_b.cpu().data.numpy()
-            #print(spk_npy)
-            all_comp = np.all(spk_npy == spk_npy[0, 0]), spk_npy
-            assert all_comp
+            with precision_autocast(precision, cuda):
+                y, hid_state, out_state = model(lab_b, hid_state, 
+                                                out_state, 
+                                                speaker_idx=spk_b)
             if isinstance(y, dict):
                 # we have a MO model, pick the right spk
                 # print('Extracting y prediction for MO spk ', spk_name)
@@ -736,85 +1033,52 @@ def eval_aco_epoch(model, dloader, epoch_idx, cuda=False,
                 del spk2out_states[spk_name]
             #print('y size: ', y.size())
             #print('aco_b size: ', aco_b.size())
-            #print('len(curr_ph_b)= ', len(curr_ph_b))
-            preds, gtruths, \
-            spks, sil_mask = predict_masked_mcd(y, aco_b, slen_b, 
-                                                spk_b, curr_ph_b,
-                                                preds, gtruths,
-                                                spks, sil_mask,
-                                                sil_id)
-        print('After batch preds shape: ', preds.shape)
-        print('After batch gtruths shape: ', gtruths.shape)
-        print('After batch sil_mask shape: ', sil_mask.shape)
-        print('After batch spks shape: ', spks.shape)
-        print('Sil mask mean: ', sil_mask.mean())
-        # denorm with normalization stats
-        assert spk2acostats is not None
-        preds, gtruths = denorm_aco_preds_gtruth(preds, gtruths,
-                                                 spks, spk2acostats)
-        aco_mcd = mcd(preds[:,:40], gtruths[:,:40], spks, idx2spk)
-        print('U/V preds min: ', preds[:, -1].min())
-        print('U/V preds max: ', preds[:, -1].max())
-        print('U/V preds mean: ', preds[:, -1].mean())
-        print('U/V gtruth min: ', gtruths[:, -1].min())
-        print('U/V gtruth max: ', gtruths[:, -1].max())
-        print('U/V gtruth mean: ', gtruths[:, -1].mean())
-        #print('preds shape: ', preds.shape)
-        #print('gtruths shape: ', gtruths.shape)
-        aco_afpr = afpr(np.round(preds[:,-1]).reshape(-1, 1),
-                        gtruths[:,-1].reshape(-1, 1), spks, 
-                        idx2spk)
-        aco_f0_rmse, aco_f0_spk = rmse(np.exp(preds[:, -2]), 
-                                       np.exp(gtruths[:, -2]),
-                                       spks, idx2spk)
-        #print('Evaluated aco F0 mRMSE [Hz]: {:.2f}'.format(aco_f0_rmse))
-        masked_f0_preds = np.exp(preds[:, -2]).reshape(-1, 1) * sil_mask
-        masked_f0_gtruths = np.exp(gtruths[:, -2]).reshape(-1, 1) * sil_mask
-        write_histogram_log(np.exp(preds[:, -2]),
-                            'F0 predictions',
-                            epoch_idx, log_writer)
-        write_histogram_log(np.exp(gtruths[:, -2]),
-                            'F0 groundtruth',
-                            epoch_idx, log_writer)
+            # metrics in float32
+            metrics.update(y.float(), aco_b, slen_b, spk_b, sil_b)
+        print('Evaluated frames: ', metrics.num_frames)
+        print('Non-silence frames ratio: ', metrics.nosil_ratio())
+        aco_mcd = metrics.mcd()
+        nosil_aco_mcd = metrics.mcd(nosil=True)
+        aco_afpr = metrics.afpr()
+        nosil_aco_afpr = metrics.afpr(nosil=True)
+        aco_f0_rmse, aco_f0_spk = metrics.f0_rmse()
         nosil_aco_f0_rmse, \
-        nosil_aco_f0_spk = rmse(masked_f0_preds,
-                                masked_f0_gtruths,
-                                spks, idx2spk)
-        write_histogram_log(preds[:, :40],
-                            'MFCC predictions',
-                            epoch_idx, log_writer)
-        write_histogram_log(gtruths[:, :40],
-                            'MFCC groundtruth',
-                            epoch_idx, log_writer)
-        masked_cc_preds = preds[:, :40] * sil_mask
-        masked_cc_gtruths = gtruths[:, :40] * sil_mask
-        nosil_aco_mcd = mcd(masked_cc_preds, masked_cc_gtruths,
-                            spks, idx2spk)
-        write_histogram_log(preds[:, -1],
-                            'U/V predictions',
-                            epoch_idx, log_writer)
-        write_histogram_log(gtruths[:, -1],
-                            'U/V groundtruth',
-                            epoch_idx, log_writer)
-        masked_uv_preds = np.round(preds[:, -1]).reshape(-1, 1) * sil_mask
-        masked_uv_gtruths = gtruths[:, -1].reshape(-1, 1) * sil_mask
-        write_histogram_log(preds[:, -3],
-                            'FV predictions',
-                            epoch_idx, log_writer)
-        write_histogram_log(gtruths[:, -3],
-                            'FV groundtruth',
-                            epoch_idx, log_writer)
-        #print('masked_uv_preds shape: ', masked_uv_preds.shape)
-        #print('masked_uv_gtruths shape: ', masked_uv_gtruths.shape)
-        nosil_aco_afpr = afpr(masked_uv_preds, masked_uv_gtruths,
-                              spks, idx2spk)
+        nosil_aco_f0_spk = metrics.f0_rmse(nosil=True)
+        hist = metrics.hist_sample()
+        if hist is not None:
+            # sampled de-normalized frames: predictions | groundtruths
+            preds, gtruths = np.split(hist, 2, axis=1)
+            write_histogram_log(np.exp(preds[:, -2]),
+                                'F0 predictions',
+                                epoch_idx, log_writer)
+            write_histogram_log(np.exp(gtruths[:, -2]),
+                                'F0 groundtruth',
+                                epoch_idx, log_writer)
+            write_histogram_log(preds[:, :40],
+                                'MFCC predictions',
+                                epoch_idx, log_writer)
+            write_histogram_log(gtruths[:, :40],
+                                'MFCC groundtruth',
+                                epoch_idx, log_writer)
+            write_histogram_log(preds[:, -1],
+                                'U/V predictions',
+                                epoch_idx, log_writer)
+            write_histogram_log(gtruths[:, -1],
+                                'U/V groundtruth',
+                                epoch_idx, log_writer)
+            write_histogram_log(preds[:, -3],
+                                'FV predictions',
+                                epoch_idx, log_writer)
+            write_histogram_log(gtruths[:, -3],
+                                'FV groundtruth',
+                                epoch_idx, log_writer)
 
         #print('Evaluated aco MCD [dB]: {:.3f}'.format(aco_mcd['total']))
         print('========= F0 RMSE =========')
         print('Evaluated aco W/O sil phones ({}) F0 mRMSE [Hz]:'
               '{:.2f}'.format(sil_id, nosil_aco_f0_rmse))
         write_scalar_log(nosil_aco_f0_rmse, 
-                         'total_no-silence_F0_rmse_Hz',
+                               'total_no-silence_F0_rmse_Hz',
                          epoch_idx, log_writer)
         print('Evaluated aco F0 mRMSE of spks: '
               '{}'.format(json.dumps(nosil_aco_f0_spk,
@@ -827,7 +1091,7 @@ def eval_aco_epoch(model, dloader, epoch_idx, cuda=False,
         print('Evaluated aco W/O sil phones ({}) MCD [dB]:'
               '{:.3f}'.format(sil_id, nosil_aco_mcd['total']))
         write_scalar_log(nosil_aco_mcd['total'],
-                         'total_MCD_dB',
+                               'total_MCD_dB',
                          epoch_idx, log_writer)
         #print('Evaluated w/ sil MCD of spks: {}'.format(json.dumps(aco_mcd,
         #                                                           indent=2)))
@@ -863,6 +1127,8 @@ def eval_aco_epoch(model, dloader, epoch_idx, cuda=False,
         # WRITE AUDIO TO TBOARD if possible
         if log_writer is not None:
             tfl = tempfile.NamedTemporaryFile()
+            # first eval sequences, in order
+            preds = metrics.audio_preds()
             cc = preds[:, :40]
             fv = preds[:, -3]
             lf0 = preds[:, -2]
@@ -938,6 +1204,10 @@ def eval_dur_epoch(model, dloader, epoch_idx, cuda=False,
         idx2spk = None
         if 'idx2spk' in va_opts:
             idx2spk = va_opts.pop('idx2spk')
+        # precision of the forward passes (fp32 or bf16 autocast)
+        precision = 'fp32'
+        if 'precision' in va_opts:
+            precision = va_opts.pop('precision')
         if 'mulout' in va_opts:
             print('Multi-Output dur evaluation')
             mulout = va_opts.pop('mulout')
@@ -947,24 +1217,26 @@ def eval_dur_epoch(model, dloader, epoch_idx, cuda=False,
         assert len(va_opts) == 0, 'unrecognized params passed in: '\
                                   '{}'.format(va_opts.keys())
         spk2durstats=stats
-        preds = None
-        gtruths = None
-        seqlens = None
-        spks = None
-        # make the silence mask
-        sil_mask = None
+        assert spk2durstats is not None
+        # masked metric sums are accumulated in the device, frames are
+        # only sampled for the histograms when logging
+        hist_frames = 0
+        if log_writer is not None:
+            hist_frames = 20000
+        metrics = DurMetricAccumulator(spk2durstats, idx2spk,
+                                       q_classes=q_classes,
+                                       hist_frames=hist_frames)
         for b_idx, batch in enumerate(dloader):
             # decompose the batch into the sub-batches
-            spk_b, lab_b, dur_b, slen_b, ph_b = batch
-            # build batch of curr_ph to filter out results without sil phones
-            # size of curr_ph_b [bsize, seqlen]
-            curr_ph_b = [[ph[2] for ph in ph_s] for ph_s in ph_b]
-            # convert all into variables and transpose (we want time-major)
-            spk_b = spk_b.transpose(0,1)
-            lab_b = lab_b.transpose(0,1)
-            dur_b = dur_b.transpose(0,1)
+            spk_b, lab_b, dur_b, slen_b, ph_b, sil_b = batch
+            # sil_b [seqlen, bsize] flags the silence frames (filtered out
+            # of the masked metrics)
             # get curr batch size
             curr_bsz = spk_b.size(1)
+            if idx2spk is not None:
+                # batches hold a single speaker, read from the host-side
+                # batch before the device copy
+                spk_name = idx2spk[spk_b[0, 0].item()]
             # init hidden states of dur model
             states = model.init_hidden_state(curr_bsz)
             if cuda:
@@ -974,43 +1246,34 @@ def eval_dur_epoch(model, dloader, epoch_idx, cuda=False,
                 slen_b = var_to_cuda(slen_b)
                 states = var_to_cuda(states)
             # forward through model
-            y, states = model(lab_b, states, speaker_idx=spk_b)
+            with precision_autocast(precision, cuda):
+                y, states = model(lab_b, states, speaker_idx=spk_b)
             if isinstance(y, dict):
                 # we have a MO model, pick the right spk
-                spk_name = idx2spk[spk_b.cpu().data[0,0]]
                 # print('Extracting y prediction for MO spk ', spk_name)
                 y = y[spk_name]
-            y = y.squeeze(-1)
-            preds, gtruths, \
-            spks, sil_mask = predict_masked_rmse(y, dur_b, slen_b, 
-                                                 spk_b, curr_ph_b,
-                                                 preds, gtruths,
-                                                 spks, sil_mask,
-                                                 sil_id,
-                                                 q_classes)
-        # denorm with normalization stats
-        assert spk2durstats is not None
-        preds, gtruths = denorm_dur_preds_gtruth(preds, gtruths,
-                                                 spks, spk2durstats,
-                                                 q_classes)
-        write_histogram_log(preds, 'eval_preds_rmse',
-                            epoch_idx, log_writer)
-        write_histogram_log(gtruths, 'eval_gtruths_rmse',
-                            epoch_idx, log_writer)
-        dur_rmse, spks_rmse = rmse(preds, gtruths, spks)
+            # metrics in float32
+            y = y.squeeze(-1).float()
+            metrics.update(y, dur_b, slen_b, spk_b, sil_b)
+        hist = metrics.hist_sample()
+        if hist is not None:
+            # sampled de-normalized durs: predictions | groundtruths
+            write_histogram_log(hist[:, 0], 'eval_preds_rmse',
+                                epoch_idx, log_writer)
+            write_histogram_log(hist[:, 1], 'eval_gtruths_rmse',
+                                epoch_idx, log_writer)
+        dur_rmse, spks_rmse = metrics.dur_rmse()
         dur_rmse *= 1e3
         for k, v in spks_rmse.items():
             spks_rmse[k] = v * 1e3
         nosil_dur_rmse, \
-        nosil_spks_rmse = rmse(preds * sil_mask, 
-                               gtruths * sil_mask, spks)
+        nosil_spks_rmse = metrics.dur_rmse(nosil=True)
         nosil_dur_rmse *= 1e3
         nosil_spkname_rmse = {}
         for k, v in nosil_spks_rmse.items():
-            #nosil_spks_rmse[k] = v * 1e3
-            nosil_spkname_rmse[idx2spk[int(k)]] = v * 1e3
+            nosil_spkname_rmse[k] = v * 1e3
             write_scalar_log(v * 1e3,
-                             'eval_nosil_{}_rmse'.format(idx2spk[int(k)]),
+                             'eval_nosil_{}_rmse'.format(k),
                              epoch_idx, log_writer)
         #print('Evaluated dur mRMSE [ms]: {:.3f}'.format(dur_rmse))
         print('Evaluated dur w/o sil phones mRMSE [ms]:'
@@ -1020,10 +1283,10 @@ def eval_dur_epoch(model, dloader, epoch_idx, cuda=False,
         nosil_spkname_rmse.update({'eval_total_dur_rmse':dur_rmse,
                                    'eval_total_nosil_dur_rmse':nosil_dur_rmse})
         write_scalar_log(dur_rmse,
-                         'eval_total_dur_rmse',
+                               'eval_total_dur_rmse',
                          epoch_idx, log_writer)
         write_scalar_log(nosil_dur_rmse,
-                         'eval_total_nosil_dur_rmse',
+                               'eval_total_nosil_dur_rmse',
                          epoch_idx, log_writer)
         return nosil_spkname_rmse
 
@@ -1041,37 +1304,81 @@ def train_attaco_epoch(model, dloader, opt, log_freq, epoch_idx,
     idx2spk = None
     if 'idx2spk' in tr_opts:
         idx2spk = tr_opts.pop('idx2spk')
+    # num of batches staged ahead by a background thread
+    prefetch = 0
+    if 'prefetch' in tr_opts:
+        prefetch = tr_opts.pop('prefetch')
+    # precision of the forward passes (fp32 or bf16 autocast)
+    precision = 'fp32'
+    if 'precision' in tr_opts:
+        precision = tr_opts.pop('precision')
     decoder = False
     if 'decoder' in tr_opts:
         decoder = tr_opts.pop('decoder')
+    # train MCD is accumulated every metric_every batches (0 skips it)
+    metric_every = 1
+    if 'metric_every' in tr_opts:
+        metric_every = tr_opts.pop('metric_every')
+    # step_fn(batch, epoch_state) is called after every batch (see
+    # train_engine) and ends the epoch if it returns True, and resume
+    # holds the epoch state to continue from
+    step_fn = None
+    if 'step_fn' in tr_opts:
+        step_fn = tr_opts.pop('step_fn')
+    resume = None
+    if 'resume' in tr_opts:
+        resume = tr_opts.pop('resume')
     assert len(tr_opts) == 0, 'unrecognized params passed in: '\
                               '{}'.format(tr_opts.keys())
     epoch_losses = {}
     num_batches = len(dloader)
     print('num_batches: ', num_batches)
     pe_start_idx = 0
-    for b_idx, batch in enumerate(dloader):
+    # losses and metrics stay in the device until they are logged
+    losses = LossAccumulator()
+    tr_metrics = None
+    if metric_every > 0:
+        assert spk2acostats is not None
+        tr_metrics = AcoMetricAccumulator(spk2acostats)
+    beg_batch = 0
+    resume_rng = None
+    if resume is not None:
+        # continue the epoch right after the snapshot batch
+        beg_batch = resume['batch']
+        # RNG as it was after the snapshot batch, restored once the
+        # skipped batches replayed the loader draws
+        resume_rng = resume['rng']
+        epoch_state = resume['epoch_state']
+        pe_start_idx = epoch_state['pe_start_idx']
+        losses.load_state_dict(epoch_state['losses'])
+        if tr_metrics is not None:
+            tr_metrics.load_state_dict(epoch_state['tr_metrics'])
+        epoch_losses = epoch_state['epoch_losses']
+        global_step += beg_batch
+    # batches come time-major (as collated) and already in the device
+    batches = DevicePrefetcher(dloader, cuda, depth=prefetch,
+                               skip=beg_batch,
+                               rng=resume_rng)
+    for b_idx, batch in enumerate(batches, start=beg_batch):
         # decompose the batch into the sub-batches
-        spk_b, lab_b, aco_b, slen_b, ph_b = batch
-        # build batch of curr_ph to filter out results without sil phones
-        # size of curr_ph_b [bsize, seqlen]
-        curr_ph_b = [[ph[2] for ph in ph_s] for ph_s in ph_b]
-        # transpose (we want time-major)
-        spk_b = spk_b.transpose(0,1)
-        spk_name = idx2spk[spk_b.data[0,0].item()]
-        lab_b = lab_b.transpose(0,1)
-        aco_b = aco_b.transpose(0,1)
+        spk_b, lab_b, aco_b, slen_b, ph_b, sil_b = batch[:6]
+        # sil_b [seqlen, bsize] flags the silence frames (filtered out
+        # of the masked metrics)
+        seg_b = None
+        pos_b = None
+        if len(batch) > 6:
+            # packed rows: segment ids and positions of every frame
+            seg_b, pos_b = batch[6:8]
         aco_p = torch.zeros(1, aco_b.size(1), 
                             aco_b.size(2))
         # get curr batch size
         curr_bsz = spk_b.size(1)
         if cuda:
-            spk_b = var_to_cuda(spk_b)
-            lab_b = var_to_cuda(lab_b)
-            aco_b = var_to_cuda(aco_b)
             aco_p = var_to_cuda(aco_p)
-            slen_b = var_to_cuda(slen_b)
         if decoder:
+            if seg_b is not None:
+                raise NotImplementedError('Packed batches are not supported '
+                                          'by the decoder model.')
             print('WARNING: decsatt aco does not work well yet'
                   ' cause of real valued feedback problems')
             # forward in teacher force mode the feedback
@@ -1079,30 +1386,29 @@ def train_attaco_epoch(model, dloader, opt, log_freq, epoch_idx,
             fb_aco_b = torch.cat((aco_p,
                                   aco_b[:-1, :, :]), dim=0)
             fb_aco_b = None
-            y = model(lab_b, fb_aco_b, speaker_idx=spk_b,
-                      pe_start_idx=pe_start_idx)
+            with precision_autocast(precision, cuda):
+                y = model(lab_b, fb_aco_b, speaker_idx=spk_b,
+                          pe_start_idx=pe_start_idx)
+        elif seg_b is not None:
+            # packed sequences attend within themselves, each one
+            # with positions starting at 0
+            with precision_autocast(precision, cuda):
+                y = model(lab_b, speaker_idx=spk_b, segments=seg_b,
+                          positions=pos_b)
         else:
             # forward through att encoder model
-            y = model(lab_b, speaker_idx=spk_b,
-                      pe_start_idx=pe_start_idx)
-        y = y.squeeze(-1)
-        loss = criterion(y, aco_b)
-        preds = None
-        gtruths = None
-        seqlens = None
-        spks = None
-        # make the silence mask
-        sil_mask = None
-        preds, gtruths, \
-        spks, sil_mask = predict_masked_mcd(y, aco_b, slen_b, 
-                                            spk_b, curr_ph_b,
-                                            preds, gtruths,
-                                            spks, sil_mask,
-                                            'pau')
-        assert spk2acostats is not None
-        preds, gtruths = denorm_aco_preds_gtruth(preds, gtruths,
-                                                 spks, spk2acostats)
-        nosil_aco_mcd = mcd(preds[:,:40] * sil_mask, gtruths[:,:40] * sil_mask)
+            with precision_autocast(precision, cuda):
+                y = model(lab_b, speaker_idx=spk_b,
+                          pe_start_idx=pe_start_idx)
+        # loss and metrics in float32
+        y = y.squeeze(-1).float()
+        # average over the non-padding frames: batch sizes and
+        # padding vary with token budget batching and packing
+        valid_b = frames_mask(slen_b, y.size(0))
+        loss = masked_mean_loss(criterion, y, aco_b, valid_b)
+        losses.add(loss)
+        if tr_metrics is not None and b_idx % metric_every == 0:
+            tr_metrics.update(y.detach(), aco_b, slen_b, spk_b, sil_b)
         opt.zero_grad()
         loss.backward()
         opt.step()
@@ -1111,23 +1417,37 @@ def train_attaco_epoch(model, dloader, opt, log_freq, epoch_idx,
             log_mesg = 'batch {:4d}/{:4d} '.format(b_idx + 1, num_batches) + \
                        '(pe_start_idx: {:5d}) '.format(pe_start_idx) + \
                        '(epoch {:3d})'.format(epoch_idx)
-            log_mesg += ' loss {:.5f}'.format(loss.item())
+            # mean loss since the last log (single sync)
+            tr_loss = losses.means()['tr_loss']
+            nosil_aco_mcd = None
+            if tr_metrics is not None and tr_metrics.num_frames > 0:
+                nosil_aco_mcd = tr_metrics.mcd(nosil=True)['total']
+                tr_metrics.reset()
+            log_mesg += ' loss {:.5f}'.format(tr_loss)
             if nosil_aco_mcd is not None:
                 log_mesg += ', MCD {:.5f} dB'.format(nosil_aco_mcd)
             if 'tr_loss' not in epoch_losses:
                 epoch_losses['tr_loss'] = []
-                if nosil_aco_mcd:
-                    epoch_losses['tr_mcd'] = []
-            epoch_losses['tr_loss'].append(loss.item())
-            write_scalar_log(loss.item(), 'tr_loss',
+            epoch_losses['tr_loss'].append(tr_loss)
+            write_scalar_log(tr_loss, 'tr_loss',
                              global_step, log_writer)
-            if nosil_aco_mcd:
+            if nosil_aco_mcd is not None:
+                if 'tr_mcd' not in epoch_losses:
+                    epoch_losses['tr_mcd'] = []
                 epoch_losses['tr_mcd'].append(nosil_aco_mcd)
                 write_scalar_log(nosil_aco_mcd, 'tr_mcd',
                                  global_step, log_writer)
             print(log_mesg)
         global_step += 1
         pe_start_idx += aco_b.size(0)
+        if step_fn is not None and \
+           step_fn(b_idx + 1, {'pe_start_idx':pe_start_idx,
+                               'losses':losses.state_dict(),
+                               'tr_metrics':None if tr_metrics is None else \
+                                            tr_metrics.state_dict(),
+                               'epoch_losses':epoch_losses}):
+            # out of patience
+            break
     end_log = '-- Finished epoch {:4d}, mean losses:'.format(epoch_idx)
     if isinstance(epoch_losses, dict):
         for k, val in epoch_losses.items():
@@ -1147,37 +1467,34 @@ def eval_attaco_epoch(model, dloader, epoch_idx, cuda=False,
         idx2spk = None
         if 'idx2spk' in va_opts:
             idx2spk = va_opts.pop('idx2spk')
+        # precision of the forward passes (fp32 or bf16 autocast)
+        precision = 'fp32'
+        if 'precision' in va_opts:
+            precision = va_opts.pop('precision')
         decoder = False
         if 'decoder' in va_opts:
             decoder = va_opts.pop('decoder')
         assert len(va_opts) == 0, 'unrecognized params passed in: '\
                                   '{}'.format(va_opts.keys())
         spk2acostats=stats
-        preds = None
-        gtruths = None
-        seqlens = None
-        spks = None
-        # make the silence mask
-        sil_mask = None
-        all_phones = []
+        assert spk2acostats is not None
+        # masked metric sums are accumulated in the device, frames are
+        # only sampled for the histograms and the audio when logging
+        hist_frames = 0
+        audio_frames = 0
+        if log_writer is not None:
+            hist_frames = 20000
+            # 10 s of 5 ms frames
+            audio_frames = 2000
+        metrics = AcoMetricAccumulator(spk2acostats, idx2spk,
+                                       hist_frames=hist_frames,
+                                       audio_frames=audio_frames)
         pe_start_idx = 0
         for b_idx, batch in enumerate(dloader):
             # decompose the batch into the sub-batches
-            spk_b, lab_b, aco_b, slen_b, ph_b = batch
-            # build batch of curr_ph to filter out results without sil phones
-            # size of curr_ph_b [bsize, seqlen]
-            curr_ph_b = []
-            for ph_s in ph_b:
-                phone_seq = []
-                for ph in ph_s:
-                    phone_seq.append(ph[2])
-                    all_phones.append(ph[2])
-                curr_ph_b.append(phone_seq)
-            # transpose (we want time-major)
-            spk_b = spk_b.transpose(0,1)
-            spk_name = idx2spk[spk_b.cpu().data[0,0].item()]
-            lab_b = lab_b.transpose(0,1)
-            aco_b = aco_b.transpose(0,1)
+            spk_b, lab_b, aco_b, slen_b, ph_b, sil_b = batch
+            # sil_b [seqlen, bsize] flags the silence frames (filtered out
+            # of the masked metrics)
             aco_p = torch.zeros(1, aco_b.size(1), 
                                 aco_b.size(2))
             # get curr batch size
@@ -1194,80 +1511,62 @@ def eval_attaco_epoch(model, dloader, epoch_idx, cuda=False,
                 fb_aco_b = torch.cat((aco_p,
                                       aco_b[:-1, :, :]), dim=0)
                 fb_aco_b = None
-                y = model(lab_b, fb_aco_b, speaker_idx=spk_b,
-                          pe_start_idx=pe_start_idx)
+                with precision_autocast(precision, cuda):
+                    y = model(lab_b, fb_aco_b, speaker_idx=spk_b,
+                              pe_start_idx=pe_start_idx)
             else:
                 # forward through att encoder model
-                y = model(lab_b, speaker_idx=spk_b,
-                          pe_start_idx=pe_start_idx)
+                with precision_autocast(precision, cuda):
+                    y = model(lab_b, speaker_idx=spk_b,
+                              pe_start_idx=pe_start_idx)
             if not reset_batch_state:
                 pe_start_idx += aco_b.size(0)
-            y = y.cpu()
-            spk_npy = spk_b.cpu().data.numpy()
-            all_comp = np.all(spk_npy == spk_npy[0, 0]), spk_npy
-            assert all_comp
-            preds, gtruths, \
-            spks, sil_mask = predict_masked_mcd(y, aco_b, slen_b, 
-                                                spk_b, curr_ph_b,
-                                                preds, gtruths,
-                                                spks, sil_mask,
-                                                sil_id)
-        # denorm with normalization stats
-        assert spk2acostats is not None
-        preds, gtruths = denorm_aco_preds_gtruth(preds, gtruths,
-                                                 spks, spk2acostats)
-        aco_mcd = mcd(preds[:,:40], gtruths[:,:40], spks, idx2spk)
-        aco_afpr = afpr(np.round(preds[:,-1]).reshape(-1, 1),
-                        gtruths[:,-1].reshape(-1, 1), spks, 
-                        idx2spk)
-        aco_f0_rmse, aco_f0_spk = rmse(np.exp(preds[:, -2]), 
-                                       np.exp(gtruths[:, -2]),
-                                       spks, idx2spk)
-        masked_f0_preds = np.exp(preds[:, -2]).reshape(-1, 1) * sil_mask
-        masked_f0_gtruths = np.exp(gtruths[:, -2]).reshape(-1, 1) * sil_mask
-        write_histogram_log(np.exp(preds[:, -2]),
-                            'F0 predictions',
-                            epoch_idx, log_writer)
-        write_histogram_log(np.exp(gtruths[:, -2]),
-                            'F0 groundtruth',
-                            epoch_idx, log_writer)
+            # metrics in float32
+            metrics.update(y.float(), aco_b, slen_b, spk_b, sil_b)
+        print('Evaluated frames: ', metrics.num_frames)
+        print('Non-silence frames ratio: ', metrics.nosil_ratio())
+        aco_mcd = metrics.mcd()
+        nosil_aco_mcd = metrics.mcd(nosil=True)
+        aco_afpr = metrics.afpr()
+        nosil_aco_afpr = metrics.afpr(nosil=True)
+        aco_f0_rmse, aco_f0_spk = metrics.f0_rmse()
         nosil_aco_f0_rmse, \
-        nosil_aco_f0_spk = rmse(masked_f0_preds,
-                                masked_f0_gtruths,
-                                spks, idx2spk)
-        write_histogram_log(preds[:, :40],
-                            'MFCC predictions',
-                            epoch_idx, log_writer)
-        write_histogram_log(gtruths[:, :40],
-                            'MFCC groundtruth',
-                            epoch_idx, log_writer)
-        masked_cc_preds = preds[:, :40] * sil_mask
-        masked_cc_gtruths = gtruths[:, :40] * sil_mask
-        nosil_aco_mcd = mcd(masked_cc_preds, masked_cc_gtruths,
-                            spks, idx2spk)
-        write_histogram_log(preds[:, -1],
-                            'U/V predictions',
-                            epoch_idx, log_writer)
-        write_histogram_log(gtruths[:, -1],
-                            'U/V groundtruth',
-                            epoch_idx, log_writer)
-        masked_uv_preds = np.round(preds[:, -1]).reshape(-1, 1) * sil_mask
-        masked_uv_gtruths = gtruths[:, -1].reshape(-1, 1) * sil_mask
-        write_histogram_log(preds[:, -3],
-                            'FV predictions',
-                            epoch_idx, log_writer)
-        write_histogram_log(gtruths[:, -3],
-                            'FV groundtruth',
-                            epoch_idx, log_writer)
-        nosil_aco_afpr = afpr(masked_uv_preds, masked_uv_gtruths,
-                              spks, idx2spk)
+        nosil_aco_f0_spk = metrics.f0_rmse(nosil=True)
+        hist = metrics.hist_sample()
+        if hist is not None:
+            # sampled de-normalized frames: predictions | groundtruths
+            preds, gtruths = np.split(hist, 2, axis=1)
+            write_histogram_log(np.exp(preds[:, -2]),
+                                'F0 predictions',
+                                epoch_idx, log_writer)
+            write_histogram_log(np.exp(gtruths[:, -2]),
+                                'F0 groundtruth',
+                                epoch_idx, log_writer)
+            write_histogram_log(preds[:, :40],
+                                'MFCC predictions',
+                                epoch_idx, log_writer)
+            write_histogram_log(gtruths[:, :40],
+                                'MFCC groundtruth',
+                                epoch_idx, log_writer)
+            write_histogram_log(preds[:, -1],
+                                'U/V predictions',
+                                epoch_idx, log_writer)
+            write_histogram_log(gtruths[:, -1],
+                                'U/V groundtruth',
+                                epoch_idx, log_writer)
+            write_histogram_log(preds[:, -3],
+                                'FV predictions',
+                                epoch_idx, log_writer)
+            write_histogram_log(gtruths[:, -3],
+                                'FV groundtruth',
+                                epoch_idx, log_writer)
 
         #print('Evaluated aco MCD [dB]: {:.3f}'.format(aco_mcd['total']))
         print('========= F0 RMSE =========')
         print('Evaluated aco W/O sil phones ({}) F0 mRMSE [Hz]:'
               '{:.2f}'.format(sil_id, nosil_aco_f0_rmse))
         write_scalar_log(nosil_aco_f0_rmse, 
-                         'total_no-silence_F0_rmse_Hz',
+                               'total_no-silence_F0_rmse_Hz',
                          epoch_idx, log_writer)
         print('Evaluated aco F0 mRMSE of spks: '
               '{}'.format(json.dumps(nosil_aco_f0_spk,
@@ -1280,7 +1579,7 @@ def eval_attaco_epoch(model, dloader, epoch_idx, cuda=False,
         print('Evaluated aco W/O sil phones ({}) MCD [dB]:'
               '{:.3f}'.format(sil_id, nosil_aco_mcd['total']))
         write_scalar_log(nosil_aco_mcd['total'],
-                         'total_MCD_dB',
+                               'total_MCD_dB',
                          epoch_idx, log_writer)
         #print('Evaluated w/ sil MCD of spks: {}'.format(json.dumps(aco_mcd,
         #                                                           indent=2)))
@@ -1316,6 +1615,8 @@ def eval_attaco_epoch(model, dloader, epoch_idx, cuda=False,
         # WRITE AUDIO TO TBOARD 
         if log_writer is not None:
             tfl = tempfile.NamedTemporaryFile()
+            # first eval sequences, in order
+            preds = metrics.audio_preds()
             cc = preds[:, :40]
             fv = preds[:, -3]
             lf0 = preds[:, -2]
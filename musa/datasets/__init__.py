@@ -3,7 +3,12 @@ from .tcstar import TCSTAR_dur, TCSTAR_aco
 #from .tcstar import varlen_aco_collate
 from .vctk import VCTK
 from .sampler import MOSampler
+from .sampler import BucketBatchSampler
+from .sampler import StatefulSampler
+from .sampler import TokenBudgetBatchSampler
 from .collaters import Aco2Id_Collater
 from .collaters import varlen_dur_collate
 from .collaters import varlen_aco_collate
+from .collaters import VarlenCollater
+from .collaters import PackingCollater
 from .utils import *
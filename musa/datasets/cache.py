@@ -0,0 +1,81 @@
+import hashlib
+import pickle
+import shutil
+import os
+import numpy as np
+
+
+def file_manifest(paths):
+    """ List (path, size, mtime) of every input file, in order.
+        Missing files are listed with size and mtime set to -1.
+    """
+    manifest = []
+    for path in paths:
+        try:
+            fstat = os.stat(path)
+            manifest.append((path, fstat.st_size, fstat.st_mtime_ns))
+        except OSError:
+            manifest.append((path, -1, -1))
+    return manifest
+
+def file_digest(path):
+    """ sha1 of a file contents (None if it does not exist) """
+    if not os.path.exists(path):
+        return None
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def cache_key(params, manifest):
+    """ Hash the build params (a picklable structure) and the
+        input files manifest into the cache entry name.
+    """
+    sha = hashlib.sha1()
+    sha.update(pickle.dumps(params, protocol=2))
+    for path, size, mtime in manifest:
+        sha.update('{}:{}:{}\n'.format(path, size, mtime).encode('utf-8'))
+    return sha.hexdigest()
+
+def save_dataset_cache(cache_dir, key, arrays, meta):
+    """ Store the arrays (one .npy each) and the meta dict (pickle)
+        of a built dataset under cache_dir/key. The entry is written
+        to a temporary dir first and renamed, so that a broken
+        build never leaves a readable entry behind.
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    if os.path.exists(entry_dir):
+        return entry_dir
+    tmp_dir = '{}.tmp{}'.format(entry_dir, os.getpid())
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for name, arr in arrays.items():
+        np.save(os.path.join(tmp_dir, name + '.npy'), arr)
+    with open(os.path.join(tmp_dir, 'meta.pkl'), 'wb') as meta_f:
+        pickle.dump({'arrays':list(arrays.keys()),
+                     'meta':meta}, meta_f)
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # another process stored the same entry meanwhile
+        shutil.rmtree(tmp_dir)
+    return entry_dir
+
+def load_dataset_cache(cache_dir, key, mmap_mode='r'):
+    """ Load a cached dataset entry as (arrays, meta), or None if
+        the key is not in the cache. Arrays are memory-mapped
+        by default, so loading is independent of the dataset size.
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    meta_file = os.path.join(entry_dir, 'meta.pkl')
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file, 'rb') as meta_f:
+        entry = pickle.load(meta_f)
+    arrays = {}
+    for name in entry['arrays']:
+        arrays[name] = np.load(os.path.join(entry_dir, name + '.npy'),
+                               mmap_mode=mmap_mode)
+    return arrays, entry['meta']
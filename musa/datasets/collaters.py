@@ -1,7 +1,62 @@
+from .storage import FrameWindow, decode_frames
+from torch.utils.data import get_worker_info
 import numpy as np
 import torch
 
 
+# All the collate functions of sequences return time-major (T, B, ...)
+# contiguous tensors (seqlens are (B,)): the layout taken by the models
+# and the metrics, so batches are never transposed on the way.
+
+def pad_phone_batch(ph_batch, max_seq_len, phs=None, sils=None):
+    """ Pad the (ph_ids, sil_flags) arrays of the samples into (T, B)
+        phone ids and silence mask (padding is neither silence nor
+        any phone: it is trimmed out by the seqlens)
+    """
+    if phs is None:
+        phs = np.zeros((max_seq_len, len(ph_batch)), dtype=np.int64)
+    if sils is None:
+        sils = np.zeros((max_seq_len, len(ph_batch)), dtype=np.bool_)
+    for ith, (ph_ids, sil_flags) in enumerate(ph_batch):
+        seq_len = len(ph_ids)
+        phs[:seq_len, ith] = ph_ids
+        phs[seq_len:, ith] = 0
+        sils[:seq_len, ith] = sil_flags
+        sils[seq_len:, ith] = False
+    return phs, sils
+
+def varlen_window_collate(batch, ph_batch):
+    """ Variable length collate of FrameWindow samples: windows are
+        copied (decoded and upcasted to float32 if compact) straight
+        into the padded batch
+    """
+    max_seq_len = max(len(win) for win in batch)
+    spks = np.zeros((max_seq_len, len(batch)), dtype=np.int64)
+    in_dim = batch[0].in_frames.shape[1]
+    labs = np.zeros((max_seq_len, len(batch), in_dim), dtype=np.float32)
+    out_0 = batch[0].out_frames
+    if isinstance(out_0, np.ndarray) and out_0.dtype == np.int64:
+        outs = np.zeros((max_seq_len, len(batch)) + out_0.shape[1:],
+                        dtype=np.int64)
+    else:
+        outs = np.zeros((max_seq_len, len(batch)) + out_0.shape[1:],
+                        dtype=np.float32)
+    seqlens = np.zeros((len(batch),), dtype=np.int32)
+    for ith, win in enumerate(batch):
+        # padding left-side (past)
+        spks[:len(win), ith] = win.spk_idx
+        decode_frames(win.in_frames, labs[:len(win), ith])
+        decode_frames(win.out_frames, outs[:len(win), ith])
+        seqlens[ith] = len(win)
+    # compose tensors batching sequences
+    spks = torch.from_numpy(spks)
+    labs = torch.from_numpy(labs)
+    outs = torch.from_numpy(outs)
+    seqlens = torch.from_numpy(seqlens)
+    phs, sils = pad_phone_batch(ph_batch, max_seq_len)
+    return spks, labs, outs, seqlens, torch.from_numpy(phs), \
+           torch.from_numpy(sils)
+
 def varlen_dur_collate(batch):
     """ Variable length dur collate function,
         compose the batch of sequences (lab, dur) 
@@ -9,6 +64,8 @@ def varlen_dur_collate(batch):
     """
     ph_batch = [b[1] for b in batch]
     batch = [b[0] for b in batch]
+    if isinstance(batch[0], FrameWindow):
+        return varlen_window_collate(batch, ph_batch)
     # traverse the batch looking for the longest seq 
     max_seq_len = 0
     for seq in batch:
@@ -16,17 +73,17 @@ def varlen_dur_collate(batch):
             max_seq_len = len(seq)
     # build the batches of spk_idx, labs and durs
     # each sample in batch is a sequence!
-    spks = np.zeros((len(batch), max_seq_len), dtype=np.int64)
+    spks = np.zeros((max_seq_len, len(batch)), dtype=np.int64)
     #print('#batch[0][0][2] type: ', type(batch[0][0][2]))
     #print('np array dtype: ', batch[0][0][2].dtype)
     if batch[0][0][2].dtype == np.int64:
         #print('int64')
-        durs = np.zeros((len(batch), max_seq_len), dtype=np.int64)
+        durs = np.zeros((max_seq_len, len(batch)), dtype=np.int64)
     else:
     #    print('float32')
-        durs = np.zeros((len(batch), max_seq_len), dtype=np.float32)
+        durs = np.zeros((max_seq_len, len(batch)), dtype=np.float32)
     lab_len = len(batch[0][0][1])
-    labs = np.zeros((len(batch), max_seq_len, lab_len), dtype=np.float32)
+    labs = np.zeros((max_seq_len, len(batch), lab_len), dtype=np.float32)
     # store each sequence length
     seqlens = np.zeros((len(batch),), dtype=np.int32)
     for ith, seq in enumerate(batch):
@@ -38,16 +95,18 @@ def varlen_dur_collate(batch):
             dur_seq.append(dur)
             lab_seq.append(lab)
         # padding left-side (past)
-        spks[ith, :len(spk_seq)] = spk_seq
-        labs[ith, :len(lab_seq)] = lab_seq
-        durs[ith, :len(dur_seq)] = dur_seq
+        spks[:len(spk_seq), ith] = spk_seq
+        labs[:len(lab_seq), ith] = lab_seq
+        durs[:len(dur_seq), ith] = dur_seq
         seqlens[ith] = len(spk_seq)
     # compose tensors batching sequences
     spks = torch.from_numpy(spks)
     labs = torch.from_numpy(labs)
     durs = torch.from_numpy(durs)
     seqlens = torch.from_numpy(seqlens)
-    return spks, labs, durs, seqlens, ph_batch
+    phs, sils = pad_phone_batch(ph_batch, max_seq_len)
+    return spks, labs, durs, seqlens, torch.from_numpy(phs), \
+           torch.from_numpy(sils)
 
 def varlen_aco_collate(batch):
     """ Variable length aco collate function,
@@ -60,6 +119,8 @@ def varlen_aco_collate(batch):
         lab_batch = None
     ph_batch = [b[1] for b in batch]
     batch = [b[0] for b in batch]
+    if isinstance(batch[0], FrameWindow):
+        return varlen_window_collate(batch, ph_batch)
     # traverse the batch looking for the longest seq 
     max_seq_len = 0
     for seq in batch:
@@ -67,17 +128,17 @@ def varlen_aco_collate(batch):
             max_seq_len = len(seq)
     # build the batches of spk_idx, labs+durs and acos
     # each sample in batch is a sequence!
-    spks = np.zeros((len(batch), max_seq_len), dtype=np.int64)
+    spks = np.zeros((max_seq_len, len(batch)), dtype=np.int64)
     #print('np array dtype: ', batch[0][0][2].dtype)
     aco_dim = len(batch[0][0][2])
     if batch[0][0][2].dtype == np.int64:
         #print('int64')
-        acos = np.zeros((len(batch), max_seq_len, aco_dim), dtype=np.int64)
+        acos = np.zeros((max_seq_len, len(batch), aco_dim), dtype=np.int64)
     else:
     #    print('float32')
-        acos = np.zeros((len(batch), max_seq_len, aco_dim), dtype=np.float32)
+        acos = np.zeros((max_seq_len, len(batch), aco_dim), dtype=np.float32)
     lab_len = len(batch[0][0][1])
-    labs = np.zeros((len(batch), max_seq_len, lab_len), dtype=np.float32)
+    labs = np.zeros((max_seq_len, len(batch), lab_len), dtype=np.float32)
     # store each sequence length
     seqlens = np.zeros((len(batch),), dtype=np.int32)
     for ith, seq in enumerate(batch):
@@ -89,16 +150,189 @@ def varlen_aco_collate(batch):
             aco_seq.append(aco)
             lab_seq.append(lab)
         # padding left-side (past)
-        spks[ith, :len(spk_seq)] = spk_seq
-        labs[ith, :len(lab_seq)] = lab_seq
-        acos[ith, :len(aco_seq)] = aco_seq
+        spks[:len(spk_seq), ith] = spk_seq
+        labs[:len(lab_seq), ith] = lab_seq
+        acos[:len(aco_seq), ith] = aco_seq
         seqlens[ith] = len(spk_seq)
     # compose tensors batching sequences
     spks = torch.from_numpy(spks)
     labs = torch.from_numpy(labs)
     acos = torch.from_numpy(acos)
     seqlens = torch.from_numpy(seqlens)
-    return spks, labs, acos, seqlens, ph_batch
+    phs, sils = pad_phone_batch(ph_batch, max_seq_len)
+    return spks, labs, acos, seqlens, torch.from_numpy(phs), \
+           torch.from_numpy(sils)
+
+class VarlenCollater(object):
+    """ Variable length collate of FrameWindow samples (datasets built
+        with return_arrays or compact storage), for either (lab, dur)
+        or (lab+dur, aco) sequences. Padding is the same as in
+        varlen_dur_collate and varlen_aco_collate, but every sample is
+        copied with one slice assignment into preallocated buffers
+        that are reused across batches.
+
+        # Arguments
+            num_buffers: size of the ring of buffers. The returned
+                         tensors share memory with the buffers, so a
+                         batch is overwritten num_buffers calls later.
+                         Inside loader workers, batches are moved to
+                         shared memory when sent, so buffers are not
+                         reused there.
+            pin_memory: allocate the buffers in page-locked memory
+                        (useful when collating in the main process).
+    """
+
+    def __init__(self, num_buffers=2, pin_memory=False):
+        self.buffers = [{} for _ in range(num_buffers)]
+        self.buf_idx = 0
+        self.pin_memory = pin_memory
+
+    def get_buffer(self, buffers, name, shape, dtype):
+        """ Contiguous tensor view of the named buffer, grown if needed """
+        size = int(np.prod(shape))
+        buf = buffers.get(name)
+        if buf is None or buf.numel() < size or buf.dtype != dtype:
+            buf = torch.empty(max(size, 1), dtype=dtype,
+                              pin_memory=self.pin_memory)
+            buffers[name] = buf
+        return buf[:size].view(*shape)
+
+    def __call__(self, batch):
+        ph_batch = [b[1] for b in batch]
+        batch = [b[0] for b in batch]
+        if not isinstance(batch[0], FrameWindow):
+            raise TypeError('VarlenCollater requires FrameWindow samples: '
+                            'build the dataset with return_arrays=True.')
+        if get_worker_info() is not None:
+            buffers = {}
+        else:
+            buffers = self.buffers[self.buf_idx]
+            self.buf_idx = (self.buf_idx + 1) % len(self.buffers)
+        max_seq_len = max(len(win) for win in batch)
+        num_seqs = len(batch)
+        in_dim = batch[0].in_frames.shape[1]
+        out_0 = batch[0].out_frames
+        if isinstance(out_0, np.ndarray) and out_0.dtype == np.int64:
+            out_dtype = torch.int64
+        else:
+            out_dtype = torch.float32
+        spks = self.get_buffer(buffers, 'spks', (max_seq_len, num_seqs),
+                               torch.int64)
+        labs = self.get_buffer(buffers, 'labs',
+                               (max_seq_len, num_seqs, in_dim),
+                               torch.float32)
+        outs = self.get_buffer(buffers, 'outs',
+                               (max_seq_len, num_seqs) + out_0.shape[1:],
+                               out_dtype)
+        seqlens = self.get_buffer(buffers, 'seqlens', (num_seqs,),
+                                  torch.int32)
+        phs = self.get_buffer(buffers, 'phs', (max_seq_len, num_seqs),
+                              torch.int64)
+        sils = self.get_buffer(buffers, 'sils', (max_seq_len, num_seqs),
+                               torch.bool)
+        # fill through numpy views of the buffers
+        spks_np = spks.numpy()
+        labs_np = labs.numpy()
+        outs_np = outs.numpy()
+        seqlens_np = seqlens.numpy()
+        for ith, win in enumerate(batch):
+            seq_len = len(win)
+            # padding left-side (past)
+            spks_np[:seq_len, ith] = win.spk_idx
+            spks_np[seq_len:, ith] = 0
+            decode_frames(win.in_frames, labs_np[:seq_len, ith])
+            labs_np[seq_len:, ith] = 0
+            decode_frames(win.out_frames, outs_np[:seq_len, ith])
+            outs_np[seq_len:, ith] = 0
+            seqlens_np[ith] = seq_len
+        pad_phone_batch(ph_batch, max_seq_len, phs.numpy(), sils.numpy())
+        return spks, labs, outs, seqlens, phs, sils
+
+class PackingCollater(object):
+    """ Collate that packs the batch sequences (FrameWindow samples or
+        lists of (spk_idx, in, out) frames) one after the other into
+        rows of pack_len frames, placing the longest first in the
+        first row with room for it, so that only the tail of each row
+        is padding. The number of rows varies from batch to batch.
+
+        Returns the (spks, labs, outs, seqlens, phs, sils) of the rows
+        (seqlens counting the packed frames of every row) plus:
+            segs: (pack_len, R) int64 idx of the packed sequence of
+                  every frame, starting at 1 (0 for padding).
+            pos: (pack_len, R) int64 position of every frame within its
+                 packed sequence.
+    """
+
+    def __init__(self, pack_len):
+        self.pack_len = pack_len
+
+    def pack(self, lens):
+        """ First-fit decreasing packing of the lens into rows """
+        rows = []
+        room = []
+        for idx in np.argsort(lens, kind='stable')[::-1]:
+            seq_len = lens[idx]
+            if seq_len > self.pack_len:
+                raise ValueError('Cannot pack a sequence of {} frames in '
+                                 'rows of {}: use max_seq_len <= '
+                                 'pack_len.'.format(seq_len, self.pack_len))
+            for row_i in range(len(rows)):
+                if room[row_i] >= seq_len:
+                    rows[row_i].append(idx)
+                    room[row_i] -= seq_len
+                    break
+            else:
+                rows.append([idx])
+                room.append(self.pack_len - seq_len)
+        return rows
+
+    def seq_arrays(self, seq):
+        """ spk_idx, in and out frames of a sample """
+        if isinstance(seq, FrameWindow):
+            return seq.spk_idx, decode_frames(seq.in_frames), \
+                   decode_frames(seq.out_frames)
+        return seq[0][0], np.array([frame[1] for frame in seq]), \
+               np.array([frame[2] for frame in seq])
+
+    def __call__(self, batch):
+        ph_batch = [b[1] for b in batch]
+        batch = [self.seq_arrays(b[0]) for b in batch]
+        rows = self.pack(np.array([len(seq[1]) for seq in batch]))
+        num_rows = len(rows)
+        in_dim = batch[0][1].shape[1]
+        out_0 = batch[0][2]
+        if out_0.dtype == np.int64:
+            out_dtype = np.int64
+        else:
+            out_dtype = np.float32
+        spks = np.zeros((self.pack_len, num_rows), dtype=np.int64)
+        labs = np.zeros((self.pack_len, num_rows, in_dim), dtype=np.float32)
+        outs = np.zeros((self.pack_len, num_rows) + out_0.shape[1:],
+                        dtype=out_dtype)
+        seqlens = np.zeros((num_rows,), dtype=np.int32)
+        phs = np.zeros((self.pack_len, num_rows), dtype=np.int64)
+        sils = np.zeros((self.pack_len, num_rows), dtype=np.bool_)
+        segs = np.zeros((self.pack_len, num_rows), dtype=np.int64)
+        pos = np.zeros((self.pack_len, num_rows), dtype=np.int64)
+        for row_i, row in enumerate(rows):
+            beg = 0
+            for seg_i, idx in enumerate(row, start=1):
+                spk_idx, in_frames, out_frames = batch[idx]
+                ph_ids, sil_flags = ph_batch[idx]
+                end = beg + len(in_frames)
+                spks[beg:end, row_i] = spk_idx
+                labs[beg:end, row_i] = in_frames
+                outs[beg:end, row_i] = out_frames
+                phs[beg:end, row_i] = ph_ids
+                sils[beg:end, row_i] = sil_flags
+                segs[beg:end, row_i] = seg_i
+                pos[beg:end, row_i] = np.arange(end - beg)
+                beg = end
+            seqlens[row_i] = beg
+        return torch.from_numpy(spks), torch.from_numpy(labs), \
+               torch.from_numpy(outs), torch.from_numpy(seqlens), \
+               torch.from_numpy(phs), torch.from_numpy(sils), \
+               torch.from_numpy(segs), torch.from_numpy(pos)
 
 class Aco2Id_Collater(object):
 
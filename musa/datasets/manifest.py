@@ -0,0 +1,64 @@
+import hashlib
+import pickle
+import os
+from .cache import file_digest
+
+
+class FileManifest(object):
+    """ Keeps the (size, mtime, sha1) of the input files and, for every
+        derived artifact (parsed utterances, speaker stats, codebooks...),
+        the digest of the inputs it was built from.
+
+        A file is only re-hashed when its size or mtime changed, so
+        touching a file without modifying it does not invalidate the
+        artifacts built out of it.
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.files = {}
+        self.artifacts = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'rb') as man_f:
+                manifest = pickle.load(man_f)
+                self.files = manifest['files']
+                self.artifacts = manifest['artifacts']
+
+    def digest(self, path):
+        """ sha1 of an input file (None if it does not exist) """
+        path = os.path.abspath(path)
+        try:
+            fstat = os.stat(path)
+        except OSError:
+            return None
+        record = self.files.get(path)
+        if record is not None and record[0] == fstat.st_size and \
+           record[1] == fstat.st_mtime_ns:
+            return record[2]
+        sha = file_digest(path)
+        self.files[path] = (fstat.st_size, fstat.st_mtime_ns, sha)
+        return sha
+
+    def inputs_digest(self, paths):
+        sha = hashlib.sha1()
+        for path in paths:
+            sha.update('{}:{}\n'.format(os.path.abspath(path),
+                                        self.digest(path)).encode('utf-8'))
+        return sha.hexdigest()
+
+    def is_fresh(self, artifact, paths):
+        """ Check that artifact was recorded from the current paths contents """
+        return self.artifacts.get(artifact) == self.inputs_digest(paths)
+
+    def record(self, artifact, paths):
+        self.artifacts[artifact] = self.inputs_digest(paths)
+
+    def save(self):
+        man_dir = os.path.dirname(self.manifest_path)
+        if man_dir and not os.path.exists(man_dir):
+            os.makedirs(man_dir)
+        tmp_path = '{}.tmp{}'.format(self.manifest_path, os.getpid())
+        with open(tmp_path, 'wb') as man_f:
+            pickle.dump({'files':self.files,
+                         'artifacts':self.artifacts}, man_f)
+        os.replace(tmp_path, self.manifest_path)
@@ -0,0 +1,84 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import timeit
+
+
+def read_file_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class FilePrefetcher(object):
+    """ Iterate over (path, contents) of a list of files, reading the
+        upcoming ones with a pool of threads while the current one is
+        processed, to hide the storage latency (e.g. NFS volumes).
+
+        # Arguments
+            paths: files to read, yielded in the same order.
+            depth: max num of files read ahead (also num of reading
+                   threads). With depth 0, files are read synchronously.
+    """
+
+    def __init__(self, paths, depth=8):
+        self.paths = list(paths)
+        self.depth = depth
+        self.bytes_read = 0
+        # time spent by the consumer waiting for the files
+        self.wait_time = 0.
+        self.beg_t = None
+        self.end_t = None
+
+    @property
+    def elapsed(self):
+        """ Time since the iteration started (until it ended) """
+        if self.beg_t is None:
+            return 0.
+        end_t = self.end_t
+        if end_t is None:
+            end_t = timeit.default_timer()
+        return end_t - self.beg_t
+
+    def __iter__(self):
+        self.beg_t = timeit.default_timer()
+        self.end_t = None
+        if self.depth <= 0:
+            for path in self.paths:
+                read_t = timeit.default_timer()
+                contents = read_file_bytes(path)
+                self.wait_time += timeit.default_timer() - read_t
+                self.bytes_read += len(contents)
+                yield path, contents
+        else:
+            with ThreadPoolExecutor(max_workers=self.depth) as pool:
+                paths = iter(self.paths)
+                pending = deque()
+                for path in paths:
+                    pending.append((path, pool.submit(read_file_bytes, path)))
+                    if len(pending) >= self.depth:
+                        break
+                while len(pending) > 0:
+                    path, future = pending.popleft()
+                    wait_t = timeit.default_timer()
+                    contents = future.result()
+                    self.wait_time += timeit.default_timer() - wait_t
+                    # keep depth files in flight
+                    next_path = next(paths, None)
+                    if next_path is not None:
+                        pending.append((next_path,
+                                        pool.submit(read_file_bytes,
+                                                    next_path)))
+                    self.bytes_read += len(contents)
+                    yield path, contents
+        self.end_t = timeit.default_timer()
+
+    def report(self):
+        """ Summary of the read throughput and consumer wait time """
+        mbytes = self.bytes_read / 1e6
+        elapsed = max(self.elapsed, 1e-8)
+        return ('read {} files, {:.2f} MB in {:.2f} s ({:.2f} MB/s), '
+                'waiting for I/O {:.2f} s ({:.1f}%)'.format(len(self.paths),
+                                                            mbytes,
+                                                            elapsed,
+                                                            mbytes / elapsed,
+                                                            self.wait_time,
+                                                            100. * self.wait_time / elapsed))
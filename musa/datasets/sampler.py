@@ -1,61 +1,305 @@
 from torch.utils.data.sampler import Sampler
 from random import shuffle
+import random
 import json
 import numpy as np
 
 
+def padding_ratio(batches, lens):
+    """ Ratio of padded time-steps in the batches of sample indices """
+    total_steps = 0
+    pad_steps = 0
+    for batch in batches:
+        batch_lens = lens[batch]
+        total_steps += batch_lens.max() * len(batch)
+        pad_steps += batch_lens.max() * len(batch) - batch_lens.sum()
+    return pad_steps / max(total_steps, 1)
+
+
 class MOSampler(Sampler):
 
     def __init__(self, spk2size, mo_dataset, 
                  batch_size,
-                 randomize_rounds=False):
-        """ 
+                 randomize_rounds=False,
+                 weights=None,
+                 temperature=None,
+                 pack_rounds=False):
+        """ Batch sampler of MO datasets: every batch holds batch_size
+            consecutive samples (idx, spk_name) of a single speaker,
+            and speakers are interleaved in rounds. Speakers can have
+            different num of samples: they leave the rounds once their
+            samples are exhausted, so no data has to be trimmed.
+
         # Arguments
             spk2size: dict containing num of samples
                       per speaker id.
             mo_dataset: Dataset w/ MO instantiation.
-            randomize_rounds: randomize id order per round or not.
+            randomize_rounds: randomize the speakers order per round
+                              (otherwise it follows spk2size order).
+            weights: dict of speaker sampling weights. If weights or
+                     temperature are specified, the speaker of every
+                     batch is drawn with p ~ weight ** (1 / temperature)
+                     (weights default to the speakers num of batches),
+                     cycling over the speaker samples if needed. The
+                     num of batches per epoch does not change.
+            temperature: > 1 flattens the speakers distribution.
+            pack_rounds: every batch packs the batches of all the
+                         speakers of a round (rows of several speakers,
+                         in spk2size order), so that a single step
+                         trains all of them.
         """
         self.spk2size = spk2size
         self.mo_dataset = mo_dataset
         self.batch_size = batch_size
         self.randomize_rounds = randomize_rounds
-        # ASSUMING ALL SPEAKERS HAVE SAME AMOUNT OF DATA
-        self.len_by_spks = self.mo_dataset.len_by_spk()
-        assert isinstance(self.len_by_spks, dict)
-        spks = list(self.len_by_spks.keys())
-        self.N = self.len_by_spks[spks[0]]
-        # compute number of rounds
-        self.round_M = int(np.ceil(self.N / batch_size))
-        print('Number of rounds: ', self.round_M)
+        self.pack_rounds = pack_rounds
+        self.spks = list(spk2size.keys())
+        # number of batches (rounds it takes part in) per speaker
+        self.spk2batches = dict((spk, int(np.ceil(size / batch_size))) \
+                                for spk, size in spk2size.items())
+        self.num_batches = sum(self.spk2batches.values())
+        self.spk_probs = None
+        if weights is not None or temperature is not None:
+            if weights is None:
+                weights = self.spk2batches
+            if temperature is None:
+                temperature = 1.
+            spk_w = np.array([weights[spk] for spk in self.spks],
+                             dtype=np.float64) ** (1. / temperature)
+            self.spk_probs = spk_w / spk_w.sum()
+            if pack_rounds:
+                raise ValueError('Speaker sampling weights cannot be '
+                                 'used with packed rounds.')
+        print('Number of rounds: ', max(self.spk2batches.values()))
         print('Setting up MO sampler with spk sizes: ')
         print(json.dumps(self.spk2size, indent=2))
+        if self.spk_probs is not None:
+            print('MO sampler speaker probs: ', 
+                  dict(zip(self.spks, self.spk_probs.round(4).tolist())))
+
+    def spk_batch(self, spkname, batch_i):
+        """ batch_i-th batch of consecutive samples of a speaker """
+        batch_i = batch_i % self.spk2batches[spkname]
+        beg_i = batch_i * self.batch_size
+        end_i = min(beg_i + self.batch_size, self.spk2size[spkname])
+        return [(ii, spkname) for ii in range(beg_i, end_i)]
 
     def __iter__(self):
-        # arrange indeces of a whole epoch, defining here
-        # the rounds by interleaving speakers
-        spks = list(self.len_by_spks.keys())
-        # make a list of indices per speaker
-        spk_idces = dict((k, list(range(self.N))) for k in spks)
-        # shuffle every spk id
-        for k, v in spk_idces.items():
-            shuffle(spk_idces[k])
-        # including smaller batch in the end
-        epoch_ids = []
-        # make the list of indeces of every round
-        for beg_i in range(0, self.N, self.batch_size):
-            shuffle(spks)
-            left = self.batch_size
-            if self.N - beg_i < self.batch_size:
-                left = self.N - beg_i
-            for spkname in spks:
-                #print('Fetching spk {} beg_i {}'.format(spkname, beg_i))
-                batch = [(ii, spkname) for ii in \
-                         range(beg_i,beg_i+left)]
-                epoch_ids += batch
-        return iter(epoch_ids)
+        if self.spk_probs is not None:
+            # draw the speaker of every batch
+            spk_seq = np.random.choice(len(self.spks), size=self.num_batches,
+                                       p=self.spk_probs)
+            spk_cursor = dict((spk, 0) for spk in self.spks)
+            for spk_i in spk_seq:
+                spkname = self.spks[spk_i]
+                yield self.spk_batch(spkname, spk_cursor[spkname])
+                spk_cursor[spkname] += 1
+            return
+        # rounds interleaving one batch of every speaker with data left
+        for round_i in range(max(self.spk2batches.values())):
+            round_spks = [spk for spk in self.spks if \
+                          self.spk2batches[spk] > round_i]
+            if self.pack_rounds:
+                yield [sample for spkname in round_spks \
+                       for sample in self.spk_batch(spkname, round_i)]
+                continue
+            if self.randomize_rounds:
+                shuffle(round_spks)
+            for spkname in round_spks:
+                yield self.spk_batch(spkname, round_i)
 
     def __len__(self):
-        return len(self.mo_dataset)
+        if self.pack_rounds:
+            return max(self.spk2batches.values())
+        return self.num_batches
+
 
+class StatefulSampler(Sampler):
+    """ Sampler of the stateful arrangement of a dataset (built with
+        max_seq_len and batch_size): yields (spk_name, batch_row, chunk)
+        windows so that every loader batch of batch_size samples
+        carries on the previous batch sequences, row by row, for one
+        speaker after the other.
+    """
+
+    def __init__(self, dataset, batch_size):
+        if not hasattr(dataset, 'stateful_streams'):
+            raise ValueError('StatefulSampler requires a dataset arranged '
+                             'in stateful batches.')
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.spk_counts = dataset.stateful_counts()
+
+    def __iter__(self):
+        for spk_name, num_wins in self.spk_counts:
+            for win_i in range(num_wins):
+                chunk, row = divmod(win_i, self.batch_size)
+                yield (spk_name, row, chunk)
 
+    def __len__(self):
+        return sum(num_wins for spk_name, num_wins in self.spk_counts)
+
+
+class BucketBatchSampler(Sampler):
+    """ Batch sampler grouping samples of similar length, so that
+        padding each batch to its longest sequence wastes less compute.
+        Samples are shuffled within their length bucket every epoch,
+        split into batches, and batches are shuffled among buckets.
+    """
+
+    def __init__(self, lens, batch_size, boundaries=None,
+                 num_buckets=8, megabatch=None, shuffle=True,
+                 drop_last=False):
+        """
+        # Arguments
+            lens: length (num of frames) of every dataset sample.
+            boundaries: sorted lengths splitting the buckets. If None,
+                        num_buckets quantiles of lens are used.
+            megabatch: if specified, every bucket is further sorted by
+                       length within chunks of megabatch batches.
+            shuffle: shuffle samples and batches every epoch.
+            drop_last: drop the last incomplete batch of every bucket.
+        """
+        self.lens = np.asarray(lens)
+        self.batch_size = batch_size
+        if boundaries is None:
+            qs = np.linspace(0, 100, num_buckets + 1)[1:-1]
+            boundaries = np.unique(np.percentile(self.lens, qs).astype(int))
+        self.boundaries = [int(b) for b in boundaries]
+        self.megabatch = megabatch
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        bucket_ids = np.digitize(self.lens, self.boundaries, right=True)
+        self.buckets = [np.where(bucket_ids == b)[0] for b in \
+                        np.unique(bucket_ids)]
+        self.last_padding_ratio = None
+        # padding of the bucketed batches, and of random (not bucketed)
+        # ones as reference: drawn from a local RNG, so that the setup
+        # does not change the draws of the training
+        rand_idxs = np.random.default_rng(0).permutation(len(self.lens))
+        rand_batches = [rand_idxs[i:i + batch_size] for i in \
+                        range(0, len(rand_idxs), batch_size)]
+        self.rand_padding_ratio = padding_ratio(rand_batches, self.lens)
+        self.bucket_padding_ratio = padding_ratio(self.make_batches(shuffle=False),
+                                                  self.lens)
+        print('Setting up bucket sampler with boundaries {}, bucket sizes '
+              '{}, padding ratio {:.4f} (random batches: '
+              '{:.4f})'.format(self.boundaries,
+                               [len(bucket) for bucket in self.buckets],
+                               self.bucket_padding_ratio,
+                               self.rand_padding_ratio))
+
+    def make_batches(self, shuffle=None):
+        if shuffle is None:
+            shuffle = self.shuffle
+        batches = []
+        for bucket in self.buckets:
+            bucket = np.array(bucket)
+            if shuffle:
+                np.random.shuffle(bucket)
+            if self.megabatch is not None:
+                mb_size = self.megabatch * self.batch_size
+                for beg_i in range(0, len(bucket), mb_size):
+                    mb = bucket[beg_i:beg_i + mb_size]
+                    bucket[beg_i:beg_i + mb_size] = mb[np.argsort(self.lens[mb],
+                                                                  kind='stable')]
+            for beg_i in range(0, len(bucket), self.batch_size):
+                batch = bucket[beg_i:beg_i + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append(batch.tolist())
+        if shuffle:
+            random.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        batches = self.make_batches()
+        self.last_padding_ratio = padding_ratio(batches, self.lens)
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(bucket) // self.batch_size for bucket in \
+                       self.buckets)
+        return sum(int(np.ceil(len(bucket) / self.batch_size)) for bucket \
+                   in self.buckets)
+
+class TokenBudgetBatchSampler(Sampler):
+    """ Batch sampler filling every batch up to a budget of padded
+        frames (or squared frames, for models whose cost grows
+        quadratically with the window length, like self-attention)
+        instead of a fixed num of samples: batches of short windows
+        hold many samples and batches of long windows only a few.
+        Samples are sorted by length (random order among equal
+        lengths), packed greedily, and batches are shuffled.
+    """
+
+    def __init__(self, lens, max_frames, cost='frames', max_seqs=None,
+                 shuffle=True):
+        """
+        # Arguments
+            lens: length (num of frames) of every dataset sample.
+            max_frames: budget of every batch, i.e. max of
+                        num_seqs * max_len ('frames' cost) or
+                        num_seqs * max_len ** 2 ('frames2' cost). A
+                        sample over budget makes a batch on its own.
+            max_seqs: optional cap of samples per batch.
+            shuffle: shuffle samples of equal length and batches
+                     every epoch.
+        """
+        if cost not in ['frames', 'frames2']:
+            raise ValueError('Unrecognized batch cost: ', cost)
+        self.lens = np.asarray(lens)
+        self.max_frames = max_frames
+        self.cost = cost
+        self.max_seqs = max_seqs
+        self.shuffle = shuffle
+        # num of batches (and their padding) does not depend on the
+        # order of equal lengths: count them without shuffling, which
+        # would advance the global RNGs
+        batches = self.make_batches(shuffle=False)
+        self.num_batches = len(batches)
+        batch_sizes = [len(batch) for batch in batches]
+        print('Setting up token budget sampler with max {} {}: {} batches '
+              'of {}-{} samples, padding ratio {:.4f}'.format(max_frames,
+                                                              cost,
+                                                              self.num_batches,
+                                                              min(batch_sizes),
+                                                              max(batch_sizes),
+                                                              padding_ratio(batches,
+                                                                            self.lens)))
+
+    def batch_cost(self, num_seqs, max_len):
+        if self.cost == 'frames2':
+            return num_seqs * max_len ** 2
+        return num_seqs * max_len
+
+    def make_batches(self, shuffle=None):
+        if shuffle is None:
+            shuffle = self.shuffle
+        idxs = np.arange(len(self.lens))
+        if shuffle:
+            np.random.shuffle(idxs)
+        idxs = idxs[np.argsort(self.lens[idxs], kind='stable')]
+        batches = []
+        batch = []
+        for idx in idxs.tolist():
+            # sorted: the new sample is the longest of the batch
+            if len(batch) > 0 and \
+               (self.batch_cost(len(batch) + 1, self.lens[idx]) > \
+                self.max_frames or \
+                (self.max_seqs is not None and len(batch) >= self.max_seqs)):
+                batches.append(batch)
+                batch = []
+            batch.append(idx)
+        if len(batch) > 0:
+            batches.append(batch)
+        if shuffle:
+            random.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        return iter(self.make_batches())
+
+    def __len__(self):
+        return self.num_batches
@@ -0,0 +1,118 @@
+import numpy as np
+
+
+class CompactFrames(object):
+    """ Compact storage of a (N, D) float32 frames matrix: binary
+        columns (bools, one-hots) are packed into bits and the rest are
+        stored in float16, optionally scaled to [0, 1] per column.
+        Frames are only upcasted to float32 when decoded.
+    """
+
+    def __init__(self, bits, reals, bin_cols, real_cols, offset=None,
+                 scale=None):
+        self.bits = bits
+        self.reals = reals
+        self.bin_cols = bin_cols
+        self.real_cols = real_cols
+        self.offset = offset
+        self.scale = scale
+
+    @classmethod
+    def from_dense(cls, frames, scale_reals=False):
+        """ Encode a dense (N, D) frames matrix
+
+            # Arguments
+                scale_reals: store the non-binary columns as
+                             (x - min) / (max - min), so that float16
+                             rounding error is relative to each column range.
+        """
+        frames = np.asarray(frames, dtype=np.float32)
+        is_bin = np.all((frames == 0) | (frames == 1), axis=0)
+        bin_cols = np.where(is_bin)[0]
+        real_cols = np.where(~is_bin)[0]
+        bits = np.packbits(frames[:, bin_cols].astype(np.uint8), axis=1)
+        reals = frames[:, real_cols]
+        offset = None
+        scale = None
+        if scale_reals and len(real_cols) > 0:
+            offset = reals.min(axis=0)
+            scale = reals.max(axis=0) - offset
+            scale[scale == 0] = 1.
+            reals = (reals - offset) / scale
+        return cls(bits, reals.astype(np.float16), bin_cols, real_cols,
+                   offset, scale)
+
+    @property
+    def shape(self):
+        return (self.reals.shape[0], len(self.bin_cols) + len(self.real_cols))
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes + self.reals.nbytes
+
+    def __len__(self):
+        return self.reals.shape[0]
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            index = slice(index, index + 1)
+        return CompactFrames(self.bits[index], self.reals[index],
+                             self.bin_cols, self.real_cols,
+                             self.offset, self.scale)
+
+    def decode(self, out=None):
+        """ Upcast to the dense float32 frames (written in out if given) """
+        if out is None:
+            out = np.zeros(self.shape, dtype=np.float32)
+        if len(self.bin_cols) > 0:
+            out[:, self.bin_cols] = np.unpackbits(self.bits, axis=1,
+                                                  count=len(self.bin_cols))
+        reals = self.reals.astype(np.float32)
+        if self.scale is not None:
+            reals = reals * self.scale + self.offset
+        out[:, self.real_cols] = reals
+        return out
+
+
+class SymbolFrames(object):
+    """ Interned storage of a (N, K) array of strings: slicing it gives
+        back the string rows.
+    """
+
+    def __init__(self, frames):
+        self.vocab, ids = np.unique(np.asarray(frames), return_inverse=True)
+        self.ids = ids.reshape(np.shape(frames)).astype(np.uint16)
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.vocab.nbytes
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def __getitem__(self, index):
+        return self.vocab[self.ids[index]]
+
+
+class FrameWindow(object):
+    """ Window of (spk_idx, in, out) frames kept as arrays (dense or
+        in compact storage) until the collate function copies/decodes it.
+    """
+
+    def __init__(self, spk_idx, in_frames, out_frames):
+        self.spk_idx = spk_idx
+        self.in_frames = in_frames
+        self.out_frames = out_frames
+
+    def __len__(self):
+        return len(self.in_frames)
+
+
+def decode_frames(frames, out=None):
+    """ Decode compact frames, or copy dense ones, into out """
+    if isinstance(frames, CompactFrames):
+        return frames.decode(out)
+    if out is None:
+        return np.array(frames)
+    out[:] = frames
+    return out
@@ -7,19 +7,33 @@ import glob
 import sys
 from musa.ops import *
 from .utils import *
+from .cache import *
+from .manifest import FileManifest
+from .storage import CompactFrames, SymbolFrames, FrameWindow
+from .prefetch import FilePrefetcher
 import timeit
 import struct
 import numpy as np
 import multiprocessing as mp
 from sklearn.cluster import KMeans
+import random
 import copy
+import io
 
 
-def read_aco_file(spk_name, file_id, aco_dir):
+def aco_file_paths(spk_name, file_id, aco_dir):
+    """ cc, fv and lf0 files of an utterance """
     spk_aco_dir = os.path.join(aco_dir, spk_name)
-    cc = read_bin_aco_file(os.path.join(spk_aco_dir, '{}.cc'.format(file_id)))
-    fv = read_bin_aco_file(os.path.join(spk_aco_dir, '{}.fv'.format(file_id)))
-    lf0 = read_bin_aco_file(os.path.join(spk_aco_dir, '{}.lf0'.format(file_id)))
+    return [os.path.join(spk_aco_dir, '{}.{}'.format(file_id, ext)) \
+            for ext in ['cc', 'fv', 'lf0']]
+
+def read_aco_file(spk_name, file_id, aco_dir, aco_bytes=None):
+    """ aco_bytes: contents of the cc, fv and lf0 files, if already read """
+    if aco_bytes is None:
+        cc, fv, lf0 = [read_bin_aco_file(aco_path) for aco_path in \
+                       aco_file_paths(spk_name, file_id, aco_dir)]
+    else:
+        cc, fv, lf0 = [parse_bin_aco(aco_bs) for aco_bs in aco_bytes]
     fv = fv.reshape((-1, 1))
     cc = cc.reshape((-1, 40))
     # make lf0 interpolation and obtain u/v flag
@@ -94,7 +108,8 @@ def parse_lab_aco_correspondences(durs, aco_data):
     return aco_seq_data, reldurs
 
 def read_speaker_labs(spk_name, ids_list, lab_dir, lab_parser,
-                      filter_by_dur=False, aco_dir=None):
+                      filter_by_dur=False, aco_dir=None,
+                      prefetch_depth=8):
     parsed_lines = [] # maintain seq structure
     parsed_tstamps = [] # maintain seq structure
     if aco_dir is not None:
@@ -106,11 +121,18 @@ def read_speaker_labs(spk_name, ids_list, lab_dir, lab_parser,
     beg_t = timeit.default_timer()
     #if filter_by_dur:
         #log_file = open('/tmp/dur_filter.log', 'w')
+    # read the upcoming lab (and aco) files while parsing the current one
+    utt_files = []
+    for split_id in ids_list:
+        utt_files.append(os.path.join(lab_dir, spk_name,
+                                      '{}.lab'.format(split_id)))
+        if aco_dir is not None:
+            utt_files += aco_file_paths(spk_name, split_id, aco_dir)
+    prefetcher = FilePrefetcher(utt_files, depth=prefetch_depth)
+    utt_contents = iter(prefetcher)
     for id_i, split_id in enumerate(ids_list, start=1):
-        spk_lab_dir = os.path.join(lab_dir, spk_name)
-        lab_f = os.path.join(spk_lab_dir, '{}.lab'.format(split_id))
-        with open(lab_f) as lf:
-            lab_lines = [l.rstrip() for l in lf.readlines()]
+        lab_f, lab_bs = next(utt_contents)
+        lab_lines = [l.rstrip() for l in io.StringIO(lab_bs.decode('utf-8'))]
         tstamps, parsed_lab = lab_parser(lab_lines)
         if filter_by_dur:
             filtered_lab = []
@@ -151,7 +173,8 @@ def read_speaker_labs(spk_name, ids_list, lab_dir, lab_parser,
             #print('parsed_tstamps[-1]: ', parsed_tstamps[-1])
             # parse aco
             parsed_durs = tstamps_to_dur(parsed_tstamps[-1], True)
-            aco_seq = read_aco_file(spk_name, split_id, aco_dir)
+            aco_bytes = [next(utt_contents)[1] for _ in range(3)]
+            aco_seq = read_aco_file(spk_name, split_id, aco_dir, aco_bytes)
             #print('Total read aco frames: ', aco_seq.shape)
             aco_seq_data, \
             seq_reldur = parse_lab_aco_correspondences(parsed_durs, 
@@ -165,6 +188,8 @@ def read_speaker_labs(spk_name, ids_list, lab_dir, lab_parser,
         #     end='\n')
         #beg_t = timeit.default_timer()
     #log_file.close()
+    if len(ids_list) > 0:
+        print('spk {} > {}'.format(spk_name, prefetcher.report()))
     if aco_dir is None:
         return (spk_name, parsed_tstamps, parsed_lines, flat_lines)
     else:
@@ -289,6 +314,9 @@ def old_varlen_aco_collate(batch):
 
 class TCSTAR(Dataset):
 
+    # current phone of the silence frames, masked out of the metrics
+    sil_phone = 'pau'
+
     def __init__(self, spk_cfg_file, split, lab_dir,
                  lab_codebooks_path, force_gen=False,
                  ogmios_lab=True, parse_workers=4,
@@ -299,12 +327,20 @@ class TCSTAR(Dataset):
                  trim_to_min=False,
                  forced_trim=None,
                  exclude_train_spks=[],
-                 exclude_eval_spks=[]):
+                 exclude_eval_spks=[],
+                 window_mode='stride',
+                 window_stride=None,
+                 cache_dir=None,
+                 storage='dense',
+                 prefetch_depth=8,
+                 return_arrays=False):
         """
         # Arguments:
             max_seq_len: if specified, batches are stateful-like
                          with max_seq_len time-steps per sample,
-                         and batch_size is also required.
+                         and batch_size is also required. Without
+                         batch_size, every utterance is served in
+                         windows of max_seq_len time-steps.
 
             mulout: determines that speaker's data has to be
                     arranged in batches
@@ -312,6 +348,25 @@ class TCSTAR(Dataset):
                          maxlen is applied (specially for MO).
             forced_trim: max num of samples per speaker forced (this
                          has priority over trim_to_min counts)
+            window_mode: non-stateful windowing of utterances longer
+                         than max_seq_len: 'stride' (sliding windows)
+                         or 'random' (one random crop per utterance
+                         each time it is sampled).
+            window_stride: hop of the 'stride' windows (Def: max_seq_len).
+            cache_dir: if specified, the built frame store is cached
+                       there, keyed by the build params and the input
+                       files manifest, and re-loaded (memory-mapped) on
+                       later launches. Windowing options are not part
+                       of the key: windows are re-arranged at load time.
+            storage: 'dense' (float32 frames) or 'compact' (bit-packed
+                     binary columns, float16 reals and per-column scaled
+                     float16 targets), decoded by the collate functions.
+            prefetch_depth: num of files read ahead by threads in every
+                            parse worker (0: synchronous reads).
+            return_arrays: serve every window as a FrameWindow of
+                           contiguous arrays instead of a list of
+                           (spk_idx, in, out) frame tuples (implied by
+                           compact storage).
         """
         self.trim_to_min = trim_to_min
         self.forced_trim = forced_trim
@@ -330,6 +385,14 @@ class TCSTAR(Dataset):
         self.q_classes = q_classes
         self.mulout = mulout
         self.batch_size = batch_size
+        if storage not in ['dense', 'compact']:
+            raise ValueError('Unrecognized storage: ', storage)
+        self.storage = storage
+        self.return_arrays = return_arrays
+        if window_mode not in ['stride', 'random']:
+            raise ValueError('Unrecognized window_mode: ', window_mode)
+        self.window_mode = window_mode
+        self.window_stride = window_stride
         self.exclude_train_spks = exclude_train_spks
         with open(spk_cfg_file, 'rb') as cfg_f:
             # load speakers config paths
@@ -366,10 +429,26 @@ class TCSTAR(Dataset):
         self.ogmios_lab = ogmios_lab
         self.force_gen = force_gen
         self.parse_workers = parse_workers
+        self.prefetch_depth = prefetch_depth
         self.lab_codebooks_path = lab_codebooks_path
         self.max_spk_samples = max_spk_samples
-        # call load_lab
-        self.load_lab()
+        self.cache_dir = cache_dir
+        self.spk_cfg_file = spk_cfg_file
+        self.manifest = None
+        if cache_dir is not None:
+            # parsed utterances, stats and codebooks are tracked against
+            # their input files, to only re-process what changed
+            self.preproc_dir = os.path.join(cache_dir, 'preproc')
+            self.manifest = FileManifest(os.path.join(self.preproc_dir,
+                                                      'manifest.pkl'))
+        # call load_lab (or load the cached build)
+        self.build_frames()
+        if self.manifest is not None:
+            self.manifest.save()
+        if self.storage == 'compact':
+            self.compact_frames()
+        # arrange the loaded frames into the served windows
+        self.make_windows()
         # save stats in case anything changed
         with open(spk_cfg_file, 'wb') as cfg_f:
             # update original speakers, excluded ones in
@@ -380,8 +459,540 @@ class TCSTAR(Dataset):
             pickle.dump(self.all_speakers, cfg_f)
 
     def load_lab(self):
+        """ Must fill in the frame store: in_frames, out_frames and
+            ph_frames (one row per time-step), with utt_bounds and
+            utt_spk describing each utterance [beg, end) and speaker idx.
+        """
         raise NotImplementedError
 
+    def build_frames(self):
+        """ Fill the frame store, going through the build cache if any """
+        if self.cache_dir is None:
+            self.load_lab()
+            return
+        key = cache_key(self.cache_params(), file_manifest(self.input_files()))
+        cached = None
+        if not self.force_gen:
+            cached = load_dataset_cache(self.cache_dir, key)
+        if cached is not None:
+            beg_t = timeit.default_timer()
+            self.restore_cache(*cached)
+            end_t = timeit.default_timer()
+            print('{}-{} > Loaded built dataset {} from cache in {:.4f} '
+                  's'.format(self.__class__.__name__, self.split, key,
+                             end_t - beg_t))
+            return
+        self.load_lab()
+        # stats and codebooks might have been made by this build, so
+        # the entry is keyed as the next launch will see them
+        key = cache_key(self.cache_params(), file_manifest(self.input_files()))
+        save_dataset_cache(self.cache_dir, key, self.cache_arrays(),
+                           self.cache_meta())
+        print('{}-{} > Stored built dataset {} in cache '
+              '{}'.format(self.__class__.__name__, self.split, key,
+                          self.cache_dir))
+
+    def split_samples(self, spk):
+        """ ids of the split samples read for a speaker """
+        if self.max_spk_samples is not None:
+            return spk[self.split][:self.max_spk_samples]
+        return spk[self.split]
+
+    def input_files(self):
+        """ Files read to build the dataset, in reading order """
+        files = []
+        for sname in sorted(self.speakers.keys()):
+            for split_id in self.split_samples(self.speakers[sname]):
+                files.append(os.path.join(self.lab_dir, sname,
+                                          '{}.lab'.format(split_id)))
+        return files
+
+    def cache_params(self):
+        """ Everything but the input files that changes the built frames """
+        spk_params = {}
+        for sname in sorted(self.speakers.keys()):
+            spk = self.speakers[sname]
+            spk_params[sname] = {'idx':self.spk2idx[sname],
+                                 'ids':list(self.split_samples(spk))}
+            if self.split != 'train':
+                # non-train splits read the stats from the train split.
+                # Train stats are derived from the (manifested) inputs
+                # and restored from the cache entry
+                for k in ['aco_stats', 'dur_stats', 'dur_clusters']:
+                    if k in spk:
+                        spk_params[sname][k] = spk[k]
+        return {'dataset':self.__class__.__name__,
+                'split':self.split,
+                'lab_dir':os.path.abspath(self.lab_dir),
+                'ogmios_lab':self.ogmios_lab,
+                'q_classes':self.q_classes,
+                'codebooks':file_digest(self.lab_codebooks_path),
+                'speakers':spk_params}
+
+    def utt_inputs(self, sname, split_id, aco_dir=None):
+        """ Input files of an utterance (lab, plus aco files if aco_dir) """
+        files = [os.path.join(self.lab_dir, sname, '{}.lab'.format(split_id))]
+        if aco_dir is not None:
+            files += aco_file_paths(sname, split_id, aco_dir)
+        return files
+
+    def utt_artifact(self, sname, split_id, aco_dir=None):
+        """ Name of the parsed utterance artifact (relative to preproc_dir) """
+        kind = 'lab' if aco_dir is None else 'aco'
+        lab_fmt = 'ogmios' if self.ogmios_lab else 'std'
+        return os.path.join('{}-{}'.format(kind, lab_fmt), sname,
+                            '{}.pkl'.format(split_id))
+
+    def stats_artifact(self, sname, aco_dir=None):
+        """ Name and inputs of a speaker stats artifact """
+        kind = 'dur' if aco_dir is None else 'aco'
+        stats_name = 'stats-{}:{}:{}'.format(kind,
+                                            os.path.abspath(self.spk_cfg_file),
+                                            sname)
+        stats_inputs = []
+        for split_id in self.split_samples(self.speakers[sname]):
+            stats_inputs += self.utt_inputs(sname, split_id, aco_dir)
+        return stats_name, stats_inputs
+
+    def load_parsed_utts(self, sname, ids_list, aco_dir=None):
+        """ Load the parsed utterances that are up to date with their
+            input files, in a dict split_id -> parsed utterance
+        """
+        parsed = {}
+        for split_id in ids_list:
+            artifact = self.utt_artifact(sname, split_id, aco_dir)
+            artifact_file = os.path.join(self.preproc_dir, artifact)
+            if self.force_gen or not os.path.exists(artifact_file):
+                continue
+            if not self.manifest.is_fresh(artifact,
+                                          self.utt_inputs(sname, split_id,
+                                                          aco_dir)):
+                continue
+            with open(artifact_file, 'rb') as utt_f:
+                parsed[split_id] = pickle.load(utt_f)
+        return parsed
+
+    def merge_parsed_utts(self, sname, parsed, result, aco_dir=None):
+        """ Store the freshly parsed utterances of result and merge them
+            with the previously parsed ones, returning the full speaker
+            result in read_speaker_labs format
+        """
+        ids_list = self.split_samples(self.speakers[sname])
+        stale_ids = [split_id for split_id in ids_list \
+                     if split_id not in parsed]
+        for utt_i, split_id in enumerate(stale_ids):
+            utt = [result[1][utt_i], result[2][utt_i]]
+            if aco_dir is not None:
+                utt += [result[4][utt_i], result[5][utt_i]]
+            parsed[split_id] = utt
+            artifact = self.utt_artifact(sname, split_id, aco_dir)
+            artifact_file = os.path.join(self.preproc_dir, artifact)
+            if not os.path.exists(os.path.dirname(artifact_file)):
+                os.makedirs(os.path.dirname(artifact_file))
+            with open(artifact_file, 'wb') as utt_f:
+                pickle.dump(utt, utt_f)
+            self.manifest.record(artifact, self.utt_inputs(sname, split_id,
+                                                           aco_dir))
+        print('{}-{} > spk {}: parsed {} utterances, {} up to '
+              'date'.format(self.__class__.__name__, self.split, sname,
+                            len(stale_ids), len(parsed) - len(stale_ids)))
+        utts = [parsed[split_id] for split_id in ids_list]
+        merged = [sname, [utt[0] for utt in utts], [utt[1] for utt in utts],
+                  [lab for utt in utts for lab in utt[1]]]
+        if aco_dir is not None:
+            merged += [[utt[2] for utt in utts], [utt[3] for utt in utts]]
+        return tuple(merged)
+
+    def build_lab_encoder(self, lab_data):
+        """ Load the lab codebooks, making them if they don't exist (or if
+            forced). With a manifest, the train labs are checked against
+            the codebooks whenever they changed: codebooks are shared
+            with the trained models (and synthesize.py), so they are
+            never modified in place, and a change of the encoded
+            dimension or of the real values stats raises unless force_gen.
+        """
+        lab_codebooks_path = self.lab_codebooks_path
+        if self.manifest is None or self.split != 'train':
+            return label_encoder(codebooks_path=lab_codebooks_path,
+                                 lab_data=lab_data,
+                                 force_gen=self.force_gen)
+        cbooks_name = 'codebooks:{}'.format(os.path.abspath(lab_codebooks_path))
+        cbooks_inputs = []
+        for sname in sorted(self.speakers.keys()):
+            for split_id in self.split_samples(self.speakers[sname]):
+                cbooks_inputs += self.utt_inputs(sname, split_id)
+        if self.force_gen or not os.path.exists(lab_codebooks_path):
+            lab_enc = label_encoder(codebooks_path=lab_codebooks_path,
+                                    lab_data=lab_data,
+                                    force_gen=True)
+        else:
+            lab_enc = label_encoder(codebooks_path=lab_codebooks_path)
+            if not self.manifest.is_fresh(cbooks_name, cbooks_inputs):
+                changes = lab_enc.codebooks_changes(lab_data)
+                if len(changes) > 0:
+                    raise ValueError('The train labs do not match the lab '
+                                     'codebooks {} anymore ({}). Re-make '
+                                     'them with force_gen (the models '
+                                     'trained with them will not be valid '
+                                     'anymore) or use a new codebooks '
+                                     'path.'.format(lab_codebooks_path,
+                                                    ', '.join(changes)))
+        self.manifest.record(cbooks_name, cbooks_inputs)
+        return lab_enc
+
+    def utt_ids(self):
+        """ (spk name, split_id) of every parsed utterance, in the order
+            of parse_labs
+        """
+        return [(sname, split_id) for sname, spk in self.speakers.items() \
+                for split_id in self.split_samples(spk)]
+
+    def encode_utts(self, lab_seqs, normalize):
+        """ Encode the parsed labs of every utterance into a float32 array
+            (one row per phone). With a manifest, the codes of every
+            utterance are stored as an artifact recorded against its lab
+            file and the codebooks, and only re-encoded when any of them
+            changed.
+        """
+        utt_ids = self.utt_ids()
+        assert len(utt_ids) == len(lab_seqs), len(lab_seqs)
+        lab_fmt = 'ogmios' if self.ogmios_lab else 'std'
+        code_seqs = []
+        num_encoded = 0
+        for (sname, split_id), lab_seq in zip(utt_ids, lab_seqs):
+            artifact = None
+            if self.manifest is not None:
+                artifact = os.path.join('enc-{}-{}'.format(normalize,
+                                                           lab_fmt),
+                                        sname, '{}.npy'.format(split_id))
+                artifact_file = os.path.join(self.preproc_dir, artifact)
+                enc_inputs = self.utt_inputs(sname, split_id) + \
+                             [self.lab_codebooks_path]
+                if not self.force_gen and os.path.exists(artifact_file) and \
+                   self.manifest.is_fresh(artifact, enc_inputs):
+                    code_seqs.append(np.load(artifact_file))
+                    continue
+            codes = np.array([self.lab_enc(lab, normalize=normalize,
+                                           sort_types=False)
+                              for lab in lab_seq], dtype=np.float32)
+            code_seqs.append(codes)
+            num_encoded += 1
+            if artifact is not None:
+                if not os.path.exists(os.path.dirname(artifact_file)):
+                    os.makedirs(os.path.dirname(artifact_file))
+                np.save(artifact_file, codes)
+                self.manifest.record(artifact, enc_inputs)
+        print('{}-{} > encoded {} utterances, {} up to '
+              'date'.format(self.__class__.__name__, self.split, num_encoded,
+                            len(code_seqs) - num_encoded))
+        return code_seqs
+
+    def cache_arrays(self):
+        return {'utt_bounds':self.utt_bounds,
+                'utt_spk':self.utt_spk,
+                'in_frames':self.in_frames,
+                'out_frames':self.out_frames,
+                'ph_frames':self.ph_frames,
+                'ph_ids':self.ph_ids,
+                'sil_frames':self.sil_frames}
+
+    def cache_meta(self):
+        meta = {'speakers':{}}
+        for sname, spk in self.speakers.items():
+            meta['speakers'][sname] = dict((k, spk[k]) for k in \
+                                           ['aco_stats', 'dur_stats',
+                                            'dur_clusters'] if k in spk)
+        for attr in ['ling_feats_dim', 'aco_feats_dim', 'spk2durstats',
+                     'spk2acostats']:
+            if hasattr(self, attr):
+                meta[attr] = getattr(self, attr)
+        return meta
+
+    def restore_cache(self, arrays, meta):
+        for name, arr in arrays.items():
+            setattr(self, name, arr)
+        for sname, spk_stats in meta['speakers'].items():
+            if sname in self.speakers:
+                self.speakers[sname].update(spk_stats)
+        for attr, val in meta.items():
+            if attr != 'speakers':
+                setattr(self, attr, val)
+        self.lab_parser = label_parser(ogmios_fmt=self.ogmios_lab)
+        self.lab_enc = label_encoder(codebooks_path=self.lab_codebooks_path)
+        if 'ph_ids' not in arrays:
+            # entry stored before phones were interned
+            self.intern_phones()
+
+    def store_frames(self, utt_spks, in_seqs, out_seqs, ph_seqs):
+        """ Merge the vectorized utterances into the contiguous frame store """
+        utt_lens = np.array([len(seq) for seq in in_seqs], dtype=np.int64)
+        utt_ends = np.cumsum(utt_lens)
+        self.utt_bounds = np.stack((utt_ends - utt_lens, utt_ends), axis=1)
+        self.utt_spk = np.array(utt_spks, dtype=np.int64)
+        self.in_frames = np.concatenate(in_seqs, axis=0)
+        self.out_frames = np.concatenate(out_seqs, axis=0)
+        self.ph_frames = np.concatenate(ph_seqs, axis=0)
+        self.intern_phones()
+
+    def intern_phones(self):
+        """ Map the current phone of every frame to its integer id in the
+            lab codebooks (shared by all splits, 0 if unknown) and flag
+            the silence frames, so batches carry no phone strings.
+        """
+        self.ph2idx = self.lab_enc.codebooks['p3']
+        curr_phs = np.asarray(self.ph_frames)[:, 2]
+        vocab, inv = np.unique(curr_phs, return_inverse=True)
+        vocab_ids = np.array([self.ph2idx.get(ph, 0) for ph in vocab],
+                             dtype=np.int32)
+        self.ph_ids = vocab_ids[inv.reshape(-1)]
+        self.sil_frames = vocab[inv.reshape(-1)] == self.sil_phone
+
+    def compact_frames(self):
+        """ Move the frame store to the compact storage """
+        dense_bytes = self.in_frames.nbytes + self.out_frames.nbytes + \
+                      self.ph_frames.nbytes
+        self.in_frames = CompactFrames.from_dense(self.in_frames)
+        if self.out_frames.ndim > 1 and self.out_frames.dtype == np.float32:
+            # targets are scaled per column to make the most of float16
+            self.out_frames = CompactFrames.from_dense(self.out_frames,
+                                                       scale_reals=True)
+        else:
+            self.out_frames = np.array(self.out_frames)
+        self.ph_frames = SymbolFrames(self.ph_frames)
+        compact_bytes = self.in_frames.nbytes + self.out_frames.nbytes + \
+                        self.ph_frames.nbytes
+        print('{}-{} > Compacted frame store from {:.2f} MB to {:.2f} '
+              'MB'.format(self.__class__.__name__, self.split,
+                          dense_bytes / 1e6, compact_bytes / 1e6))
+
+    def set_windowing(self, max_seq_len, batch_size=None, window_mode=None,
+                      window_stride=None):
+        """ Change the served windows without re-parsing nor re-vectorizing
+            any data.
+
+            # Arguments
+                max_seq_len: time-steps per window (None: full utterances).
+                batch_size: if specified, windows are arranged to follow
+                            the stateful batch layout.
+        """
+        self.max_seq_len = max_seq_len
+        self.batch_size = batch_size
+        if window_mode is not None:
+            if window_mode not in ['stride', 'random']:
+                raise ValueError('Unrecognized window_mode: ', window_mode)
+            self.window_mode = window_mode
+        if window_stride is not None:
+            self.window_stride = window_stride
+        self.make_windows()
+
+    def select_speakers(self, spk_names):
+        """ Only serve the windows of these speakers (e.g. to train a
+            single speaker model), without re-building anything. The
+            stateful arrangement of every speaker is kept as it is.
+        """
+        spk_idxs = [self.spk2idx[spk] for spk in spk_names]
+        if isinstance(self.windows, dict):
+            self.windows = dict((spk, wins) for spk, wins in \
+                                self.windows.items() if spk in spk_names)
+        else:
+            keep = np.isin(self.windows[:, 2], spk_idxs)
+            self.windows = self.windows[keep]
+        print('TCSTAR-{} > Selected {} windows of speakers '
+              '{}'.format(self.split, len(self), ', '.join(spk_names)))
+
+    def make_windows(self):
+        """ Arrange the frame store into the windows served by __getitem__.
+            Each window is a row [beg, end, spk_idx] pointing to the frame
+            store, so nothing is copied here.
+        """
+        beg_t = timeit.default_timer()
+        if self.max_seq_len is not None and self.batch_size is not None:
+            if self.window_mode == 'random':
+                raise ValueError('Random windows cannot be arranged in '
+                                 'stateful batches.')
+            windows = self.stateful_windows()
+        else:
+            windows = self.utterance_windows()
+        if self.mulout:
+            # separated by spk name
+            self.windows = {}
+            for spk_idx in np.unique(windows[:, 2]):
+                spk_name = self.idx2spk[spk_idx]
+                self.windows[spk_name] = windows[windows[:, 2] == spk_idx]
+        else:
+            # all merged together
+            self.windows = windows
+        if self.trim_to_min or self.forced_trim is not None:
+            self.trim_windows()
+        end_t = timeit.default_timer()
+        print('TCSTAR-{} > Arranged {} windows (max_seq_len: {}, '
+              'batch_size: {}) in {:.4f} s'.format(self.split, len(self),
+                                                   self.max_seq_len,
+                                                   self.batch_size,
+                                                   end_t - beg_t))
+
+    def utterance_windows(self):
+        begs = self.utt_bounds[:, 0]
+        ends = self.utt_bounds[:, 1]
+        if self.max_seq_len is None or self.window_mode == 'random':
+            # full utterances (random crops are taken at sampling time)
+            return np.stack((begs, ends, self.utt_spk), axis=1)
+        stride = self.window_stride
+        if stride is None:
+            stride = self.max_seq_len
+        # number of windows to fully cover every utterance
+        lens = ends - begs
+        over = np.maximum(lens - self.max_seq_len, 0)
+        nwins = -(-over // stride) + 1
+        utt_idx = np.repeat(np.arange(len(lens)), nwins)
+        first_win = np.cumsum(nwins) - nwins
+        win_pos = np.arange(len(utt_idx)) - np.repeat(first_win, nwins)
+        win_begs = begs[utt_idx] + win_pos * stride
+        win_ends = np.minimum(win_begs + self.max_seq_len, ends[utt_idx])
+        return np.stack((win_begs, win_ends, self.utt_spk[utt_idx]), axis=1)
+
+    def stateful_windows(self):
+        """ Split each speaker stream in batch_size rows and interleave
+            their max_seq_len chunks, so that consecutive batches carry
+            on the same rows (stateful).
+        """
+        bsize = self.batch_size
+        seq_len = self.max_seq_len
+        # spk_idx -> (stream beg, num of chunks per batch row)
+        self.stateful_streams = {}
+        windows = []
+        for spk_idx in np.unique(self.utt_spk):
+            spk_utts = self.utt_bounds[self.utt_spk == spk_idx]
+            # speaker utterances are contiguous in the frame store
+            stream_beg = spk_utts[0, 0]
+            stream_len = spk_utts[-1, 1] - stream_beg
+            print('{}: Length of all code_seq: '
+                  '{}'.format(self.idx2spk[spk_idx], stream_len))
+            # trim data to fit stateful arrangement
+            total_batches = stream_len // (bsize * seq_len)
+            print('total stateful batches: ', total_batches)
+            if total_batches <= 0:
+                raise ValueError('Not enough samples to statefulize '
+                                 'with specified max_len ({}) and '
+                                 'batch_size ({})'.format(seq_len, bsize))
+            self.stateful_streams[spk_idx] = (stream_beg, total_batches)
+            # window positions in the stream are pure index arithmetic
+            win_begs = stream_beg + stateful_offsets(bsize, seq_len,
+                                                     total_batches)
+            spk_wins = np.stack((win_begs, win_begs + seq_len,
+                                 np.full(len(win_begs), spk_idx)), axis=1)
+            windows.append(spk_wins)
+        return np.concatenate(windows, axis=0)
+
+    def trim_windows(self):
+        if self.forced_trim is not None:
+            counts_min = self.forced_trim + 1
+            counts_spk = 'Forced Trim'
+        else:
+            spks, counts = np.unique(self.all_windows()[:, 2],
+                                     return_counts=True)
+            counts_min = counts.min()
+            counts_spk = self.idx2spk[spks[np.argmin(counts)]]
+        print('-- Trimming speaker samples --')
+        print('counts_min: ', counts_min)
+        print('counts_spk: ', counts_spk)
+        print('len windows prior to trim: ', len(self))
+        if self.mulout:
+            for spk_name, spk_wins in self.windows.items():
+                self.windows[spk_name] = spk_wins[:counts_min]
+        else:
+            # keep the first counts_min windows of every speaker
+            keep = np.zeros(len(self.windows), dtype=bool)
+            for spk_idx in np.unique(self.windows[:, 2]):
+                spk_pos = np.where(self.windows[:, 2] == spk_idx)[0]
+                keep[spk_pos[:counts_min]] = True
+            self.windows = self.windows[keep]
+        print('len windows after trim: ', len(self))
+
+    def all_windows(self):
+        if isinstance(self.windows, dict):
+            return np.concatenate(list(self.windows.values()), axis=0)
+        return self.windows
+
+    def window_lens(self):
+        """ Num of frames served by every (SO) sample, e.g. to bucket them """
+        if isinstance(self.windows, dict):
+            raise ValueError('window_lens is not available for MO datasets.')
+        lens = self.windows[:, 1] - self.windows[:, 0]
+        if self.window_mode == 'random' and self.max_seq_len is not None:
+            lens = np.minimum(lens, self.max_seq_len)
+        return lens
+
+    def stateful_window(self, spk_name, row, chunk):
+        """ Window of chunk-th max_seq_len frames of a batch row of the
+            speaker stateful stream
+        """
+        spk_idx = self.spk2idx[spk_name]
+        stream_beg, num_chunks = self.stateful_streams[spk_idx]
+        beg = stream_beg + (row * num_chunks + chunk) * self.max_seq_len
+        return beg, beg + self.max_seq_len, spk_idx
+
+    def stateful_counts(self):
+        """ (spk_name, num of windows) of the stateful streams, in
+            serving order
+        """
+        counts = []
+        for spk_idx in np.unique(self.all_windows()[:, 2]):
+            spk_wins = self.all_windows()[:, 2] == spk_idx
+            counts.append((self.idx2spk[spk_idx], int(spk_wins.sum())))
+        return counts
+
+    def get_window(self, index):
+        if isinstance(index, tuple) and len(index) == 3:
+            # (spk_name, batch row, chunk) of the stateful arrangement
+            return self.stateful_window(*index)
+        if isinstance(self.windows, dict):
+            # select hierarchicaly, first speaker, and then that speaker's sample
+            if not isinstance(index, tuple):
+                raise IndexError('Accessing MO Dataset with SO format. Use the '
+                                 'proper Sampler in your loader please.')
+            beg, end, spk_idx = self.windows[index[1]][index[0]]
+        else:
+            beg, end, spk_idx = self.windows[index]
+        if self.window_mode == 'random' and self.max_seq_len is not None \
+           and end - beg > self.max_seq_len:
+            # random crop of max_seq_len frames
+            beg = random.randint(beg, end - self.max_seq_len)
+            end = beg + self.max_seq_len
+        return beg, end, spk_idx
+
+    def frame_tuples(self, beg, end, spk_idx):
+        """ Build the seq of (spk_idx, in, out) frames and the
+            (phone ids, silence flags) arrays of a window.
+        """
+        ph_seq = (self.ph_ids[beg:end], self.sil_frames[beg:end])
+        if self.return_arrays or self.storage == 'compact':
+            # copied (decoded) by the collate function
+            vec_seq = FrameWindow(spk_idx, self.in_frames[beg:end],
+                                  self.out_frames[beg:end])
+            return vec_seq, ph_seq
+        vec_seq = list(zip([spk_idx] * (end - beg),
+                           self.in_frames[beg:end],
+                           self.out_frames[beg:end]))
+        return vec_seq, ph_seq
+
+    def __len__(self):
+        if isinstance(self.windows, dict):
+            # sup up all keys length for final len on num of samples
+            total_samples = sum(len(spk_wins) for spkname, spk_wins in
+                                self.windows.items())
+        else:
+            # directly compute windows length
+            total_samples = len(self.windows)
+        return total_samples
+
+    def len_by_spk(self):
+        if not isinstance(self.windows, dict):
+            raise TypeError('Cannot get len_by_spk w/ SO format')
+        else:
+            lens = dict((k, len(v)) for k, v in self.windows.items())
+            return lens
+
 
     def parse_labs(self, lab_parser, compute_dur_stats=False, 
                    compute_dur_classes=False, aco_dir=None):
@@ -405,15 +1016,19 @@ class TCSTAR(Dataset):
                                           num_labs_total,
                                           len(self.speakers),
                                           self.parse_workers))
+        parsed_utts = {}
         for sname, spk in self.speakers.items():
             async_f = read_speaker_labs
-            if self.max_spk_samples is not None:
-                spk_samples = spk[self.split][:self.max_spk_samples]
-            else:
-                spk_samples = spk[self.split]
+            spk_samples = self.split_samples(spk)
+            if self.manifest is not None:
+                # only parse the utterances that changed since last time
+                parsed_utts[sname] = self.load_parsed_utts(sname, spk_samples,
+                                                           aco_dir)
+                spk_samples = [split_id for split_id in spk_samples \
+                               if split_id not in parsed_utts[sname]]
             async_args = (sname, spk_samples, self.lab_dir,
                           lab_parser, True, 
-                          aco_dir)
+                          aco_dir, self.prefetch_depth)
             spk['result'] = parse_pool.apply_async(async_f, async_args)
         parse_pool.close()
         parse_pool.join()
@@ -421,12 +1036,20 @@ class TCSTAR(Dataset):
         print('Total parse time: {} s'.format(end_t - beg_t))
         for sname, spk in self.speakers.items():
             result = spk['result'].get()
+            # stats are re-computed for speakers whose train data changed
+            stale_stats = False
+            if self.manifest is not None:
+                result = self.merge_parsed_utts(sname, parsed_utts[sname],
+                                                result, aco_dir)
+                stats_name, stats_inputs = self.stats_artifact(sname, aco_dir)
+                stale_stats = self.split == 'train' and \
+                        not self.manifest.is_fresh(stats_name, stats_inputs)
             parsed_timestamps = result[1]
             parsed_durs = tstamps_to_dur(parsed_timestamps)
             if compute_dur_stats:
             #if self.norm_dur:
                 if self.split == 'train' and ('dur_stats' not in spk or \
-                                              self.force_gen):
+                                              self.force_gen or stale_stats):
                     flat_durs = [fd for dseq in parsed_durs for fd in dseq]
                     # if they do not exist (or force_gen) and it's train split
                     dur_min = np.min(flat_durs)
@@ -444,7 +1067,7 @@ class TCSTAR(Dataset):
             if compute_dur_classes:
             #if self.q_classes is not None:
                 if self.split == 'train' and ('dur_clusters' not in spk or \
-                                              self.force_gen) and \
+                                              self.force_gen or stale_stats) and \
                    self.q_classes is not None:
                     flat_durs = [fd for dseq in parsed_durs for fd in dseq]
                     flat_durs = np.array(flat_durs)
@@ -465,7 +1088,7 @@ class TCSTAR(Dataset):
                 total_parsed_aco += result[-2]
                 total_parsed_reldur += result[-1]
                 if self.split == 'train' and ('aco_stats' not in spk or \
-                                              self.force_gen):
+                                              self.force_gen or stale_stats):
                     flat_acos = [fa for aseq in result[-2] for adur in aseq \
                                  for fa in adur]
                     #print('len(flat_acos)=', len(flat_acos))
@@ -477,7 +1100,7 @@ class TCSTAR(Dataset):
                                         'max':aco_max}
                 # dur stats are necessary for absolute duration normalization
                 if self.split == 'train' and ('dur_stats' not in spk or \
-                                              self.force_gen):
+                                              self.force_gen or stale_stats):
                     #print('len parsed_durs: ', len(result[-1]))
                     #flat_durs = [fd for dseq in parsed_durs for fd in dseq]
                     flat_durs = []
@@ -497,6 +1120,8 @@ class TCSTAR(Dataset):
                     spk['dur_stats'] = {'min':dur_min,
                                         'max':dur_max}
             del spk['result']
+            if stale_stats:
+                self.manifest.record(stats_name, stats_inputs)
         if aco_dir is None:
             return parsed_labs, total_flat_labs, total_parsed_durs, \
                    total_parsed_labs, total_parsed_spks
@@ -520,7 +1145,13 @@ class TCSTAR_dur(TCSTAR):
                  forced_trim=None,
                  exclude_train_spks=[],
                  exclude_eval_spks=[],
-                 norm_dur=True):
+                 norm_dur=True,
+                 window_mode='stride',
+                 window_stride=None,
+                 cache_dir=None,
+                 storage='dense',
+                 prefetch_depth=8,
+                 return_arrays=False):
         """
         # Arguments
             q_classes: integer specifying num of quantization clusters.
@@ -540,7 +1171,13 @@ class TCSTAR_dur(TCSTAR):
                                          exclude_train_spks=exclude_train_spks,
                                          exclude_eval_spks=exclude_eval_spks,
                                          batch_size=batch_size,
-                                         max_spk_samples=max_spk_samples)
+                                         max_spk_samples=max_spk_samples,
+                                         window_mode=window_mode,
+                                         window_stride=window_stride,
+                                         cache_dir=cache_dir,
+                                         storage=storage,
+                                         prefetch_depth=prefetch_depth,
+                                         return_arrays=return_arrays)
 
 
     def load_lab(self):
@@ -568,183 +1205,50 @@ class TCSTAR_dur(TCSTAR):
                                                                  not None))
         # Build label encoder (codebooks will be made if they don't exist or
         # if they are forced)
-        lab_enc = label_encoder(codebooks_path=lab_codebooks_path,
-                                lab_data=total_flat_labs,
-                                force_gen=self.force_gen)
+        lab_enc = self.build_lab_encoder(total_flat_labs)
         self.lab_enc = lab_enc
         end_t = timeit.default_timer()
         print('TCSTAR_dur-{} > Loaded lab codebooks in {:.4f} '
               's'.format(self.split, end_t - beg_t))
         # Encode all lab contents
-        # store vectorized sequences of samples of triplets (spk, lab, dur)
-        if self.mulout:
-            # separated by spk idx
-            self.vec_sample = {}
-            self.phone_sample = {}
-        else:
-            # all merged together
-            self.vec_sample = []
-            # store reference to phone identities (str)
-            self.phone_sample = []
+        # store vectorized sequences of (spk, lab, dur), one row per phone
         print('TCSTAR_dur-{} > Vectorizing {} sequences..'
               '.'.format(self.split,
                          len(total_parsed_durs)))
-        all_durs = {} # tmp
         beg_t = timeit.default_timer()
-        if self.max_seq_len is None:
-            for spk, dur_seq, lab_seq in zip(total_parsed_spks, total_parsed_durs, 
-                                             total_parsed_labs):
-                vec_seq = [None] * len(dur_seq)
-                phone_seq = [None] * len(dur_seq)
-                for t_, (dur, lab) in enumerate(zip(dur_seq, lab_seq)):
-                    code = lab_enc(lab, normalize='minmax', sort_types=False,
-                                   verbose=False)
-                    # store reference to phoneme labels (to filter if needed)
-                    phone_seq[t_] = lab[:5]
-                    ndur = self.process_dur(spk, dur)
-                    if spk not in all_durs:
-                        all_durs[spk] = []
-                    all_durs[spk].append(dur)
-                    vec_seq[t_] = [self.spk2idx[spk], code, ndur]
-                    if not hasattr(self, 'ling_feats_dim'):
-                        self.ling_feats_dim = len(code)
-                        print('Setting ling feats dim: ', len(code))
-                if self.mulout:
-                    spk_name = spk
-                    if spk_name not in self.vec_sample:
-                        self.vec_sample[spk_name] = []
-                        self.phone_sample[spk_name] = []
-                    self.vec_sample[spk_name].append(vec_seq)
-                    self.phone_sample[spk_name].append(phone_seq)
-                else:
-                    self.vec_sample.append(vec_seq)
-                    self.phone_sample.append(phone_seq)
-            #pickle.dump(all_durs, open('/tmp/durs.pickle', 'wb'))
-        else:
-            print('-' * 50)
-            print('Encoding dur samples with max_seq_len {} and batch_size '
-                  '{}'.format(self.max_seq_len, self.batch_size))
-            # First, arrange all sequences into one very long one
-            # Then split it into batch_size sequences, and arrange
-            # samples to follow batch_size interleaved samples (stateful)
-            all_code_seq = {}
-            all_phone_seq = {}
-            for spk, dur_seq, lab_seq in zip(total_parsed_spks,
-                                             total_parsed_durs,
-                                             total_parsed_labs):
-                for t_, (dur, lab) in enumerate(zip(dur_seq, lab_seq)):
-                    code = lab_enc(lab, normalize='minmax', sort_types=False)
-                    ndur = self.process_dur(spk, dur)
-                    if spk not in all_code_seq:
-                        all_code_seq[spk] = []
-                        all_phone_seq[spk] = []
-                    all_code_seq[spk].append([self.spk2idx[spk]] +\
-                                              code + [ndur])
-                    all_phone_seq[spk].append(lab[:5])
-                    if not hasattr(self, 'ling_feats_dim'):
-                        self.ling_feats_dim = len(code)
-                        print('setting ling feats dim: ', len(code))
-            all_seq_len = {}
-            if self.trim_to_min:
-                # count each spks samples
-                counts = {}
-                counts_min = np.inf
-                counts_spk = None
-            for spkname, spkdata in all_code_seq.items():
-                # all_code_seq contains the large sequence of features (in, out)
-                all_seq_len[spkname] = len(spkdata)
-                print('{}: Length of all code_seq: '
-                      '{}'.format(spkname,
-                                  all_seq_len[spkname]))
-                # trim data to fit stateful arrangement
-                total_batches = all_seq_len[spkname] // (self.batch_size * \
-                                                         self.max_seq_len)
-                tri_code_seq = spkdata[:self.batch_size * self.max_seq_len * \
-                                        total_batches]
-                all_code_seq[spkname] = tri_code_seq
-                tri_phone_seq = all_phone_seq[spkname][:self.batch_size * \
-                                                       self.max_seq_len * \
-                                                       total_batches]
-                all_phone_seq[spkname] = tri_phone_seq
-                print('total stateful batches: ', total_batches)
-                if total_batches <= 0:
-                    raise ValueError('Not enough dur samples to statefulize '
-                                     'with specified max_len ({}) and '
-                                     'batch_size ({})'.format(self.max_seq_len,
-                                                              self.batch_size))
-
-                # Create dict of data to statefulize codes and phones data
-                to_st_data = {'co':{'data':all_code_seq[spkname], 
-                                    'np_class':np.array},
-                              'ph':{'data':all_phone_seq[spkname],
-                                    'np_class':np.char.array}}
-                st_data = statefulize_data(to_st_data, self.batch_size,
-                                           self.max_seq_len)
-                co_arr = st_data['co']['st_data']
-                ph_arr = st_data['ph']['st_data']
-
-                # re-format data per speaker excluding padding symbols now
-                for phone_sample, vec_sample in zip(ph_arr, co_arr):
-                    vec_seq = []
-                    ph_seq = []
-                    for t_ in range(vec_sample.shape[0]):
-                        vec_seq_el = vec_sample[t_]
-                        ph_seq_el = phone_sample[t_]
-                        dur_i_t = vec_seq_el[-1]
-                        if self.q_classes is not None:
-                            dur_i_t = np.array(dur_i_t, dtype=np.int64)
-                        vec_seq.append([vec_seq_el[0], 
-                                        vec_seq_el[1:-1], 
-                                        dur_i_t])
-                        ph_seq.append(ph_seq_el.tolist())
-                    if self.mulout:
-                        spk_name = self.idx2spk[vec_seq_el[0]] 
-                        if spk_name not in self.vec_sample:
-                            self.vec_sample[spk_name] = []
-                            self.phone_sample[spk_name] = []
-                        self.vec_sample[spk_name].append(vec_seq)
-                        self.phone_sample[spk_name].append(ph_seq)
-                    else:
-                        self.vec_sample.append(vec_seq)
-                        self.phone_sample.append(ph_seq)
-                    if self.trim_to_min:
-                        spk_name = self.idx2spk[vec_seq_el[0]]
-                        if spk_name not in counts:
-                            counts[spk_name] = 0
-                        counts[spk_name] += 1
-            if self.trim_to_min or self.forced_trim is not None:
-                if self.forced_trim is not None:
-                    counts_min = self.forced_trim + 1
-                    counts_spk = 'Forced Trim'
-                else:
-                    for spk_name, cnt in counts.items():
-                        if counts[spk_name] < counts_min:
-                            counts_min = counts[spk_name]
-                            counts_spk = spk_name
-                print('-- Trimming speaker samples --')
-                print('counts_min: ', counts_min)
-                print('counts_spk: ', counts_spk)
-                print('len self.vec_sample prior to '
-                      'trim: ', len(self.vec_sample))
-                self.vec_sample, \
-                self.phone_sample = trim_spk_samples(self.vec_sample,
-                                                     self.phone_sample,
-                                                     counts_min,
-                                                     self.mulout)
-                print('len self.vec_sample after trim: ', len(self.vec_sample))
-                if self.mulout:
-                    # go over all speaker ids and trim to max amount of samples
-                    for spkname, phsample in self.phone_sample.items():
-                        print('-' * 60)
-                        print('spk {} phsample len: '
-                              '{}'.format(spkname, len(phsample)))
+        utt_spks = []
+        code_seqs = []
+        dur_seqs = []
+        phone_seqs = []
+        enc_seqs = self.encode_utts(total_parsed_labs, 'minmax')
+        for spk, dur_seq, lab_seq, codes in zip(total_parsed_spks,
+                                                total_parsed_durs,
+                                                total_parsed_labs, enc_seqs):
+            if len(dur_seq) == 0:
+                continue
+            if not hasattr(self, 'ling_feats_dim'):
+                self.ling_feats_dim = len(codes[0])
+                print('Setting ling feats dim: ', len(codes[0]))
+            utt_spks.append(self.spk2idx[spk])
+            code_seqs.append(np.array(codes, dtype=np.float32))
+            # normalize (or quantize) the whole sequence of durs at once
+            dur_seqs.append(self.process_dur(spk, np.array(dur_seq)))
+            # store reference to phoneme labels (to filter if needed)
+            phone_seqs.append(np.array([lab[:5] for lab in lab_seq]))
+        self.store_frames(utt_spks, code_seqs, dur_seqs, phone_seqs)
         print('-' * 50)
         end_t = timeit.default_timer()
         print('TCSTAR_dur-{} > Vectorized dur samples in {:.4f} '
               's'.format(self.split, end_t - beg_t))
         # All labs + durs are vectorized and stored at this point
 
+    def cache_params(self):
+        params = super(TCSTAR_dur, self).cache_params()
+        params['norm_dur'] = self.norm_dur
+        return params
+
     def process_dur(self, spk, dur):
+        """ Normalize (or quantize) a dur value or an array of durs """
         if not hasattr(self, 'spk2durstats'):
             self.spk2durstats = {}
         if self.norm_dur and not self.q_classes:
@@ -752,51 +1256,24 @@ class TCSTAR_dur(TCSTAR):
             #print('dur_stats: ', dur_stats)
             ndur = (dur - dur_stats['min']) / (dur_stats['max'] - \
                                                dur_stats['min'])
+            ndur = np.array(ndur, dtype=np.float32)
             if self.spk2idx[spk] not in self.spk2durstats:
                 # store ref to this speaker dur stats to denorm outside
                 self.spk2durstats[self.spk2idx[spk]] = dur_stats
         elif self.q_classes is not None:
             spk_clusters = self.speakers[spk]['dur_clusters']
-            # TODO: can do batch prediction, but nvm atm
-            ndur = spk_clusters.predict([[dur]])[0]
-            ndur = np.array(ndur, dtype=np.int64)
+            ndur = spk_clusters.predict(np.reshape(dur, (-1, 1)))
+            ndur = np.array(ndur, dtype=np.int64).reshape(np.shape(dur))
             if self.spk2idx[spk] not in self.spk2durstats:
                 self.spk2durstats[self.spk2idx[spk]] = spk_clusters
         else:
-            ndur = dur
+            ndur = np.array(dur, dtype=np.float32)
         return ndur
 
     def __getitem__(self, index):
-        if isinstance(self.vec_sample, dict):
-            # select hierarchicaly, first speaker, and then that speaker's sample
-            if not isinstance(index, tuple):
-                raise IndexError('Accessing MO Dataset with SO format. Use the '
-                                 'proper Sampler in your loader please.')
-            spk_key = index[1]
-            index = index[0]
-            return self.vec_sample[spk_key][index], \
-                   self.phone_sample[spk_key][index]
-        else:
-            # return seq of triplets (spk_idx, code, ndur) and 
-            # seq of (ph_id_str)
-            return self.vec_sample[index], self.phone_sample[index]
-
-    def __len__(self):
-        if isinstance(self.vec_sample, dict):
-            # sup up all keys length for final len on num of samples
-            total_samples = sum(len(spk_samples) for spkname, spk_samples in
-                                self.vec_sample.items())
-        else:
-            # directly compute list length
-            total_samples = len(self.vec_sample)
-        return total_samples
-
-    def len_by_spk(self):
-        if not isinstance(self.vec_sample, dict):
-            raise TypeError('Cannot get len_by_spk w/ SO format')
-        else:
-            lens = dict((k, len(v)) for k, v in self.vec_sample.items())
-            return lens
+        # return seq of triplets (spk_idx, code, ndur) and 
+        # (ph_ids, sil_flags) arrays
+        return self.frame_tuples(*self.get_window(index))
 
 
 class TCSTAR_aco(TCSTAR):
@@ -814,7 +1291,13 @@ class TCSTAR_aco(TCSTAR):
                  norm_aco=True,
                  aco_window_stride=80, aco_window_len=320, 
                  aco_frame_rate=16000, 
-                 seq2seq_lab=False):
+                 seq2seq_lab=False,
+                 window_mode='stride',
+                 window_stride=None,
+                 cache_dir=None,
+                 storage='dense',
+                 prefetch_depth=8,
+                 return_arrays=False):
         self.aco_window_stride = aco_window_stride
         self.aco_window_len = aco_window_len
         self.aco_frame_rate = aco_frame_rate
@@ -833,7 +1316,13 @@ class TCSTAR_aco(TCSTAR):
                                          exclude_train_spks=exclude_train_spks,
                                          exclude_eval_spks=exclude_eval_spks,
                                          batch_size=batch_size,
-                                         max_spk_samples=max_spk_samples)
+                                         max_spk_samples=max_spk_samples,
+                                         window_mode=window_mode,
+                                         window_stride=window_stride,
+                                         cache_dir=cache_dir,
+                                         storage=storage,
+                                         prefetch_depth=prefetch_depth,
+                                         return_arrays=return_arrays)
         #if self.max_seq_len is None:
         #    raise ValueError('TCSTAR_aco does not accept untrimmed seqs.'
         #                     'Please specify a max_seq_len')
@@ -873,238 +1362,104 @@ class TCSTAR_aco(TCSTAR):
                                               aco_dir=self.aco_dir)
         # Build label encoder (codebooks will be made if they don't exist or
         # if they are forced)
-        lab_enc = label_encoder(codebooks_path=lab_codebooks_path,
-                                lab_data=total_flat_labs,
-                                force_gen=self.force_gen)
+        lab_enc = self.build_lab_encoder(total_flat_labs)
         self.lab_enc = lab_enc
         end_t = timeit.default_timer()
         print('TCSTAR_aco-{} > Loaded lab codebooks in {:.4f} '
               's'.format(self.split, end_t - beg_t))
         # Encode all lab contents
-        # store vectorized sequences of samples of triplets (spk, lab, dur)
-        if self.mulout:
-            # separated by spk idx
-            self.vec_sample = {}
-            self.phone_sample = {}
-            if self.seq2seq_lab:
-                self.lab_sample = {}
-        else:
-            # all merged together
-            self.vec_sample = []
-            # store reference to phone identities (str)
-            self.phone_sample = []
-            if self.seq2seq_lab:
-                self.lab_sample = []
+        # store vectorized sequences of (spk, lab+dur, aco), one row per frame
         total_aco_seqs = 0
         for aco_ in total_parsed_aco:
             total_aco_seqs += len(aco_[0]) * len(aco_[1])
         print('TCSTAR_aco-{} > Vectorizing {} sequences..'
               '.'.format(self.split,
                          total_aco_seqs))
-        print('-' * 50)
-        print('Encoding aco samples with max_seq_len {} and batch_size '
-              '{}'.format(self.max_seq_len, self.batch_size))
-        if self.max_seq_len is None or self.batch_size is None:
-            assert not self.mulout
-            for spk, dur_seq, lab_seq, aco_seq, reldur_seq \
-                    in zip(total_parsed_spks, total_parsed_durs, 
-                                             total_parsed_labs,
-                                             total_parsed_aco,
-                                             total_parsed_reldur):
-                vec_seq = []
-                phone_seq = []
-                if self.seq2seq_lab:
-                    lab_seq = []
-                quit_seq = False
-                total_frames = 0
-                for t_, (dur, lab, aco, reldur) in enumerate(zip(dur_seq, 
-                                                                 lab_seq, 
-                                                                 aco_seq,
-                                                                 reldur_seq)):
-                    if quit_seq:
-                        break
-                    code = lab_enc(lab, normalize='znorm', sort_types=False)
-                    if not hasattr(self, 'ling_feats_dim'):
-                        self.ling_feats_dim = len(code)
-                        print('setting ACO ling feats dim: ',
-                              self.ling_feats_dim)
-                    for aco_ph, reldur_ph in zip(aco, reldur):
-                        # process aco outputs and absolute dur
-                        naco, nreldur = self.process_aco(spk, aco_ph, reldur_ph[1])
-                        if not hasattr(self, 'aco_feats_dim'):
-                            self.aco_feats_dim = len(naco)
-                            print('setting ACO aco feats dim: ', len(naco))
-                        nreldur = [reldur_ph[0], nreldur]
-                        phone_seq.append(lab[:5])
-                        vec_seq.append([self.spk2idx[spk], code + nreldur, \
-                                        np.array(naco.tolist(),
-                                                 dtype=np.float32)])
-                        total_frames += 1
-                        if self.max_seq_len is not None \
-                           and total_frames >= self.max_seq_len:
-                            quit_seq = True
-                            break
-                    # appending lab to ensure it goes after max_seq_len control
-                    if self.seq2seq_lab:
-                        lab_seq.append([self.spk2idx[spk], code])
-
-                self.vec_sample.append(vec_seq)
-                self.phone_sample.append(phone_seq)
-                if self.seq2seq_lab:
-                    self.lab_sample.append(lab_seq)
-        else:
-            # First, arrange all sequences into very long ones (per spk)
-            # Then split it into batch_size sequences, and arrange
-            # samples to follow batch_size interleaved samples (stateful)
-            all_code_seq = {}
-            all_phone_seq = {}
-            for spk, dur_seq, lab_seq, aco_seq, \
-                reldur_seq in zip(total_parsed_spks,
-                                  total_parsed_durs,
-                                  total_parsed_labs,
-                                  total_parsed_aco,
-                                  total_parsed_reldur):
-                #print('len(spk)=', len(spk))
-                #print('len(dur_seq)=', len(dur_seq))
-                #print('len(lab_seq)=', len(lab_seq))
-                #print('len(aco_seq)=', len(aco_seq))
-                #print('len(reldur_seq)=', len(reldur_seq))
-                for t_, (dur, lab, aco, reldur) in enumerate(zip(dur_seq, 
-                                                                 lab_seq, 
-                                                                 aco_seq,
-                                                                 reldur_seq)):
-                    #print('len(aco) = ', len(aco))
-                    #print('len(reldur) = ', len(reldur))
-                    #code = lab_enc(lab, normalize='minmax', sort_types=False)
-                    code = lab_enc(lab, normalize='znorm', sort_types=False)
-                    for aco_ph, reldur_ph in zip(aco, reldur):
-                        #print('len(reldur_ph)=', len(reldur_ph))
-                        #print('reldur_ph[0]=', reldur_ph[0])
-                        #print('reldur_ph[1]=', reldur_ph[1])
-                        # process aco outputs and absolute dur
-                        naco, nreldur = self.process_aco(spk, aco_ph, reldur_ph[1])
-                        #print('aco_ph = ', aco_ph)
-                        #print('naco = ', naco)
-                        nreldur = [reldur_ph[0], nreldur]
-                        if spk not in all_code_seq:
-                            all_code_seq[spk] = []
-                            all_phone_seq[spk] = []
-                        all_code_seq[spk].append([self.spk2idx[spk]] + code + nreldur + \
-                                                  naco.tolist())
-                        all_phone_seq[spk].append(lab[:5])
-                        if not hasattr(self, 'ling_feats_dim'):
-                            self.ling_feats_dim = len(code)
-                            print('setting ACO ling feats dim: ',
-                                  self.ling_feats_dim)
-                        if not hasattr(self, 'aco_feats_dim'):
-                            self.aco_feats_dim = len(naco)
-                            print('setting ACO aco feats dim: ', len(naco))
-            all_seq_len = {}
-            if self.trim_to_min:
-                # count each spks samples
-                counts = {}
-                counts_min = np.inf
-                counts_spk = None
-                #samples_cnt, min_cnt, min_spk = count_spk_samples(co_arr, ph_arr)
-                #print('samples_cnt: ', json.dumps(samples_cnt, indent=2))
-                #print('min_cnt: ', min_cnt)
-                #print('min_spk: ', min_spk)
-            for spkname, spkdata in all_code_seq.items():
-                # all_code_seq contains the large sequence of features (in, out)
-                all_seq_len[spkname] = len(spkdata)
-                print('{}: Length of all code_seq: '
-                      '{}'.format(spkname,
-                                  all_seq_len[spkname]))
-                # trim data to fit stateful arrangement
-                total_batches = all_seq_len[spkname] // (self.batch_size * \
-                                                         self.max_seq_len)
-                tri_code_seq = spkdata[:self.batch_size * self.max_seq_len * \
-                                        total_batches]
-                all_code_seq[spkname] = tri_code_seq
-                tri_phone_seq = all_phone_seq[spkname][:self.batch_size * \
-                                                       self.max_seq_len * \
-                                                       total_batches]
-                all_phone_seq[spkname] = tri_phone_seq
-                print('total stateful batches: ', total_batches)
-
-                # Create dict of data to statefulize codes and phones data
-                to_st_data = {'co':{'data':all_code_seq[spkname], 
-                                    'np_class':np.array},
-                              'ph':{'data':all_phone_seq[spkname],
-                                    'np_class':np.char.array}}
-                st_data = statefulize_data(to_st_data, self.batch_size,
-                                           self.max_seq_len)
-                co_arr = st_data['co']['st_data']
-                ph_arr = st_data['ph']['st_data']
-
-                # re-format data per speaker excluding padding symbols now
-                for phone_sample, vec_sample in zip(ph_arr, co_arr):
-                    vec_seq = []
-                    ph_seq = []
-                    for t_ in range(vec_sample.shape[0]):
-                        vec_seq_el = vec_sample[t_]
-                        ph_seq_el = phone_sample[t_]
-                        aco_i_t = vec_seq_el[-self.aco_feats_dim:]
-                        #if self.q_classes is not None:
-                        #    aco_i_t = np.array(aco_i_t, dtype=np.int64)
-                        vec_seq.append([vec_seq_el[0], vec_seq_el[1:-self.aco_feats_dim], 
-                                        aco_i_t])
-                        ph_seq.append(ph_seq_el.tolist())
-                    if self.mulout:
-                        spk_name = self.idx2spk[vec_seq_el[0]] 
-                        if spk_name not in self.vec_sample:
-                            self.vec_sample[spk_name] = []
-                            self.phone_sample[spk_name] = []
-                        self.vec_sample[spk_name].append(vec_seq)
-                        self.phone_sample[spk_name].append(ph_seq)
-                    else:
-                        self.vec_sample.append(vec_seq)
-                        self.phone_sample.append(ph_seq)
-                    if self.trim_to_min:
-                        spk_name = self.idx2spk[vec_seq_el[0]]
-                        if spk_name not in counts:
-                            counts[spk_name] = 0
-                        counts[spk_name] += 1
-            if self.trim_to_min or self.forced_trim is not None:
-                if self.forced_trim is not None:
-                    counts_min = self.forced_trim + 1
-                    counts_spk = 'Forced Trim'
-                else:
-                    for spk_name, cnt in counts.items():
-                        if counts[spk_name] < counts_min:
-                            counts_min = counts[spk_name]
-                            counts_spk = spk_name
-                print('-- Trimming speaker samples --')
-                print('counts_min: ', counts_min)
-                print('counts_spk: ', counts_spk)
-                print('len self.vec_sample prior to trim: ', len(self.vec_sample))
-                self.vec_sample, \
-                self.phone_sample = trim_spk_samples(self.vec_sample,
-                                                     self.phone_sample,
-                                                     counts_min,
-                                                     self.mulout)
-                if self.mulout:
-                    # go over all speaker ids and trim to max amount of samples
-                    for spkname, phsample in self.phone_sample.items():
-                        print('-' * 60)
-                        print('spk {} phsample len: {}'.format(spkname, len(phsample)))
-                        #for phs in phsample:
-                        #    print('{}|{}'.format(spkname, phs[2]), end=' ')
-                #else:
-                #    print('len self.vec_sample after trim: ', len(self.vec_sample))
-                #    first_vec_len = len(self.vec_sample[0])
-                #    raw_aco = []
-                #    for vi, vseq in enumerate(self.vec_sample):
-                #        for vsample in vseq:
-                #            raw_aco.append(vsample[1])
-                #np.save('/tmp/{}-aco.npy'.format(self.split), raw_aco)
+        beg_t = timeit.default_timer()
+        utt_spks = []
+        in_seqs = []
+        aco_seqs = []
+        phone_seqs = []
+        if self.seq2seq_lab:
+            # phone-level codes and frame -> phone correspondence
+            ph_code_seqs = []
+            frame2ph_seqs = []
+            num_phones = 0
+        enc_seqs = self.encode_utts(total_parsed_labs, 'znorm')
+        for spk, dur_seq, lab_seq, aco_seq, reldur_seq, enc_seq \
+                in zip(total_parsed_spks, total_parsed_durs, 
+                       total_parsed_labs, total_parsed_aco,
+                       total_parsed_reldur, enc_seqs):
+            # phones without aligned frames are dropped (like zip does)
+            num_ph = min(len(dur_seq), len(lab_seq), len(aco_seq),
+                         len(reldur_seq))
+            if num_ph == 0:
+                continue
+            codes = enc_seq[:num_ph]
+            if not hasattr(self, 'ling_feats_dim'):
+                self.ling_feats_dim = codes.shape[1]
+                print('setting ACO ling feats dim: ',
+                      self.ling_feats_dim)
+            ph_frames = [len(aco_ph) for aco_ph in aco_seq[:num_ph]]
+            aco = np.concatenate([np.array(aco_ph, dtype=np.float32) \
+                                  for aco_ph in aco_seq[:num_ph]])
+            reldur = np.array([reldur_t for reldur_ph in reldur_seq[:num_ph] \
+                               for reldur_t in reldur_ph], dtype=np.float32)
+            # process aco outputs and absolute dur of the whole sequence
+            naco, ndur = self.process_aco(spk, aco, reldur[:, 1])
+            if not hasattr(self, 'aco_feats_dim'):
+                self.aco_feats_dim = naco.shape[1]
+                print('setting ACO aco feats dim: ', self.aco_feats_dim)
+            # every frame is fed with its phone code + (reldur, dur)
+            in_seq = np.concatenate((np.repeat(codes, ph_frames, axis=0),
+                                     reldur[:, :1], ndur.reshape(-1, 1)),
+                                    axis=1)
+            utt_spks.append(self.spk2idx[spk])
+            in_seqs.append(in_seq.astype(np.float32))
+            aco_seqs.append(naco.astype(np.float32))
+            phone_seqs.append(np.repeat(np.array([lab[:5] for lab in \
+                                                  lab_seq[:num_ph]]),
+                                        ph_frames, axis=0))
+            if self.seq2seq_lab:
+                ph_code_seqs.append(codes)
+                frame2ph_seqs.append(np.repeat(np.arange(num_phones,
+                                                         num_phones + num_ph),
+                                               ph_frames))
+                num_phones += num_ph
+        self.store_frames(utt_spks, in_seqs, aco_seqs, phone_seqs)
+        if self.seq2seq_lab:
+            self.ph_codes = np.concatenate(ph_code_seqs, axis=0)
+            self.frame2ph = np.concatenate(frame2ph_seqs)
         print('-' * 50)
         end_t = timeit.default_timer()
         print('TCSTAR_aco-{} > Vectorized dur samples in {:.4f} '
               's'.format(self.split, end_t - beg_t))
-        print('Total aco samples: ', len(self.vec_sample))
+        print('Total aco frames: ', self.in_frames.shape[0])
         # All labs + durs are vectorized and stored at this point
-        # store labs reference with speaker ID
+
+    def input_files(self):
+        files = super(TCSTAR_aco, self).input_files()
+        for sname in sorted(self.speakers.keys()):
+            for split_id in self.split_samples(self.speakers[sname]):
+                files += aco_file_paths(sname, split_id, self.aco_dir)
+        return files
+
+    def cache_params(self):
+        params = super(TCSTAR_aco, self).cache_params()
+        params.update({'aco_dir':os.path.abspath(self.aco_dir),
+                       'norm_aco':self.norm_aco,
+                       'aco_window_stride':self.aco_window_stride,
+                       'aco_window_len':self.aco_window_len,
+                       'aco_frame_rate':self.aco_frame_rate,
+                       'seq2seq_lab':self.seq2seq_lab})
+        return params
+
+    def cache_arrays(self):
+        arrays = super(TCSTAR_aco, self).cache_arrays()
+        if self.seq2seq_lab:
+            arrays['ph_codes'] = self.ph_codes
+            arrays['frame2ph'] = self.frame2ph
+        return arrays
 
     def process_aco(self, spk, aco, dur):
         if not hasattr(self, 'spk2acostats'):
@@ -1136,42 +1491,15 @@ class TCSTAR_aco(TCSTAR):
         return naco, ndur
 
     def __getitem__(self, index):
-        try:
-            if isinstance(self.vec_sample, dict):
-                # select hierarchicaly, first speaker, and then that speaker's sample
-                if not isinstance(index, tuple):
-                    raise IndexError('Accessing MO Dataset with SO format. Use the '
-                                     'proper Sampler in your loader please.')
-                spk_key = index[1]
-                index = index[0]
-                return self.vec_sample[spk_key][index], \
-                       self.phone_sample[spk_key][index]
-            else:
-                # return seq of triplets (spk_idx, code+dur, aco) and 
-                # seq of (ph_id_str)
-                if self.seq2seq_lab:
-                    return self.vec_sample[index], self.phone_sample[index], \
-                           self.lab_sample[index]
-                else:
-                    return self.vec_sample[index], self.phone_sample[index]
-        except IndexError:
-            print('Error accessing {}:{}'.format(spk_key, index))
-            raise
-
-    def __len__(self):
-        if isinstance(self.vec_sample, dict):
-            # sup up all keys length for final len on num of samples
-            total_samples = sum(len(spk_samples) for spkname, spk_samples in
-                                self.vec_sample.items())
-        else:
-            # directly compute list length
-            total_samples = len(self.vec_sample)
-        return total_samples
-
-    def len_by_spk(self):
-        if not isinstance(self.vec_sample, dict):
-            raise TypeError('Cannot get len_by_spk w/ SO format')
-        else:
-            lens = dict((k, len(v)) for k, v in self.vec_sample.items())
-            return lens
-
+        beg, end, spk_idx = self.get_window(index)
+        # return seq of triplets (spk_idx, code+dur, aco) and 
+        # (ph_ids, sil_flags) arrays
+        vec_seq, phone_seq = self.frame_tuples(beg, end, spk_idx)
+        if self.seq2seq_lab:
+            # phones touched by the window frames
+            ph_beg = self.frame2ph[beg]
+            ph_end = self.frame2ph[end - 1] + 1
+            lab_seq = [[spk_idx, code] for code in \
+                       self.ph_codes[ph_beg:ph_end]]
+            return vec_seq, phone_seq, lab_seq
+        return vec_seq, phone_seq
@@ -7,11 +7,15 @@ import pdb
 import struct
 
 
+def parse_bin_aco(aco_bs):
+    """ Decode the float32 contents of a binary aco file """
+    num_floats = int(len(aco_bs) / 4)
+    return np.frombuffer(aco_bs[:num_floats * 4], dtype=np.float32).copy()
+
 def read_bin_aco_file(aco_filename):
     with open(aco_filename, 'rb') as aco_f:
-        aco_bs = aco_f.read()
-        aco_data = struct.unpack('{}f'.format(int(len(aco_bs) / 4)), aco_bs)
-        return np.array(aco_data, dtype=np.float32)
+        return parse_bin_aco(aco_f.read())
+
 
 class label_encoder(object):
 
@@ -133,6 +137,37 @@ class label_encoder(object):
                     raise
         return codebooks
 
+    def codebooks_changes(self, lab_data):
+        """ Compare the loaded codebooks with the ones lab_data would
+            make, without modifying them: unseen categorical symbols
+            (which would change the encoded dimension) and different
+            real values stats (which would change the normalization).
+
+            # Arguments
+                lab_data: list of label features extracted with parser
+
+            # Return
+                list of the changes found (empty if none)
+        """
+        new_codebooks = self.make_codebooks(lab_data)
+        changes = []
+        for cbook, new_cbook in sorted(new_codebooks.items()):
+            lab_i = self.codebook_name.index(cbook) + 1
+            if cbook not in self.codebooks:
+                changes.append('new codebook {}'.format(cbook))
+            elif self.lab_format[lab_i] == 'cate':
+                unseen = [lab_el for lab_el in new_cbook \
+                          if lab_el not in self.codebooks[cbook]]
+                if len(unseen) > 0:
+                    changes.append('{} unseen symbols in {}'.format(len(unseen),
+                                                                   cbook))
+            else:
+                old_cbook = self.codebooks[cbook]
+                if any(not np.isclose(old_cbook[k], new_cbook[k]) \
+                       for k in ['mean', 'std', 'min', 'max']):
+                    changes.append('stats of {}'.format(cbook))
+        return changes
+
     def __call__(self, lab_line, normalize='nonorm', sort_types=True,
                  verbose=False):
         return self.encode(lab_line, normalize=normalize, verbose=verbose,
@@ -472,6 +507,34 @@ def trim_spk_samples(spk_samples, spk_phones, min_count, mulout):
                 spk_counts[spk_id] += 1
     return trim_samples, trim_phones
 
+def stateful_offsets(batch_size, seq_len, num_chunks):
+    """ Stream offsets of the stateful windows, in serving order: the
+        stream is split in batch_size rows of num_chunks * seq_len
+        frames, and window k is chunk k // batch_size of row
+        k % batch_size.
+    """
+    chunk, row = np.divmod(np.arange(num_chunks * batch_size), batch_size)
+    return (row * num_chunks + chunk) * seq_len
+
+def stateful_view(data_arr, batch_size, seq_len):
+    """ (num_chunks, batch_size, seq_len, ...) strided view of a
+        contiguous stream array (trailing frames that do not fill a
+        whole chunk of every row are left out). Nothing is copied.
+    """
+    data_arr = np.ascontiguousarray(data_arr)
+    num_chunks = data_arr.shape[0] // (batch_size * seq_len)
+    frame_stride = data_arr.strides[0]
+    return np.lib.stride_tricks.as_strided(data_arr,
+                                           shape=(num_chunks, batch_size,
+                                                  seq_len) + \
+                                                 data_arr.shape[1:],
+                                           strides=(seq_len * frame_stride,
+                                                    num_chunks * seq_len * \
+                                                    frame_stride,
+                                                    frame_stride) + \
+                                                   data_arr.strides[1:],
+                                           writeable=False)
+
 def statefulize_data(data, batch_size, seq_len):
     assert isinstance(data, dict), type(data)
     st_data = dict(data)
@@ -479,14 +542,10 @@ def statefulize_data(data, batch_size, seq_len):
         data_vals = datav['data']
         np_class = datav['np_class']
         data_arr = np_class(data_vals)
-        #print('data_arr shape: ', data_arr.shape)
-        #print('np type of {}: {}'.format(datak, type(data_arr)))
-        data_arr = data_arr.reshape((batch_size, -1, data_arr.shape[-1]))
-        #print('{}_arr shape: {}'.format(datak, data_arr.shape))
-        data_arr = np.split(data_arr, data_arr.shape[1] // seq_len, axis=1)
-        #print('Interleaved {}_arr[0] shape: {}'.format(datak, data_arr[0].shape))
-        data_arr = np.concatenate(data_arr, axis=0)
-        #print('Interleaved {}_arr:{}'.format(datak, data_arr.shape))
+        # interleave the batch rows chunks through a strided view, and
+        # only copy once to flatten (chunk, row) into the first axis
+        data_arr = stateful_view(data_arr, batch_size, seq_len)
+        data_arr = data_arr.reshape((-1,) + data_arr.shape[2:])
         st_data[datak]['st_data'] = data_arr
     return st_data
 
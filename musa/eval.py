@@ -1,5 +1,5 @@
 import numpy as np
-from sklearn.metrics import f1_score, precision_score, recall_score
+from .metrics import afpr, mcd
 
 
 def RMSE(groundtruth, prediction, mask=None):
@@ -30,12 +30,8 @@ def AFPR(groundtruth, prediction):
     groundtruth = np.array(groundtruth)
     prediction = np.array(prediction)
     assert groundtruth.shape == prediction.shape
-    # A: accuracy
-    I = np.mean(groundtruth == prediction)
-    F = f1_score(groundtruth, prediction)
-    P = precision_score(groundtruth, prediction)
-    R = recall_score(groundtruth, prediction)
-    return I, F, P, R
+    res = afpr(prediction, groundtruth)
+    return res['A'], res['F'], res['P'], res['R']
 
 
 def MCD(gt_cep, pr_cep):
@@ -43,13 +39,4 @@ def MCD(gt_cep, pr_cep):
     Mean Cepstral Distortion
     Input are matrices with shape (time, cc_dim)
     """
-    MCD = 0
-    for t in xrange(gt_cep.shape[0]):
-        acum = 0
-        for n in xrange(gt_cep.shape[1]):
-            acum += (gt_cep[t, n]-pr_cep[t, n])**2
-        MCD += np.sqrt(acum)
-    # scale factor
-    alpha = ((10.*np.sqrt(2))/(gt_cep.shape[0]*np.log(10)))
-    MCD = alpha*MCD
-    return MCD
+    return mcd(np.asarray(pr_cep), np.asarray(gt_cep))
@@ -0,0 +1,363 @@
+import torch
+import numpy as np
+from .utils import frames_mask, DenormTable
+
+
+# 10 * sqrt(2) / ln(10): MCD [dB] from the mean cepstral distance
+MCD_ALPHA = (10. * np.sqrt(2)) / np.log(10)
+
+def spk_key(spk, idx2spk=None):
+    """ Key of a speaker idx in the per-speaker results """
+    if idx2spk is not None:
+        return idx2spk[int(spk)]
+    return str(spk)
+
+def group_spks(spks):
+    """ Sorted unique speakers of the frames, and the group of every
+        frame (its idx in them)
+    """
+    return np.unique(np.asarray(spks).reshape(-1), return_inverse=True)
+
+def segment_sum(values, groups, num_groups):
+    """ Sums of the (N,) or (N, K) values rows of every group """
+    if values.ndim == 1:
+        return np.bincount(groups, weights=values, minlength=num_groups)
+    return np.stack([np.bincount(groups, weights=values[:, k],
+                                 minlength=num_groups)
+                     for k in range(values.shape[1])], axis=1)
+
+def afpr_from_counts(n, tp, fp, fn):
+    """ Accuracy, F1, Precision and Recall of binary predictions from
+        their counts (0 when undefined, as sklearn does)
+    """
+    def safe_div(num, den):
+        return float(num / den) if den > 0 else 0.
+    return {'A':safe_div(n - fp - fn, n),
+            'F':safe_div(2 * tp, 2 * tp + fp + fn),
+            'P':safe_div(tp, tp + fp),
+            'R':safe_div(tp, tp + fn)}
+
+def binary_counts(prediction, groundtruth):
+    """ (N, 3) TP, FP and FN flags of every binary prediction """
+    pred = np.asarray(prediction).reshape(-1) == 1
+    gtruth = np.asarray(groundtruth).reshape(-1) == 1
+    return np.stack((pred & gtruth, pred & ~gtruth, ~pred & gtruth),
+                    axis=1).astype(np.float64)
+
+def rmse(prediction, groundtruth, spks=None, idx2spk=None):
+    """ Root Mean Squared Error of (N,) or (N, 1) predictions, and of
+        each speaker if spks given (returns total, spk dict)
+    """
+    assert prediction.shape == groundtruth.shape
+    sqerr = (np.asarray(groundtruth, dtype=np.float64) - prediction) ** 2
+    # global
+    D = np.sqrt(np.mean(sqerr, axis=0)).item()
+    if spks is None:
+        return D
+    spk_ids, groups = group_spks(spks)
+    sums = segment_sum(sqerr.reshape(-1), groups, len(spk_ids))
+    counts = np.bincount(groups, minlength=len(spk_ids))
+    spk_res = {}
+    for spk, sqsum, count in zip(spk_ids, sums, counts):
+        spk_res[spk_key(spk, idx2spk)] = float(np.sqrt(sqsum / count))
+    return D, spk_res
+
+def accuracy(prediction, groundtruth):
+    return afpr(prediction, groundtruth)['A']
+
+def fpr(prediction, groundtruth):
+    """ Compute F-measure, Precision and Recall """
+    res = afpr(prediction, groundtruth)
+    return res['F'], res['P'], res['R']
+
+def afpr(prediction, groundtruth, spks=None, idx2spk=None):
+    """ Accuracy, F1, Precision and Recall of binary predictions. With
+        spks, they are keyed as '<metric>.<spk>' and '<metric>.total'
+        (also grouped in 'total')
+    """
+    assert prediction.shape == groundtruth.shape
+    counts = binary_counts(prediction, groundtruth)
+    total = afpr_from_counts(len(counts), *counts.sum(axis=0))
+    if spks is None:
+        return total
+    spk_ids, groups = group_spks(spks)
+    sums = segment_sum(counts, groups, len(spk_ids))
+    nums = np.bincount(groups, minlength=len(spk_ids))
+    spk_res = {}
+    for spk, spk_counts, num in zip(spk_ids, sums, nums):
+        for k, v in afpr_from_counts(num, *spk_counts).items():
+            spk_res['{}.{}'.format(k, spk_key(spk, idx2spk))] = v
+    spk_res['total'] = {}
+    for k, v in total.items():
+        spk_res['{}.total'.format(k)] = v
+        spk_res['total']['{}.total'.format(k)] = v
+    return spk_res
+
+def mcd(prediction, groundtruth, spks=None, idx2spk=None):
+    """ Mean Cepstral Distortion [dB]
+        Inputs are matrices of shape (time, cc_order). With spks,
+        returns the MCD of each speaker and 'total'
+    """
+    assert prediction.shape == groundtruth.shape
+    diff = np.asarray(groundtruth, dtype=np.float64) - prediction
+    dists = np.sqrt(np.sum(diff ** 2, axis=1))
+    total = float(MCD_ALPHA * np.mean(dists))
+    if spks is None:
+        return total
+    spk_ids, groups = group_spks(spks)
+    sums = segment_sum(dists, groups, len(spk_ids))
+    counts = np.bincount(groups, minlength=len(spk_ids))
+    spk_res = {}
+    for spk, dsum, count in zip(spk_ids, sums, counts):
+        spk_res[spk_key(spk, idx2spk)] = float(MCD_ALPHA * dsum / count)
+    spk_res['total'] = total
+    return spk_res
+
+
+class MetricAccumulator(object):
+    """ Per-speaker sums of per-frame statistics of the eval batches,
+        kept in the device of the predictions (padding frames are
+        multiplied out instead of indexed, so there is no sync). Metrics
+        are computed from them at the end, in constant memory.
+
+        # Arguments
+            num_spks: num of speaker idxs (rows of the sums).
+            idx2spk: speaker names to key the per-speaker results
+                     (str of the idx if None).
+            hist_frames: size of the uniform random sample of frames kept
+                         for the histograms (0 keeps none).
+    """
+
+    def __init__(self, num_spks, idx2spk=None, hist_frames=0):
+        self.num_spks = num_spks
+        self.idx2spk = idx2spk
+        self.hist_frames = hist_frames
+        self.reset()
+
+    def reset(self):
+        self.sums = None
+        self.hist = None
+        self.hist_keys = None
+
+    def state_dict(self):
+        return {'sums':self.sums, 'hist':self.hist,
+                'hist_keys':self.hist_keys}
+
+    def load_state_dict(self, state):
+        # tensors are moved to the device of the next batch
+        self.sums = state['sums']
+        self.hist = state['hist']
+        self.hist_keys = state['hist_keys']
+
+    def accumulate(self, stats, valid, spk_b, hist=None):
+        """ Add (T, B, K) statistics of the valid (T, B) frames to the
+            sums of their speakers, and sample the (T, B, F) hist frames
+        """
+        valid = valid.to(stats.dtype).unsqueeze(-1)
+        # first column counts the frames
+        stats = torch.cat((valid, stats * valid), dim=-1)
+        stats = stats.view(-1, stats.size(-1)).double()
+        if self.sums is None:
+            self.sums = torch.zeros(self.num_spks, stats.size(1),
+                                    dtype=torch.float64,
+                                    device=stats.device)
+        self.sums = self.sums.to(stats.device)
+        self.sums.index_add_(0, spk_b.reshape(-1).long(), stats)
+        if hist is not None and self.hist_frames > 0:
+            self.sample_hist(hist, valid.view(-1) > 0)
+
+    def sample_hist(self, frames, valid):
+        # keep the frames with the top hist_frames random keys seen so
+        # far (padding gets negative keys and is filtered out at the end)
+        frames = frames.reshape(-1, frames.size(-1))
+        keys = torch.rand(frames.size(0), device=frames.device)
+        keys = torch.where(valid, keys, torch.full_like(keys, -1.))
+        if self.hist is not None:
+            frames = torch.cat((self.hist.to(frames.device), frames), dim=0)
+            keys = torch.cat((self.hist_keys.to(keys.device), keys), dim=0)
+        self.hist_keys, top = torch.topk(keys, min(self.hist_frames,
+                                                   keys.size(0)))
+        self.hist = frames[top]
+
+    def hist_sample(self):
+        """ Sampled frames for the histograms, as a numpy (N, F) matrix """
+        if self.hist is None:
+            return None
+        return self.hist[self.hist_keys >= 0].cpu().numpy()
+
+    def spk_sums(self):
+        """ Dict of sums rows of the evaluated speakers (keyed by name),
+            and total sums row
+        """
+        sums = self.sums.cpu().numpy()
+        spk_sums = {}
+        for spk_idx in np.where(sums[:, 0] > 0)[0]:
+            spk_sums[spk_key(spk_idx, self.idx2spk)] = sums[spk_idx]
+        return spk_sums, sums.sum(axis=0)
+
+    @property
+    def num_frames(self):
+        if self.sums is None:
+            return 0
+        return int(self.sums[:, 0].sum().item())
+
+    def rmse(self, col):
+        """ RMSE from a column of squared errors: total, spk dict """
+        spk_sums, total = self.spk_sums()
+        spk_res = dict((spk, float(np.sqrt(sums[col] / sums[0])))
+                       for spk, sums in spk_sums.items())
+        return float(np.sqrt(total[col] / total[0])), spk_res
+
+
+class AcoMetricAccumulator(MetricAccumulator):
+    """ Accumulate the MCD, F0 RMSE and U/V AFPR of de-normalized aco
+        predictions, with and without silence frames. As in the former
+        metrics over the whole eval set, silence frames are masked by
+        zeroing both prediction and groundtruth: they still count in the
+        denominators (as exact predictions).
+
+        # Arguments
+            spk2acostats: aco normalization stats of every speaker idx.
+            n_cc: num of cepstral coefs (first features) in the MCD.
+            audio_frames: num of first predicted frames of the eval
+                          sequences kept in order to synthesize audio.
+    """
+    # columns of the accumulated sums (0 counts the frames)
+    CC, F0, TP, FP, FN, NOSIL = 1, 2, 3, 4, 5, 6
+    # offset of the non-silence (masked) columns
+    MASKED = 6
+
+    def __init__(self, spk2acostats, idx2spk=None, n_cc=40,
+                 hist_frames=0, audio_frames=0):
+        self.denorm = DenormTable.from_aco_stats(spk2acostats)
+        super().__init__(self.denorm.num_spks, idx2spk, hist_frames)
+        self.n_cc = n_cc
+        self.audio_frames = audio_frames
+
+    def reset(self):
+        super().reset()
+        self.synth_frames = []
+
+    def state_dict(self):
+        state = super().state_dict()
+        state['synth_frames'] = list(self.synth_frames)
+        return state
+
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        self.synth_frames = list(state['synth_frames'])
+
+    def update(self, y, aco_b, slen_b, spk_b, sil_b):
+        """ Accumulate a time-major batch of normalized predictions y """
+        device = y.device
+        T = y.size(0)
+        spk_b = spk_b[:T].to(device).long()
+        valid = frames_mask(slen_b.to(device), T)
+        nosil = (~sil_b[:T].to(device).bool()).float()
+        pred = self.denorm(y, spk_b)
+        gtruth = self.denorm(aco_b[:T].to(device), spk_b)
+        cc_dist = (pred[:, :, :self.n_cc] - \
+                   gtruth[:, :, :self.n_cc]).pow(2).sum(dim=-1).sqrt()
+        f0_err = (torch.exp(pred[:, :, -2]) - \
+                  torch.exp(gtruth[:, :, -2])).pow(2)
+        uv_pred = torch.round(pred[:, :, -1]) == 1
+        uv_gtruth = gtruth[:, :, -1] == 1
+        tp = (uv_pred & uv_gtruth).float()
+        fp = (uv_pred & ~uv_gtruth).float()
+        fn = (~uv_pred & uv_gtruth).float()
+        stats = torch.stack((cc_dist, f0_err, tp, fp, fn, nosil,
+                             cc_dist * nosil, f0_err * nosil, tp * nosil,
+                             fp * nosil, fn * nosil), dim=-1)
+        self.accumulate(stats, valid, spk_b,
+                        torch.cat((pred, gtruth), dim=-1))
+        if len(self.synth_frames) < self.audio_frames:
+            # sequences are kept whole and in order (syncs with the
+            # device only until the first audio_frames are filled)
+            pred_npy = pred.cpu().numpy()
+            slens = slen_b.cpu().numpy()
+            for ith in range(pred_npy.shape[1]):
+                self.synth_frames.extend(pred_npy[:slens[ith], ith])
+                if len(self.synth_frames) >= self.audio_frames:
+                    break
+
+    def mcd(self, nosil=False):
+        """ MCD [dB] of each speaker (keyed by name) and 'total' """
+        col = self.CC + (self.MASKED if nosil else 0)
+        spk_sums, total = self.spk_sums()
+        spk_res = dict((spk, float(MCD_ALPHA * sums[col] / sums[0]))
+                       for spk, sums in spk_sums.items())
+        spk_res['total'] = float(MCD_ALPHA * total[col] / total[0])
+        return spk_res
+
+    def f0_rmse(self, nosil=False):
+        """ F0 RMSE [Hz]: total, spk dict """
+        return self.rmse(self.F0 + (self.MASKED if nosil else 0))
+
+    def afpr(self, nosil=False):
+        """ U/V A, F1, P and R keyed as '<metric>.<spk>' and
+            '<metric>.total' (also grouped in 'total')
+        """
+        off = self.MASKED if nosil else 0
+        cols = [0, self.TP + off, self.FP + off, self.FN + off]
+        spk_sums, total = self.spk_sums()
+        spk_res = {}
+        for spk, sums in spk_sums.items():
+            for k, v in afpr_from_counts(*sums[cols]).items():
+                spk_res['{}.{}'.format(k, spk)] = v
+        spk_res['total'] = {}
+        for k, v in afpr_from_counts(*total[cols]).items():
+            spk_res['{}.total'.format(k)] = v
+            spk_res['total']['{}.total'.format(k)] = v
+        return spk_res
+
+    def nosil_ratio(self):
+        """ Ratio of non-silence frames """
+        _, total = self.spk_sums()
+        return float(total[self.NOSIL] / total[0])
+
+    def audio_preds(self):
+        """ (N, D) de-normalized predictions of the first sequences """
+        return np.array(self.synth_frames[:self.audio_frames])
+
+
+class DurMetricAccumulator(MetricAccumulator):
+    """ Accumulate the RMSE of de-normalized (or de-quantized) dur
+        predictions, with and without silence phones (masked by zeroing
+        both prediction and groundtruth, as in AcoMetricAccumulator)
+
+        # Arguments
+            spk2durstats: dur normalization stats (or KMeans with the
+                          quantization centroids) of every speaker idx.
+    """
+    # columns of the accumulated sums (0 counts the frames)
+    SQERR, NOSIL_SQERR = 1, 2
+
+    def __init__(self, spk2durstats, idx2spk=None, q_classes=False,
+                 hist_frames=0):
+        self.denorm = DenormTable.from_dur_stats(spk2durstats, q_classes)
+        super().__init__(self.denorm.num_spks, idx2spk, hist_frames)
+        self.q_classes = q_classes
+
+    def update(self, y, dur_b, slen_b, spk_b, sil_b):
+        """ Accumulate a time-major batch of normalized predictions y
+            ((T, B), or (T, B, q_classes) scores)
+        """
+        device = y.device
+        T = y.size(0)
+        spk_b = spk_b[:T].to(device).long()
+        valid = frames_mask(slen_b.to(device), T)
+        nosil = (~sil_b[:T].to(device).bool()).float()
+        dur_b = dur_b[:T].to(device)
+        if self.q_classes:
+            # predicted classes are mapped to their centroids
+            y = torch.argmax(y, dim=-1)
+        pred = self.denorm(y, spk_b)
+        gtruth = self.denorm(dur_b, spk_b)
+        sqerr = (pred - gtruth).pow(2)
+        stats = torch.stack((sqerr, sqerr * nosil), dim=-1)
+        self.accumulate(stats, valid, spk_b,
+                        torch.stack((pred, gtruth), dim=-1))
+
+    def dur_rmse(self, nosil=False):
+        """ Dur RMSE [s]: total, spk dict """
+        return self.rmse(self.NOSIL_SQERR if nosil else self.SQERR)
@@ -65,6 +65,9 @@ class acoustic_rnn(speaker_model):
                  mulout=False, cuda=False,
                  bnorm=False,
                  emb_layers=2):
+        if mulout:
+            # every speaker is one output (as in duration_rnn)
+            mulspk_type = 'mulout'
         super().__init__(num_inputs, mulspk_type, 
                          speakers=speakers,
                          cuda=cuda)
@@ -88,23 +91,32 @@ class acoustic_rnn(speaker_model):
         self.build_output(rnn_output=True)
 
     def forward(self, dling_features, hid_state=None, out_state=None,
-                speaker_idx=None):
+                speaker_idx=None, out_spks=None):
         """ Forward the duration + linguistic features, and the speaker ID
             # Arguments
                 dling_features: Tensor with encoded linguistic features and
                 duration (absolute + relative)
                 speaker_id: Tensor with speaker idx to be generated
+                out_spks: speaker name of every row of a packed MO batch.
+                          Each row only goes through the output of its
+                          speaker, with out_state (and the returned y)
+                          packed for all the rows, not a dict.
         """
-        if self.mulout and out_state is not None:
+        routed = self.mulout and out_spks is not None
+        if self.mulout and not routed and out_state is not None:
             assert isinstance(out_state, dict), type(out_state)
-        if self.mulout and out_state is None:
+        if self.mulout and not routed and out_state is None:
             out_state = dict((spk, None) for spk in self.speakers)
         # forward through embedding
         x = self.forward_input_embedding(dling_features, speaker_idx)
         # forward through RNN core
         x, hid_state = self.forward_core(x, hid_state)
         # forward through output RNN
-        if self.mulout:
+        if routed:
+            y, nout_state = self.forward_routed_output(x, out_spks,
+                                                       out_state)
+            y = tanh2sigmoid(y)
+        elif self.mulout:
             y = {}
             nout_state = {}
             for spk in self.speakers:
@@ -125,13 +137,16 @@ class acoustic_rnn(speaker_model):
             #y = y.view(dling_features.size(0), -1, self.num_outputs)
         return y, hid_state, nout_state
 
+    def inference_forward(self, dling_features, speaker_idx=None):
+        y, _, _ = self(dling_features, None, None, speaker_idx=speaker_idx)
+        return y
 
     def init_hidden_state(self, curr_bsz):
         return (torch.zeros(self.rnn_layers, curr_bsz, self.rnn_size),
                 torch.zeros(self.rnn_layers, curr_bsz, self.rnn_size))
 
-    def init_output_state(self, curr_bsz):
-        if self.mulout:
+    def init_output_state(self, curr_bsz, packed=False):
+        if self.mulout and not packed:
             # return dict of output states, one per spk
             out_states = {}
             for spk in self.speakers:
@@ -210,28 +225,35 @@ class acoustic_satt(speaker_model):
 
     def forward(self, dling_features, 
                 speaker_idx=None,
-                pe_start_idx=0):
+                pe_start_idx=0,
+                segments=None,
+                positions=None):
         """ Forward the duration + linguistic features, and the speaker ID
             # Arguments
                 dling_features: Tensor with encoded linguistic features and
                 duration (absolute + relative)
                 speaker_id: Tensor with speaker idx to be generated
+                segments: (T, B) ids of the sequences packed in every
+                row (0 for padding), which only attend to themselves.
+                positions: (T, B) positions of the frames within their
+                packed sequence (overrides pe_start_idx).
         """
-        # states are ignored, nothing useful is carried there
-        if self.mulout and out_state is not None:
-            assert isinstance(out_state, dict), type(out_state)
-        if self.mulout and out_state is None:
-            out_state = dict((spk, None) for spk in self.speakers)
         # forward through embedding
         x = self.forward_input_embedding(dling_features, speaker_idx)
+        # attention runs batch-major: the only layout change of the model
         x = x.transpose(0, 1)
+        if positions is not None:
+            positions = positions.transpose(0, 1)
         if hasattr(self, 'position'):
-            x = self.position(x, pe_start_idx)
+            x = self.position(x, pe_start_idx, positions)
+        mask = None
+        if segments is not None:
+            mask = segment_mask(segments.transpose(0, 1))
         #print('x size: ', x.size())
         h = x
         # Now we will forward through the transformer encoder structure
         for layer in self.model:
-            h = layer(h, None)
+            h = layer(h, mask)
         #print('h size: ', h.size())
         if hasattr(self, 'norm'):
             h = self.norm(h)
@@ -246,6 +268,9 @@ class acoustic_satt(speaker_model):
         y = y.transpose(0, 1)
         return y
 
+    def inference_forward(self, dling_features, speaker_idx=None):
+        return self(dling_features, speaker_idx=speaker_idx)
+
 class acoustic_decoder_satt(speaker_model):
     # TODO: Check validity of this model in terms of seq2seq behavior
     def __init__(self, num_inputs, emb_size=512, 
@@ -311,11 +336,6 @@ class acoustic_decoder_satt(speaker_model):
                 duration (absolute + relative)
                 speaker_id: Tensor with speaker idx to be generated
         """
-        # states are ignored, nothing useful is carried there
-        if self.mulout and out_state is not None:
-            assert isinstance(out_state, dict), type(out_state)
-        if self.mulout and out_state is None:
-            out_state = dict((spk, None) for spk in self.speakers)
         # forward through embedding
         x = self.forward_input_embedding(dling_features, speaker_idx)
         x = x.transpose(0, 1)
@@ -5,11 +5,24 @@ import torch.nn.functional as F
 import torch.nn as nn
 import copy
 import math
+import json
 import os
+import warnings
+import zipfile
 
 
 class speaker_model(nn.Module):
 
+    def __new__(cls, *args, **kwargs):
+        model = super().__new__(cls)
+        # constructor arguments, to rebuild the model from a checkpoint
+        # with its state_dict (see load_model)
+        object.__setattr__(model, 'model_config',
+                           {'model':cls.__name__,
+                            'args':list(args),
+                            'kwargs':dict(kwargs)})
+        return model
+
     def __init__(self, num_inputs, mulspk_type, speakers=None, cuda=False):
         super(speaker_model, self).__init__()
         """
@@ -49,7 +62,14 @@ class speaker_model(nn.Module):
         torch.save(self, out_fpath)
 
     def load(self, model_file):
-        self.load_state_dict(torch.load(model_file))
+        state = torch.load(model_file, map_location='cpu')
+        if 'state_dict' in state:
+            # checkpoint with the model config
+            state = state['state_dict']
+        # positional encodings are recomputed, not stored anymore
+        state = dict((k, v) for k, v in state.items() \
+                     if not k.endswith('position.pe'))
+        self.load_state_dict(state)
 
     def describe_model(self):
         pytorch_total_params = sum(p.numel() for p in self.parameters() if
@@ -122,9 +142,8 @@ class speaker_model(nn.Module):
             ]
 
     def forward_input_embedding(self, dling_features, speaker_idx):
-        # inputs are time-major (Seqlen, Bsize, features)
-        dling_features = dling_features.transpose(0, 1)
-        speaker_idx = speaker_idx.transpose(0, 1)
+        # inputs are time-major (Seqlen, Bsize, features), and so is
+        # the output: the projections are applied frame-wise
         #re_dling_features = dling_features.view(-1, dling_features.size(-1))
         #re_dling_features = dling_features.view(-1, dling_features.size(-1))
         if not self.gating:
@@ -152,7 +171,6 @@ class speaker_model(nn.Module):
                 x = x_tanh * x_sig
         #x = x.view(dling_features.size(0), -1, 
         #           self.emb_size)
-        x = x.transpose(0, 1)
         return x
 
     def build_core_rnn(self):
@@ -172,10 +190,8 @@ class speaker_model(nn.Module):
     def forward_core(self, inp, hid_state):
         h_t, hid_state = self.core_rnn(inp, hid_state)
         if self.gating:
-            # we can forward 3-D tensors in linear now! [B, T, F]
-            inp_g = inp.transpose(0, 1)
-            x_g = self.core_g(inp_g)
-            x_g = x_g.transpose(0, 1)
+            # we can forward 3-D tensors in linear now! [T, B, F]
+            x_g = self.core_g(inp)
             assert x_g.size() == h_t.size(), x_g.size()
             h_t = x_g * h_t
         return self.core_dout(h_t), hid_state
@@ -184,7 +200,7 @@ class speaker_model(nn.Module):
         if self.mulout:
             # Multi-Output model
             # make as many out layers as speakers
-            self.out_layers = {}
+            self.out_layers = nn.ModuleDict()
             for k in self.speakers:
                 if rnn_output:
                     self.out_layers[k] = nn.LSTM(self.rnn_size,
@@ -210,6 +226,161 @@ class speaker_model(nn.Module):
                 self.out_layer = nn.Linear(self.rnn_size,
                                            self.num_outputs)
 
+    def forward_routed_output(self, x, out_spks, out_state=None):
+        """ Forward every row of a packed MO batch only through the
+            output of its speaker (instead of all rows through all the
+            outputs)
+
+            # Arguments
+                x: time-major [seqlen, bsize, rnn_size] core output.
+                out_spks: speaker name of every batch row.
+                out_state: packed (h, c) states of all the rows, if the
+                           outputs are RNNs.
+
+            # Returns
+                y: [seqlen, bsize, num_outputs] outputs of the rows.
+                out_state: packed states (None without RNN outputs).
+        """
+        spk2rows = {}
+        for row, spk in enumerate(out_spks):
+            spk2rows.setdefault(spk, []).append(row)
+        ys = []
+        states = []
+        order = []
+        for spk, rows in spk2rows.items():
+            if rows == list(range(rows[0], rows[-1] + 1)):
+                # contiguous rows (as packed by MOSampler) are views
+                sel = slice(rows[0], rows[-1] + 1)
+            else:
+                sel = torch.tensor(rows, device=x.device)
+            out_layer = self.out_layers[spk]
+            if isinstance(out_layer, nn.LSTM):
+                spk_state = None
+                if out_state is not None:
+                    spk_state = tuple(st[:, sel] for st in out_state)
+                y_spk, spk_state = out_layer(x[:, sel], spk_state)
+                states.append(spk_state)
+            else:
+                y_spk = out_layer(x[:, sel])
+            ys.append(y_spk)
+            order.extend(rows)
+        y = torch.cat(ys, dim=1)
+        nout_state = None
+        if len(states) > 0:
+            nout_state = tuple(torch.cat(st, dim=1) for st in zip(*states))
+        if order != list(range(len(order))):
+            # back to the batch order of the rows
+            inv_order = torch.empty(len(order), dtype=torch.long)
+            inv_order[torch.tensor(order)] = torch.arange(len(order))
+            inv_order = inv_order.to(x.device)
+            y = y[:, inv_order]
+            if nout_state is not None:
+                nout_state = tuple(st[:, inv_order] for st in nout_state)
+        return y, nout_state
+
+    def inference_forward(self, dling_features, speaker_idx=None):
+        """ Time-major predictions of a batch from the initial states
+            (the forward exported by export_compiled)
+        """
+        raise NotImplementedError('{} has no inference forward to '
+                                  'export'.format(self.__class__.__name__))
+
+    def export_compiled(self, path, example_len=100):
+        """ Export inference_forward as a frozen TorchScript graph with
+            the model config, loadable with load_model. The graph is
+            traced with an example batch of example_len frames, but the
+            lengths stay symbolic: any utterance length runs the same
+            graph, without re-tracing nor recompiling it
+        """
+        was_training = self.training
+        self.eval()
+        device = next(self.parameters()).device
+        lab = torch.zeros(example_len, 1, self.num_inputs, device=device)
+        spk = torch.zeros(example_len, 1, dtype=torch.long, device=device)
+        with torch.no_grad(), warnings.catch_warnings():
+            # the head size of the attention scaling is a constant
+            warnings.simplefilter('ignore', torch.jit.TracerWarning)
+            graph = torch.jit.trace(InferenceGraph(self).eval(), (lab, spk),
+                                    strict=False)
+            # parameters are folded into the graph as constants
+            graph = torch.jit.freeze(graph)
+        torch.jit.save(graph, path,
+                       _extra_files={COMPILED_CONFIG:
+                                     json.dumps(self.model_config)})
+        self.train(was_training)
+
+
+# model config stored within the exported graphs
+COMPILED_CONFIG = 'model_config.json'
+
+class InferenceGraph(nn.Module):
+    """ Module traced by export_compiled """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, dling_features, speaker_idx):
+        return self.model.inference_forward(dling_features, speaker_idx)
+
+class CompiledModel(nn.Module):
+    """ Exported inference graph of a model (see export_compiled), with
+        the inference_forward of the eager model
+    """
+
+    def __init__(self, graph, model_config):
+        super().__init__()
+        self.graph = graph
+        self.model_config = model_config
+
+    def inference_forward(self, dling_features, speaker_idx=None):
+        if speaker_idx is None:
+            speaker_idx = torch.zeros(dling_features.size()[:2],
+                                      dtype=torch.long,
+                                      device=dling_features.device)
+        return self.graph(dling_features, speaker_idx)
+
+def is_compiled_model(model_file):
+    """ Whether model_file holds a graph written by export_compiled """
+    if not zipfile.is_zipfile(model_file):
+        return False
+    with zipfile.ZipFile(model_file) as model_zip:
+        return any(name.endswith('/extra/' + COMPILED_CONFIG) \
+                   for name in model_zip.namelist())
+
+def model_classes(cls=speaker_model):
+    for subcls in cls.__subclasses__():
+        yield subcls
+        yield from model_classes(subcls)
+
+def load_model(model_file, map_location='cpu'):
+    """ Load a model from a checkpoint (state_dict + config) written by
+        the CheckpointManager, from a graph exported by export_compiled
+        (as a CompiledModel, with its constants in map_location), or
+        from a fully pickled model (as the former speaker_model.save
+        wrote them)
+    """
+    if is_compiled_model(model_file):
+        extra_files = {COMPILED_CONFIG:''}
+        graph = torch.jit.load(model_file, map_location=map_location,
+                               _extra_files=extra_files)
+        return CompiledModel(graph, json.loads(extra_files[COMPILED_CONFIG]))
+    ckpt = torch.load(model_file, map_location=map_location,
+                      weights_only=False)
+    if isinstance(ckpt, nn.Module):
+        return ckpt
+    config = ckpt['model_config']
+    classes = dict((cls.__name__, cls) for cls in model_classes())
+    if config['model'] not in classes:
+        raise ValueError('Unrecognized model {} in checkpoint '
+                         '{}'.format(config['model'], model_file))
+    kwargs = dict(config['kwargs'])
+    # built in CPU, moved to the device by the caller
+    kwargs['cuda'] = False
+    model = classes[config['model']](*config['args'], **kwargs)
+    model.load_state_dict(ckpt['state_dict'])
+    return model
+
 def clones(module, N):
     "Produce N identical layers."
     return nn.ModuleList([copy.deepcopy(module) for _ in range(N)])
@@ -219,6 +390,8 @@ def attention(query, key, value, mask=None, dropout=None):
     d_k = query.size(-1)
     scores = torch.matmul(query, key.transpose(-2, -1)) \
              / math.sqrt(d_k)
+    # masking and softmax in float32 (scores are bf16 under autocast)
+    scores = scores.float()
     if mask is not None:
         scores = scores.masked_fill(mask == 0, -1e9)
     #print(scores.size())
@@ -285,12 +458,18 @@ class PositionalEncoding(nn.Module):
         pe[:, 0::2] = torch.sin(position.float() * div_term)
         pe[:, 1::2] = torch.cos(position.float() * div_term)
         pe = pe.unsqueeze(0)
-        self.register_buffer('pe', pe)
+        # not persistent: checkpoints do not store the encodings
+        self.register_buffer('pe', pe, persistent=False)
         
-    def forward(self, x, start_idx=0):
+    def forward(self, x, start_idx=0, positions=None):
         #print(x.size())
         #print('start_idx: ', start_idx)
-        curr_pe = self.pe[:, start_idx:start_idx+x.size(1), :]
+        if positions is not None:
+            # (B, T) position of every frame (packed sequences restart
+            # their positions)
+            curr_pe = self.pe[0][positions]
+        else:
+            curr_pe = self.pe[:, start_idx:start_idx+x.size(1), :]
         x = x + curr_pe
         return self.dropout(x)
 
@@ -320,6 +499,8 @@ class LayerNorm(nn.Module):
         self.eps = eps
 
     def forward(self, x):
+        # normalize in float32 (x may be bf16 under autocast)
+        x = x.float()
         mean = x.mean(-1, keepdim=True)
         std = x.std(-1, keepdim=True)
         return self.a_2 * (x - mean) / (std + self.eps) + self.b_2
@@ -383,6 +564,15 @@ class NoamOpt(object):
 
     def zero_grad(self):
         self.optimizer.zero_grad()
+
+    def state_dict(self):
+        return {'step':self._step, 'rate':self._rate,
+                'optimizer':self.optimizer.state_dict()}
+
+    def load_state_dict(self, state):
+        self._step = state['step']
+        self._rate = state['rate']
+        self.optimizer.load_state_dict(state['optimizer'])
         
 def get_std_opt(model):
     return NoamOpt(model.emb_size, 2, 4000,
@@ -394,6 +584,11 @@ def subsequent_mask(size):
     subsequent_mask = np.triu(np.ones(attn_shape), k=1).astype('uint8')
     return torch.from_numpy(subsequent_mask) == 0
 
+def segment_mask(segments):
+    "Block-diagonal mask: frames only attend to their own (non-pad) segment."
+    same_seg = segments.unsqueeze(2) == segments.unsqueeze(1)
+    return same_seg & (segments.unsqueeze(1) > 0)
+
 
 def tanh2sigmoid(x):
     return (1 + x) / 2
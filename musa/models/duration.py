@@ -60,7 +60,8 @@ class duration_rnn(speaker_model):
         if sigmoid_out:
             self.sigmoid = nn.Sigmoid()
 
-    def forward(self, ling_features, rnn_state=None, speaker_idx=None):
+    def forward(self, ling_features, rnn_state=None, speaker_idx=None,
+                out_spks=None):
         """ Forward the linguistic features, and the speaker ID
             # Arguments
                 ling_features: Tensor with encoded linguistic features
@@ -68,25 +69,33 @@ class duration_rnn(speaker_model):
                 speaker_id: Tensor with speaker idx to be generated
                 In case of MO model, all speakers are generated, so
                 speaker_idx is not needed.
+                out_spks: speaker name of every row of a packed MO batch
+                          (each row only goes through the output of its
+                          speaker, and y is not a dict).
         """
         x = self.forward_input_embedding(ling_features, speaker_idx)
         x, rnn_state = self.forward_core(x, rnn_state)
-        if self.mulout:
+        # output layers are frame-wise, applied in time-major
+        if self.mulout and out_spks is not None:
+            y, _ = self.forward_routed_output(x, out_spks)
+            if self.sigmoid_out and self.num_outputs == 1:
+                y = self.sigmoid(y)
+        elif self.mulout:
             y = {}
             for spk in self.speakers:
-                x = x.transpose(0, 1)
                 y[spk] = self.out_layers[spk](x)
                 if self.sigmoid_out and self.num_outputs == 1:
                     y[spk] = self.sigmoid(y[spk])
-                y[spk] = y[spk].transpose(0, 1)
         else:
-            x = x.transpose(0, 1)
             y = self.out_layer(x)
             if self.sigmoid_out and self.num_outputs == 1:
                 y = self.sigmoid(y)
-            y = y.transpose(0, 1)
         return y, rnn_state
 
+    def inference_forward(self, ling_features, speaker_idx=None):
+        y, _ = self(ling_features, None, speaker_idx=speaker_idx)
+        return y
+
     def init_hidden_state(self, curr_bsz):
         return (torch.zeros(self.rnn_layers, curr_bsz, self.rnn_size),
                 torch.zeros(self.rnn_layers, curr_bsz, self.rnn_size))
@@ -0,0 +1,434 @@
+from multiprocessing import shared_memory
+from torch.utils.data import DataLoader
+from .datasets import StatefulSampler
+from .datasets import varlen_dur_collate, varlen_aco_collate
+from .models import duration_rnn, acoustic_builder
+from .core import train_engine, train_dur_epoch, eval_dur_epoch
+from .core import train_aco_epoch, eval_aco_epoch
+import multiprocessing as mp
+import torch.nn as nn
+import torch.optim as optim
+import numpy as np
+import argparse
+import itertools
+import traceback
+import hashlib
+import random
+import torch
+import copy
+import json
+import timeit
+import os
+
+
+class SharedDataset(object):
+    """ Built dataset whose frame store (the arrays of cache_arrays, and
+        those within its compact containers) is moved to shared memory
+        blocks, so that many processes serve it without re-building nor
+        copying it. Pickling it only pickles the rest of the dataset (the
+        windows, stats, codebooks...) and the names of the blocks, which
+        attach re-opens.
+
+        # Arguments
+            dset: built TCSTAR dataset. Its frame store is replaced by
+                  the shared arrays.
+    """
+
+    def __init__(self, dset):
+        self.dset = dset
+        # frame store path (attr[, container attr]) -> block spec
+        self.specs = {}
+        self.blocks = []
+        # only the creator unlinks the blocks
+        self.owner = True
+        for path, arr in frame_store_arrays(dset):
+            block = shared_memory.SharedMemory(create=True,
+                                               size=max(arr.nbytes, 1))
+            shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=block.buf)
+            shared[...] = arr
+            set_path(dset, path, shared)
+            self.blocks.append(block)
+            self.specs[path] = (block.name, arr.shape, arr.dtype.str)
+        self.nbytes = sum(block.size for block in self.blocks)
+
+    def __getstate__(self):
+        proto = copy.copy(self.dset)
+        for path in self.specs:
+            if len(path) > 1:
+                # do not touch the container of the shared dataset
+                setattr(proto, path[0], copy.copy(getattr(proto, path[0])))
+            set_path(proto, path, None)
+        return {'dset':proto, 'specs':self.specs, 'blocks':[],
+                'owner':False, 'nbytes':self.nbytes}
+
+    def attach(self):
+        """ Re-open the shared arrays (in a process the dataset was
+            pickled to) and return the dataset served from them
+        """
+        for path, (name, shape, dtype) in self.specs.items():
+            block = shared_memory.SharedMemory(name=name)
+            shared = np.ndarray(shape, dtype=np.dtype(dtype),
+                                buffer=block.buf)
+            # served read-only, as the memory-mapped cached arrays
+            shared.flags.writeable = False
+            set_path(self.dset, path, shared)
+            self.blocks.append(block)
+        return self.dset
+
+    def close(self):
+        """ Release the shared blocks (the creator also unlinks them) """
+        for block in self.blocks:
+            block.close()
+            if self.owner:
+                block.unlink()
+        self.blocks = []
+
+def frame_store_arrays(dset):
+    """ (path, array) of the numeric arrays of the frame store of dset """
+    arrays = []
+    for name in dset.cache_arrays():
+        val = getattr(dset, name)
+        if isinstance(val, np.ndarray):
+            members = [((name,), val)]
+        elif hasattr(val, '__dict__'):
+            # compact containers (CompactFrames, SymbolFrames)
+            members = [((name, attr), arr) for attr, arr in \
+                       vars(val).items() if isinstance(arr, np.ndarray)]
+        else:
+            members = []
+        arrays.extend((path, arr) for path, arr in members \
+                      if arr.dtype != object)
+    return arrays
+
+def set_path(dset, path, val):
+    owner = dset
+    for attr in path[:-1]:
+        owner = getattr(owner, attr)
+    setattr(owner, path[-1], val)
+
+def expand_grid(grid, spks=None):
+    """ List every configuration (dict) of the cartesian product of the
+        grid values, optionally repeated for every speaker of spks
+
+        # Arguments
+            grid: dict of option -> list of values.
+            spks: list of speakers, each configuration trains a single
+                  speaker model with every one of them (None: all the
+                  speakers together).
+    """
+    names = sorted(grid.keys())
+    configs = [dict(zip(names, vals)) for vals in \
+               itertools.product(*[grid[name] for name in names])]
+    if spks is None:
+        return configs
+    return [dict(config, spk=spk) for spk in spks for config in configs]
+
+def parse_grid(grid_args, types):
+    """ Parse 'option=v1,v2,...' grid args, casting the values with the
+        type of the option in types
+    """
+    grid = {}
+    for arg in grid_args:
+        if '=' not in arg:
+            raise ValueError('Unrecognized grid arg {} (expected '
+                             'option=v1,v2,...)'.format(arg))
+        name, vals = arg.split('=', 1)
+        if name not in types:
+            raise ValueError('Unrecognized grid option: ', name)
+        grid[name] = [types[name](val) for val in vals.split(',')]
+    return grid
+
+def halving_budgets(min_epochs, max_epochs, eta):
+    """ Epochs trained by the end of every rung of successive halving:
+        min_epochs, min_epochs * eta, ... up to max_epochs
+    """
+    if eta < 2:
+        raise ValueError('Successive halving needs eta >= 2, got '
+                         '{}'.format(eta))
+    if min_epochs < 1 or min_epochs > max_epochs:
+        raise ValueError('Successive halving needs 1 <= min_epochs <= '
+                         'max_epochs, got min_epochs {} and max_epochs '
+                         '{}'.format(min_epochs, max_epochs))
+    budgets = [min_epochs]
+    while budgets[-1] < max_epochs:
+        budgets.append(min(budgets[-1] * eta, max_epochs))
+    return budgets
+
+# datasets attached by every worker of the pool
+_WORKER_DSETS = {}
+
+def init_worker(shared_dsets, num_threads):
+    """ Pool initializer: limit the threads of every job and attach the
+        shared datasets
+    """
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(num_threads)
+    except RuntimeError:
+        # already set (forked workers)
+        pass
+    for split, shared in shared_dsets.items():
+        _WORKER_DSETS[split] = shared.attach()
+
+def job_loaders(opts, trainset, validset):
+    """ Loaders of a job over its own view (windowing, speakers) of the
+        shared datasets
+    """
+    trainset = copy.copy(trainset)
+    validset = copy.copy(validset)
+    stateful = opts.max_seq_len is not None and not opts.no_stateful
+    bsize = opts.batch_size if stateful else None
+    for dset in [trainset, validset]:
+        dset.set_windowing(opts.max_seq_len, bsize)
+        if opts.spk is not None:
+            dset.select_speakers([opts.spk])
+    collate_fn = varlen_dur_collate
+    if opts.task == 'aco':
+        collate_fn = varlen_aco_collate
+    # jobs run in daemonic pool workers: batches are loaded in-process
+    if stateful:
+        train_loader = DataLoader(trainset, batch_size=opts.batch_size,
+                                  sampler=StatefulSampler(trainset,
+                                                          opts.batch_size),
+                                  collate_fn=collate_fn)
+    else:
+        train_loader = DataLoader(trainset, batch_size=opts.batch_size,
+                                  shuffle=True, collate_fn=collate_fn)
+    valid_loader = DataLoader(validset, batch_size=opts.batch_size,
+                              shuffle=False, collate_fn=collate_fn)
+    return train_loader, valid_loader, stateful
+
+def build_job_model(opts, trainset):
+    """ Model, train and eval epoch functions and eval target of a job """
+    if opts.spk is not None:
+        # single speaker model (without speaker embedding)
+        model_spks = [opts.spk]
+    else:
+        model_spks = list(trainset.all_speakers.keys())
+    if opts.task == 'dur':
+        model = duration_rnn(num_inputs=trainset.ling_feats_dim,
+                             num_outputs=1,
+                             emb_size=opts.emb_size,
+                             rnn_size=opts.rnn_size,
+                             rnn_layers=opts.rnn_layers,
+                             sigmoid_out=True,
+                             dropout=opts.dout,
+                             speakers=model_spks,
+                             cuda=opts.cuda,
+                             emb_layers=opts.emb_layers,
+                             emb_act=opts.emb_activation)
+        return model, train_dur_epoch, eval_dur_epoch, \
+               'eval_total_nosil_dur_rmse'
+    mopts = argparse.Namespace(**vars(opts))
+    mopts.num_inputs = trainset.ling_feats_dim + 2
+    mopts.spks = model_spks
+    mopts.mulout = False
+    model, _, _ = acoustic_builder('rnn', mopts)
+    return model, train_aco_epoch, eval_aco_epoch, 'total_nosil_aco_mcd'
+
+def run_job(job):
+    """ Train the configuration of a job (resuming it from its training
+        state of the previous rung) up to job['epochs'] epochs, in a pool
+        worker
+
+        # Returns
+            dict with the job id, its best validation score, whether it
+            ran out of patience, the elapsed time and the error if it
+            failed (the sweep goes on with the other jobs).
+    """
+    beg_t = timeit.default_timer()
+    result = {'id':job['id'], 'epochs':job['epochs'], 'score':np.inf,
+              'stopped':False, 'error':None}
+    opts = argparse.Namespace(**job['opts'])
+    try:
+        trainset = _WORKER_DSETS['train']
+        validset = _WORKER_DSETS['valid']
+        save_path = os.path.join(opts.save_path, job['id'])
+        if not os.path.exists(save_path):
+            os.makedirs(save_path)
+        with open(os.path.join(save_path, 'main.opts'), 'w') as opts_f:
+            opts_f.write(json.dumps(vars(opts), indent=2))
+        torch.manual_seed(opts.seed)
+        np.random.seed(opts.seed)
+        random.seed(opts.seed)
+        train_loader, valid_loader, stateful = job_loaders(opts, trainset,
+                                                           validset)
+        model, train_fn, eval_fn, eval_target = build_job_model(opts,
+                                                                trainset)
+        if opts.cuda:
+            model.to('cuda')
+        criterion = getattr(nn, opts.loss)()
+        opti = getattr(optim, opts.optim)(model.parameters(), lr=opts.lr)
+        if opts.task == 'dur':
+            stats = trainset.spk2durstats
+            tr_opts = {'spk2durstats':stats}
+        else:
+            stats = trainset.spk2acostats
+            tr_opts = {'spk2acostats':stats}
+        tr_opts['idx2spk'] = trainset.idx2spk
+        if stateful and opts.task == 'dur':
+            # (acoustic training is always stateful)
+            tr_opts['stateful'] = True
+        tr_opts['prefetch'] = opts.device_prefetch
+        va_opts = {'idx2spk':trainset.idx2spk}
+        # the runs of every rung go on from the previous one (of this
+        # sweep, the job dirs start empty)
+        score, stopped = train_engine(model, train_loader, opti,
+                                      opts.log_freq, train_fn, criterion,
+                                      job['epochs'], save_path,
+                                      '{}_model.ckpt'.format(opts.task),
+                                      tr_opts=tr_opts, eval_fn=eval_fn,
+                                      val_dloader=valid_loader,
+                                      eval_stats=stats,
+                                      eval_target=eval_target,
+                                      eval_patience=opts.patience,
+                                      cuda=opts.cuda,
+                                      va_opts=va_opts,
+                                      keep_last=opts.keep_last,
+                                      keep_best=opts.keep_best,
+                                      resume=job['rung'] > 0)
+        result['score'] = float(score)
+        result['stopped'] = stopped
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['time'] = timeit.default_timer() - beg_t
+    return result
+
+def successive_halving(pool, configs, base_opts, min_epochs, max_epochs,
+                       eta=2):
+    """ Train all the configs for min_epochs, keep the best 1/eta of them
+        and train them further (min_epochs * eta epochs in total), and so
+        on up to max_epochs. Configs that ran out of patience keep their
+        score but are not trained further, nor take the place of the
+        ones that can. Every job is saved in a dir named by the hash of
+        its options, which must not exist yet (see job_rows), so that
+        no run resumes the states of a previous sweep. The configs of every speaker
+        (the spk option, if swept) are halved separately, as their scores
+        are not comparable.
+
+        # Arguments
+            pool: process pool (see init_worker) running the jobs.
+            configs: list of dicts of options overriding base_opts.
+            base_opts: dict of the options shared by all the jobs.
+
+        # Returns
+            One row (dict) per config with its options, the epochs it was
+            trained for, its best validation score and elapsed time, sorted
+            by speaker and score.
+    """
+    rows = job_rows(configs, base_opts)
+    alive = list(rows)
+    budgets = halving_budgets(min_epochs, max_epochs, eta)
+    for rung, budget in enumerate(budgets):
+        jobs = [{'id':row['id'], 'epochs':budget, 'rung':rung,
+                 'opts':dict(base_opts, **row['config'])} \
+                for row in alive if not row['stopped'] and \
+                row['error'] is None]
+        print('=' * 30)
+        print('Sweep rung {}/{}: training {} configs up to {} '
+              'epochs'.format(rung + 1, len(budgets), len(jobs), budget))
+        rows_by_id = dict((row['id'], row) for row in rows)
+        for result in pool.imap_unordered(run_job, jobs):
+            row = rows_by_id[result['id']]
+            row['epochs'] = result['epochs']
+            row['score'] = result['score']
+            row['stopped'] = result['stopped']
+            row['time'] += result['time']
+            row['error'] = result['error']
+            row['rung'] = rung
+            if result['error'] is not None:
+                print('[!] {} failed:\n{}'.format(row['id'], result['error']))
+            else:
+                print('{} ({}) > best score {:.4f} in {:.1f} '
+                      's'.format(row['id'], format_config(row['config']),
+                                 row['score'], result['time']))
+        if rung + 1 < len(budgets):
+            alive = halve(alive, eta)
+    return sorted(rows, key=lambda row: (str(row['config'].get('spk')),
+                                         -row['rung'], row['score']))
+
+def job_rows(configs, base_opts):
+    """ Initial result rows of the jobs of the configs, whose dirs are
+        named by the hash of their options and must not exist yet
+    """
+    rows = []
+    for config in configs:
+        job_id = job_hash(dict(base_opts, **config))
+        job_path = os.path.join(base_opts['save_path'], job_id)
+        if os.path.exists(job_path):
+            raise ValueError('Job dir {} ({}) exists from a previous sweep: '
+                             'remove it or choose another '
+                             'save_path.'.format(job_path,
+                                                 format_config(config)))
+        rows.append({'id':job_id, 'config':config,
+                     'epochs':0, 'score':np.inf, 'stopped':False,
+                     'time':0., 'error':None, 'rung':0})
+    return rows
+
+def halve(rows, eta):
+    """ Best 1/eta rows (at least one) of every speaker, among the ones
+        that can still train (not out of patience nor failed)
+    """
+    kept = []
+    spks = sorted(set(str(row['config'].get('spk')) for row in rows))
+    for spk in spks:
+        spk_rows = [row for row in rows \
+                    if str(row['config'].get('spk')) == spk]
+        trainable = [row for row in spk_rows \
+                     if not row['stopped'] and row['error'] is None]
+        trainable = sorted(trainable, key=lambda row: row['score'])
+        kept.extend(trainable[:max(1, len(spk_rows) // eta)])
+    return kept
+
+def job_hash(job_opts):
+    """ Job id from the hash of all its options """
+    opts_json = json.dumps(job_opts, sort_keys=True)
+    return 'job-{}'.format(hashlib.sha1(opts_json.encode()).hexdigest()[:10])
+
+def format_config(config):
+    return ' '.join('{}={}'.format(k, v) for k, v in sorted(config.items()))
+
+def write_summary(rows, summary_fpath):
+    """ Print the sweep results table and write it as tsv """
+    names = sorted(set(name for row in rows for name in row['config']))
+    header = ['id'] + names + ['epochs', 'rung', 'score', 'stopped',
+                               'time_s', 'status']
+    table = []
+    for row in rows:
+        status = 'ok' if row['error'] is None else 'failed'
+        table.append([row['id']] + \
+                     [str(row['config'].get(name, '')) for name in names] + \
+                     [str(row['epochs']), str(row['rung']),
+                      '{:.4f}'.format(row['score']), str(row['stopped']),
+                      '{:.1f}'.format(row['time']), status])
+    widths = [max(len(line[col]) for line in [header] + table) \
+              for col in range(len(header))]
+    for line in [header] + table:
+        print('  '.join(val.rjust(width) for val, width in zip(line,
+                                                                widths)))
+    with open(summary_fpath, 'w') as summary_f:
+        for line in [header] + table:
+            summary_f.write('\t'.join(line) + '\n')
+    print('Sweep summary written to ', summary_fpath)
+
+def sweep_pool(shared_dsets, num_jobs, threads_per_job,
+               start_method='spawn'):
+    """ Pool of num_jobs workers attached to the shared datasets, each
+        one limited to threads_per_job threads
+    """
+    # read by the numeric libraries of the spawned workers at import,
+    # and restored in this process once they are started
+    thread_vars = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS']
+    prev_env = dict((var, os.environ.get(var)) for var in thread_vars)
+    for var in thread_vars:
+        os.environ[var] = str(threads_per_job)
+    try:
+        ctx = mp.get_context(start_method)
+        return ctx.Pool(num_jobs, initializer=init_worker,
+                        initargs=(shared_dsets, threads_per_job))
+    finally:
+        for var, val in prev_env.items():
+            if val is None:
+                del os.environ[var]
+            else:
+                os.environ[var] = val
@@ -1,8 +1,21 @@
 import torch
 from torch.autograd import Variable
 import torch.optim as optim
+from torch.utils.data import DataLoader
 from .ext import YFOptimizer
 import numpy as np
+import contextlib
+import itertools
+import copy
+import threading
+import random
+import queue
+import json
+import os
+
+
+# numerical precisions of the forward passes
+PRECISIONS = ['fp32', 'bf16']
 
 
 def var_to_cuda(var):
@@ -28,7 +41,8 @@ def repackage_hidden(h, curr_bsz):
     """ Coming from https://github.com/pytorch/examples/blob/master/word_language_model/main.py """
     """Wraps hidden states in new Variables, to detach them from their history."""
     if isinstance(h, Variable) or isinstance(h, torch.Tensor):
-        return h[:, :curr_bsz, :].detach().contiguous()
+        # carried states stay in float32 (autocast may output bf16 ones)
+        return h[:, :curr_bsz, :].detach().float().contiguous()
     elif isinstance(h, dict):
         # go element by element, repackaging
         for k, el in h.items():
@@ -37,6 +51,494 @@ def repackage_hidden(h, curr_bsz):
     else:
         return tuple(repackage_hidden(v, curr_bsz).contiguous() for v in h)
 
+def repack_rows(h, state_spks, row_spks):
+    """ Detached packed MO states (rows of several speakers, state_spks
+        being the speaker of every row) re-arranged for a batch whose
+        rows belong to row_spks: every speaker keeps its first rows, in
+        order, and rows with no previous state start at zeros
+    """
+    if h is None:
+        return h
+    if isinstance(h, tuple) or isinstance(h, list):
+        return tuple(repack_rows(v, state_spks, row_spks) for v in h)
+    # carried states stay in float32 (autocast may output bf16 ones)
+    h = h.detach().float()
+    if list(state_spks) == list(row_spks):
+        return h
+    spk2rows = {}
+    for row, spk in enumerate(state_spks):
+        spk2rows.setdefault(spk, []).append(row)
+    # rows without state point to an appended zero row
+    zero_row = h.size(1)
+    spk_cursor = {}
+    rows = []
+    for spk in row_spks:
+        spk_rows = spk2rows.get(spk, [])
+        cursor = spk_cursor.get(spk, 0)
+        rows.append(spk_rows[cursor] if cursor < len(spk_rows) else zero_row)
+        spk_cursor[spk] = cursor + 1
+    h = torch.cat((h, h.new_zeros(h.size(0), 1, h.size(2))), dim=1)
+    return h[:, torch.tensor(rows, device=h.device)].contiguous()
+
+def packed_spk_losses(criterion, y, target, row_spks):
+    """ Detached loss of the rows of every speaker of a time-major
+        packed MO batch (row_spks being the speaker of every row)
+    """
+    spk2rows = {}
+    for row, spk in enumerate(row_spks):
+        spk2rows.setdefault(spk, []).append(row)
+    y = y.detach()
+    spk_losses = {}
+    for spk, rows in spk2rows.items():
+        rows = torch.tensor(rows, device=y.device)
+        spk_losses[spk] = criterion(y[:, rows], target[:, rows])
+    return spk_losses
+
+def stage_batch(batch, cuda=False, non_blocking=False, copy=False):
+    """ Move a collated (time-major) batch to the device if cuda (or
+        copy its host tensors if copy)
+    """
+    if not cuda:
+        if copy:
+            return tuple(tensor.clone() if torch.is_tensor(tensor)
+                         else tensor for tensor in batch)
+        return tuple(batch)
+    staged = []
+    for tensor in batch:
+        if torch.is_tensor(tensor):
+            if non_blocking and not tensor.is_pinned():
+                tensor = tensor.pin_memory()
+            tensor = tensor.cuda(non_blocking=non_blocking)
+        staged.append(tensor)
+    return tuple(staged)
+
+
+class DevicePrefetcher(object):
+    """ Iterate over the batches of a DataLoader staged by stage_batch.
+        A background thread stages up to depth batches ahead, so the
+        collate work and the host->device copies (pinned and
+        non-blocking, in a side CUDA stream) overlap with the
+        forward/backward of the current batch. With depth 0 batches
+        are staged synchronously. The first skip batches of the loader
+        are drawn but not staged (to resume an epoch), and then the
+        torch RNGs are restored to rng (if given): both are done before
+        any batch is staged, so the loader draws and the training ones
+        are the same as in the interrupted epoch. With host_spks,
+        every batch is yielded with the speaker idx of each of its rows
+        (list), read from the collated batch before it is staged, so
+        picking the MO outputs does not sync with the device.
+        Batches collated into a ring of reused buffers (VarlenCollater
+        in the main process) are copied when staged in the CPU if the
+        ring is smaller than depth + 2 (the staged batches, the one
+        being staged and the one in use), so they are not overwritten
+        before being consumed.
+    """
+
+    def __init__(self, dloader, cuda=False, depth=2, skip=0,
+                 host_spks=False, rng=None):
+        self.dloader = dloader
+        self.cuda = cuda
+        self.depth = depth
+        self.skip = skip
+        self.host_spks = host_spks
+        self.rng = rng
+        self.copy_host = self.reuses_buffers()
+
+    def reuses_buffers(self):
+        """ Whether the staged CPU batches could share memory with
+            collate buffers overwritten before they are consumed
+        """
+        if self.cuda or self.depth <= 0:
+            return False
+        if getattr(self.dloader, 'num_workers', 0) > 0:
+            # batches come from the workers in shared memory
+            return False
+        collate_fn = getattr(self.dloader, 'collate_fn', None)
+        buffers = getattr(collate_fn, 'buffers', None)
+        return buffers is not None and len(buffers) < self.depth + 2
+
+    def loader_batches(self):
+        """ Iterator of the loader batches past the skipped ones, which
+            are drawn right away in the calling thread
+        """
+        batches = iter(self.dloader)
+        for _ in itertools.islice(batches, self.skip):
+            pass
+        if self.rng is not None:
+            set_rng_state(self.rng, torch_only=True)
+        return batches
+
+    def __len__(self):
+        return len(self.dloader)
+
+    def row_spks(self, batch):
+        # speaker idxs of the first frame of every row (time-major
+        # spk_b), taken from the host-side collated batch
+        if not self.host_spks:
+            return None
+        return batch[0][0].tolist()
+
+    def output(self, staged, spks):
+        if self.host_spks:
+            return staged, spks
+        return staged
+
+    def stage_loop(self, batches, batch_q, stop, stream):
+        def put(item):
+            # give up if the consumer stopped iterating
+            while not stop.is_set():
+                try:
+                    batch_q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        try:
+            for batch in batches:
+                spks = self.row_spks(batch)
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        staged = stage_batch(batch, True, non_blocking=True)
+                        ready = torch.cuda.Event()
+                        ready.record(stream)
+                    # source (pinned) buffers can be reused by the
+                    # collate function once the copies are done
+                    ready.synchronize()
+                else:
+                    staged = stage_batch(batch, self.cuda,
+                                         copy=self.copy_host)
+                    ready = None
+                if not put((staged, ready, spks)):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for batch in self.loader_batches():
+                spks = self.row_spks(batch)
+                yield self.output(stage_batch(batch, self.cuda), spks)
+            return
+        stream = None
+        if self.cuda:
+            stream = torch.cuda.Stream()
+        batches = self.loader_batches()
+        batch_q = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        stager = threading.Thread(target=self.stage_loop,
+                                  args=(batches, batch_q, stop, stream))
+        stager.daemon = True
+        stager.start()
+        try:
+            while True:
+                item = batch_q.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                staged, ready, spks = item
+                if ready is not None:
+                    curr_stream = torch.cuda.current_stream()
+                    curr_stream.wait_event(ready)
+                    for tensor in staged:
+                        if torch.is_tensor(tensor):
+                            # memory was allocated in the side stream
+                            tensor.record_stream(curr_stream)
+                yield self.output(staged, spks)
+        finally:
+            stop.set()
+            stager.join()
+
+def precision_autocast(precision='fp32', cuda=False):
+    """ Context to run the forward passes in the given precision: bf16
+        autocasts the matmuls and RNNs to bfloat16 (LayerNorm, attention
+        softmax, losses and metrics are kept in float32), fp32 leaves
+        them as they are
+    """
+    if precision not in PRECISIONS:
+        raise ValueError('Unrecognized precision {}, options: '
+                         '{}'.format(precision, PRECISIONS))
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    device_type = 'cuda' if cuda else 'cpu'
+    return torch.autocast(device_type, dtype=torch.bfloat16)
+
+def get_rng_state(cuda=False):
+    """ States of the torch (and CUDA), numpy and python RNGs """
+    state = {'torch':torch.get_rng_state(),
+             'numpy':np.random.get_state(),
+             'random':random.getstate(),
+             'cuda':None}
+    if cuda and torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state, torch_only=False):
+    """ Restore the RNG states of get_rng_state. With torch_only, the
+        numpy and python RNGs (only drawn by the samplers) are left as
+        they are
+    """
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None:
+        torch.cuda.set_rng_state_all(state['cuda'])
+    if not torch_only:
+        np.random.set_state(state['numpy'])
+        random.setstate(state['random'])
+
+def subset_loader(dloader, num_batches):
+    """ Loader of a fixed subset of the batches of dloader: num_batches
+        of them evenly spaced over its batch order, which is drawn once
+        (without altering the RNGs), so that every pass goes through the
+        same samples. dloader must not be shuffled for the subset to be
+        deterministic across runs
+
+        # Arguments
+            dloader: DataLoader to subsample.
+            num_batches: num of batches of the subset (all of them if
+                         it has fewer).
+    """
+    rng = get_rng_state()
+    batches = [list(batch) for batch in dloader.batch_sampler]
+    set_rng_state(rng)
+    if num_batches < len(batches):
+        sel = np.linspace(0, len(batches) - 1, num_batches)
+        batches = [batches[idx] for idx in np.round(sel).astype(int)]
+    return DataLoader(dloader.dataset, batch_sampler=batches,
+                      num_workers=dloader.num_workers,
+                      collate_fn=dloader.collate_fn,
+                      pin_memory=dloader.pin_memory)
+
+def frames_mask(slen_b, max_len):
+    """ (T, B) mask of the time-major frames within each seqlen """
+    steps = torch.arange(max_len, device=slen_b.device).unsqueeze(1)
+    return steps < slen_b.long().unsqueeze(0)
+
+def masked_mean_loss(criterion, y, target, valid_b):
+    """ Mean of the criterion over the valid (T, B) frames of time-major
+        predictions. Padding is weighted out by the mask instead of
+        indexing the valid frames, which would sync with the device.
+    """
+    # elementwise version of the criterion (loss modules are stateless)
+    elem_criterion = copy.copy(criterion)
+    elem_criterion.reduction = 'none'
+    elem_loss = elem_criterion(y, target)
+    mask = valid_b.to(elem_loss.dtype)
+    mask = mask.view(mask.size() + (1,) * (elem_loss.dim() - 2))
+    frame_size = elem_loss[0, 0].numel()
+    return (elem_loss * mask).sum() / (mask.sum() * frame_size)
+
+class LossAccumulator(object):
+    """ Running sums of the (detached) train losses of every key, kept
+        in the device: they are only synced when their means are read
+        at the log boundaries
+    """
+
+    def __init__(self):
+        self.sums = {}
+        self.counts = {}
+
+    def add(self, loss, key='tr_loss'):
+        loss = loss.detach().double()
+        if key not in self.sums:
+            self.sums[key] = loss
+            self.counts[key] = 0
+        else:
+            # (sums of a snapshot are loaded in CPU)
+            self.sums[key] = self.sums[key].to(loss.device) + loss
+        self.counts[key] += 1
+
+    def state_dict(self):
+        return {'sums':dict(self.sums), 'counts':dict(self.counts)}
+
+    def load_state_dict(self, state):
+        self.sums = dict(state['sums'])
+        self.counts = dict(state['counts'])
+
+    def means(self, reset=True):
+        """ Mean loss of every key since the last reset """
+        keys = list(self.sums.keys())
+        if len(keys) == 0:
+            return {}
+        # a single copy to the host for all the keys
+        sums = torch.stack([self.sums[k] for k in keys]).cpu().tolist()
+        means = dict((k, v / self.counts[k]) for k, v in zip(keys, sums))
+        if reset:
+            self.sums = {}
+            self.counts = {}
+        return means
+
+def snapshot_state(state):
+    """ Copy of a (nested) state with its tensors detached in CPU memory,
+        safe from the updates of the next train steps
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((k, snapshot_state(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot_state(v) for v in state)
+    return state
+
+def json_save(obj, fpath):
+    with open(fpath, 'w') as json_f:
+        json.dump(obj, json_f, indent=2)
+
+def atomic_save(obj, fpath, save_fn=torch.save):
+    """ Write into a tmp file renamed to fpath, so that fpath is never
+        left half-written
+    """
+    tmp_fpath = fpath + '.tmp'
+    save_fn(obj, tmp_fpath)
+    os.replace(tmp_fpath, fpath)
+
+class CheckpointManager(object):
+    """ Checkpoints of a model (its state_dict + config, see load_model)
+        snapshotted to CPU memory and written by a background thread,
+        atomically. Only the keep_last latest and the keep_best best
+        (lowest val_score) checkpoints are kept, each one written once
+        even if it is both. An index (<model_savename>.index, json)
+        lists the kept checkpoints and the best one. Full training
+        states (to resume a run) are written in the same way, each one
+        replacing the previous one (<model_savename>.state).
+
+        # Arguments
+            save_path: directory of the checkpoints.
+            model_savename: checkpoints are named e<epoch>_<model_savename>
+                            (e<epoch>_s<step>_<model_savename> within an
+                            epoch).
+            keep_last: num of latest checkpoints kept (None keeps all).
+            keep_best: num of best validation checkpoints kept.
+    """
+
+    def __init__(self, save_path, model_savename, keep_last=None,
+                 keep_best=1):
+        if not os.path.exists(save_path):
+            os.makedirs(save_path)
+        self.save_path = save_path
+        self.model_savename = model_savename
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.index_fpath = os.path.join(save_path,
+                                        '{}.index'.format(model_savename))
+        self.state_fpath = os.path.join(save_path,
+                                        '{}.state'.format(model_savename))
+        # kept checkpoints of previous runs are still managed
+        self.ckpts = []
+        if os.path.exists(self.index_fpath):
+            with open(self.index_fpath, 'r') as index_f:
+                self.ckpts = json.load(index_f)['checkpoints']
+        self.error = None
+        # one snapshot waits while the previous one is written
+        self.write_q = queue.Queue(maxsize=1)
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def save(self, model, epoch, val_score=None, step=None,
+             **extra_states):
+        """ Snapshot the model (and any extra states) of this epoch, or
+            of this train step within it, and queue it to be written.
+            Only blocks if the previous snapshot is still waiting
+        """
+        self.check_error()
+        if val_score is not None:
+            val_score = float(val_score)
+        state = {'model_config':model.model_config,
+                 'state_dict':model.state_dict(),
+                 'epoch':epoch,
+                 'step':step,
+                 'val_score':val_score}
+        state.update(extra_states)
+        ckpt_fname = 'e{}_{}'.format(epoch, self.model_savename)
+        if step is not None:
+            ckpt_fname = 'e{}_s{}_{}'.format(epoch, step,
+                                             self.model_savename)
+        self.write_q.put((self.write, (ckpt_fname, snapshot_state(state))))
+
+    def save_state(self, state):
+        """ Snapshot a training state and queue it to be written """
+        self.check_error()
+        self.write_q.put((atomic_save, (snapshot_state(state),
+                                        self.state_fpath)))
+
+    def load_state(self):
+        """ Last training state written (None if there is none) """
+        if not os.path.exists(self.state_fpath):
+            return None
+        # (it holds the numpy RNG state too)
+        return torch.load(self.state_fpath, weights_only=False)
+
+    def write_loop(self):
+        while True:
+            item = self.write_q.get()
+            try:
+                if item is None:
+                    break
+                if self.error is None:
+                    write_fn, args = item
+                    write_fn(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.write_q.task_done()
+
+    def write(self, ckpt_fname, state):
+        atomic_save(state, os.path.join(self.save_path, ckpt_fname))
+        self.ckpts = [ckpt for ckpt in self.ckpts \
+                      if ckpt['file'] != ckpt_fname]
+        self.ckpts.append({'file':ckpt_fname, 'epoch':state['epoch'],
+                           'step':state['step'],
+                           'val_score':state['val_score']})
+        self.prune()
+
+    def best_ckpts(self):
+        scored = [ckpt for ckpt in self.ckpts \
+                  if ckpt['val_score'] is not None]
+        return sorted(scored, key=lambda ckpt: ckpt['val_score'])
+
+    def prune(self):
+        """ Remove the checkpoints out of the latest and best ones, and
+            update the index
+        """
+        kept = self.ckpts
+        if self.keep_last is not None:
+            kept = kept[-self.keep_last:] if self.keep_last > 0 else []
+        kept_files = set(ckpt['file'] for ckpt in kept)
+        kept_files.update(ckpt['file'] for ckpt in \
+                          self.best_ckpts()[:self.keep_best])
+        removed = [ckpt['file'] for ckpt in self.ckpts \
+                   if ckpt['file'] not in kept_files]
+        self.ckpts = [ckpt for ckpt in self.ckpts \
+                      if ckpt['file'] in kept_files]
+        # the index is updated first: it never points to removed files
+        atomic_save({'checkpoints':self.ckpts, 'best':self.best()},
+                    self.index_fpath, save_fn=json_save)
+        for ckpt_fname in removed:
+            ckpt_fpath = os.path.join(self.save_path, ckpt_fname)
+            if os.path.exists(ckpt_fpath):
+                os.remove(ckpt_fpath)
+
+    def best(self):
+        """ File of the best checkpoint written (None without scores) """
+        best_ckpts = self.best_ckpts()
+        if len(best_ckpts) == 0:
+            return None
+        return best_ckpts[0]['file']
+
+    def check_error(self):
+        if self.error is not None:
+            raise RuntimeError('Checkpoint writer failed') from self.error
+
+    def wait(self):
+        """ Block until the queued checkpoints are written """
+        self.write_q.join()
+        self.check_error()
+
+    def close(self):
+        self.write_q.put(None)
+        self.writer.join()
+        self.check_error()
+
 def write_scalar_log(val, tag, step, log_writer=None):
     if log_writer is not None:
         log_writer.add_scalar(tag, val, step)
@@ -46,131 +548,6 @@ def write_histogram_log(val, tag, step, log_writer=None):
         log_writer.add_histogram(tag, val, step, bins='sturges')
 
 
-def rmse(prediction, groundtruth, spks=None, idx2spk=None):
-    assert prediction.shape == groundtruth.shape
-    # global
-    D = np.asscalar(np.sqrt(np.mean((groundtruth - prediction) ** 2, axis=0)))
-    if spks is not None:
-        spk_durs = {}
-        for (pred, gtruth, spk) in zip(prediction, groundtruth,
-                                       spks):
-            if str(spk) not in spk_durs:
-                spk_durs[str(spk)] = []
-            spk_durs[str(spk)].append((gtruth - pred) ** 2)
-        spks = (spk_durs.keys())
-        for spk in spks:
-            diffs = spk_durs[spk]
-            avg = np.mean(diffs, axis=0)
-            spk_durs[spk] = np.asscalar(np.sqrt(avg))
-        # remake dict if idx2spk available
-        if idx2spk is not None:
-            nspk_durs = {}
-            for spk in spks:
-                nspk_durs[idx2spk[int(spk)]] = spk_durs[spk]
-            return D, nspk_durs
-        return D, spk_durs
-    else:
-        return D
-
-def accuracy(prediction, groundtruth):
-    a = [not x for x in np.logical_xor(prediction, 
-                                       groundtruth)]
-    a = list(map(float, a))
-    return np.sum(a) / len(a)
-
-def fpr(prediction, groundtruth):
-    """ Compute F-measure, Precision and Recall """
-    from sklearn.metrics import precision_score, recall_score, f1_score
-    p = precision_score(groundtruth, prediction)
-    r = recall_score(groundtruth, prediction)
-    f = f1_score(groundtruth, prediction)
-    return f, p, r
-
-def afpr(prediction, groundtruth, spks=None, idx2spk=None):
-    assert prediction.shape == groundtruth.shape
-    #print('afpr prediction shape: ', prediction.shape)
-    #print('min pred uv: ', np.min(prediction))
-    #print('max pred uv: ', np.max(prediction))
-    if prediction.ndim == 1:
-        prediction = prediction.reshape(-1, 1)
-        groundtruth = groundtruth.reshape(-1, 1)
-    if spks is not None:
-        # recursively call afpr for each speaker
-        spk_uvs = {}
-        spk_res = {}
-        for (pred, gtruth, spk) in zip(prediction, groundtruth,
-                                       spks):
-            if str(spk) not in spk_uvs:
-                spk_uvs[str(spk)] = {'preds':[], 'gtruths':[]}
-            spk_uvs[str(spk)]['preds'].append(pred)
-            spk_uvs[str(spk)]['gtruths'].append(gtruth)
-        spks = (spk_uvs.keys())
-        #print('Eval mcd spks: ', spks)
-        for spk in spks:
-            spk_pred = np.array(spk_uvs[spk]['preds'])
-            spk_gtruth = np.array(spk_uvs[spk]['gtruths'])
-            spk_r = afpr(spk_pred, spk_gtruth)
-            for k, v in spk_r.items():
-                if idx2spk is not None:
-                    spk_res['{}.{}'.format(k, idx2spk[int(spk)])] = v
-                else:
-                    spk_res['{}.{}'.format(k, spk)] = v
-        # compute global too
-        #print('Computing global afpr')
-        total_res = afpr(prediction, groundtruth)
-        spk_res['total'] = {}
-        for k, v in total_res.items():
-            spk_res['{}.total'.format(k)] = v
-            spk_res['total']['{}.total'.format(k)] = v
-        return spk_res
-    else:
-        #print('groundtruth.shape: ', groundtruth.shape)
-        #print('prediction.shape: ', prediction.shape)
-        f, p, r = fpr(prediction, groundtruth) 
-        return {'A':accuracy(prediction, groundtruth),
-                'F':f, 'P':p, 'R':r}
-
-def mcd(prediction, groundtruth, spks=None, idx2spk=None):
-    """ Mean Cepstral Distortion 
-        Inputs are matrices of shape (time, cc_order)
-    """
-    assert prediction.shape == groundtruth.shape
-    if spks is not None:
-        # recursively call mcd for each speaker
-        spk_ccs = {}
-        spk_res = {}
-        for (pred, gtruth, spk) in zip(prediction, groundtruth,
-                                       spks):
-            if str(spk) not in spk_ccs:
-                spk_ccs[str(spk)] = {'preds':[], 'gtruths':[]}
-            spk_ccs[str(spk)]['preds'].append(pred)
-            spk_ccs[str(spk)]['gtruths'].append(gtruth)
-        spks = (spk_ccs.keys())
-        #print('Eval mcd spks: ', spks)
-        for spk in spks:
-            spk_pred = np.array(spk_ccs[spk]['preds'])
-            spk_gtruth = np.array(spk_ccs[spk]['gtruths'])
-            if idx2spk is not None:
-                spk_res[idx2spk[int(spk)]] = mcd(spk_pred, spk_gtruth)
-            else:
-                spk_res[spk] = mcd(spk_pred, spk_gtruth)
-        # compute global too
-        spk_res['total'] = mcd(prediction, groundtruth)
-        return spk_res
-    else:
-        #print('groundtruth.shape: ', groundtruth.shape)
-        #print('prediction.shape: ', prediction.shape)
-        mcd_ = 0
-        for t in range(groundtruth.shape[0]):
-            acum = 0
-            for n in range(groundtruth.shape[1]):
-                acum += (groundtruth[t, n] - prediction[t, n]) ** 2
-            mcd_ += np.sqrt(acum)
-        # scale factor
-        alpha = ((10. * np.sqrt(2)) / (groundtruth.shape[0] * np.log(10)))
-        mcd_ = alpha * mcd_
-        return mcd_
-
 def denorm_minmax(y, out_min, out_max):
     # x = y * (max - min) + min
     R = out_max - out_min
@@ -178,151 +555,82 @@ def denorm_minmax(y, out_min, out_max):
     #print('denorm minmax {} -> {}'.format(y, x))
     return x
 
-def predict_masked_mcd(y, aco_b, slen_b, spk_b, curr_ph_b,
-                       preds, gtruths, spks, sil_mask,
-                       sil_id):
-    y_npy = y.cpu().data.transpose(0,1).numpy()
-    aco_npy = aco_b.cpu().data.transpose(0,1).numpy()
-    slens_npy = slen_b.cpu().data.numpy()
-    spk_npy = spk_b.cpu().data.transpose(0,1).numpy()
-    # first, select sequences within permitted lengths (remove pad)
-    for ii, (y_i, aco_i, spk_i, slen_i) in enumerate(zip(y_npy, 
-                                                         aco_npy, 
-                                                         spk_npy, 
-                                                         slens_npy)):
-        # get curr phoneme identity
-        curr_ph_seq = curr_ph_b[ii]
-        # create seq_mask
-        curr_ph_seq_mask = np.zeros((slen_i,))
-        #print('curr_ph_seq: ', curr_ph_seq)
-        for t_ in range(slen_i):
-            curr_ph = curr_ph_seq[t_]
-            if curr_ph != sil_id:
-                curr_ph_seq_mask[t_] = 1.
-            else:
-                curr_ph_seq_mask[t_] = 0.
-        #print('resulting mask: ', curr_ph_seq_mask)
-        if preds is None:
-            #print('Trimming seqlen {}/{}'.format(slen_i, y_i.shape[0]))
-            preds = np.array(y_i[:slen_i], dtype=np.float32)
-            gtruths = np.array(aco_i[:slen_i], dtype=np.float32)
-            spks = spk_i[:slen_i]
-            sil_mask = curr_ph_seq_mask.reshape((-1, 1))
-        else:
-            #print('Trimming seqlen {}/{}'.format(slen_i, y_i.shape[0]))
-            preds = np.concatenate((preds, np.array(y_i[:slen_i],
-                                                    dtype=np.float32)))
-            gtruths = np.concatenate((gtruths, np.array(aco_i[:slen_i],
-                                                        dtype=np.float32)))
-            spks = np.concatenate((spks, spk_i[:slen_i]))
-            #print('concatenating sil_mask shape: ', sil_mask.shape)
-            #print('with curr_ph_seq_mask shape: ', curr_ph_seq_mask.shape)
-            sil_mask = np.concatenate((sil_mask, 
-                                       curr_ph_seq_mask.reshape((-1, 1))))
-    return preds, gtruths, spks, sil_mask
-
-def predict_masked_rmse(y, dur_b, slen_b, spk_b, curr_ph_b,
-                        preds, gtruths, spks, sil_mask,
-                        sil_id,
-                        q_classes):
-    y_npy = y.cpu().data.transpose(0,1).numpy()
-    dur_npy = dur_b.cpu().data.transpose(0,1).numpy()
-    #print('dur_npy max: ', dur_npy.max())
-    #print('dur_npy.shape: ', dur_npy.shape)
-    slens_npy = slen_b.cpu().data.numpy()
-    spk_npy = spk_b.cpu().data.transpose(0,1).numpy()
-    # first, select sequences within permitted lengths (remove pad)
-    for ii, (y_i, dur_i, spk_i, slen_i) in enumerate(zip(y_npy, 
-                                                         dur_npy, 
-                                                         spk_npy, 
-                                                         slens_npy)):
-        # get curr phoneme identity
-        curr_ph_seq = curr_ph_b[ii]
-        # create seq_mask
-        curr_ph_seq_mask = np.zeros((slen_i,))
-        for t_ in range(slen_i):
-            curr_ph = curr_ph_seq[t_]
-            if curr_ph != sil_id:
-                curr_ph_seq_mask[t_] = 1.
-            else:
-                curr_ph_seq_mask[t_] = 0.
-        if preds is None:
-            #print('Trimming seqlen {}/{}'.format(slen_i, y_i.shape[0]))
-            if q_classes:
-                max_y_i = []
-                # have to argmax directly y_i seq
-                for y_i_t in y_i:
-                    max_y_i.append(np.argmax(y_i_t))
-                preds = np.array(max_y_i[:slen_i], dtype=np.float32)
-            else:
-                # just single output y_i_t
-                preds = np.array(y_i[:slen_i], dtype=np.float32)
-            gtruths = np.array(dur_i[:slen_i], dtype=np.float32)
-            spks = spk_i[:slen_i]
-            sil_mask = curr_ph_seq_mask
-        else:
-            #print('Trimming seqlen {}/{}'.format(slen_i, y_i.shape[0]))
-            if q_classes:
-                max_y_i = []
-                # have to argmax directly y_i seq
-                for y_i_t in y_i:
-                    max_y_i.append(np.argmax(y_i_t))
-                preds = np.concatenate((preds, np.array(max_y_i[:slen_i], 
-                                                        dtype=np.float32)))
-            else:
-                preds = np.concatenate((preds, np.array(y_i[:slen_i],
-                                                        dtype=np.float32)))
-            gtruths = np.concatenate((gtruths, np.array(dur_i[:slen_i],
-                                                        dtype=np.float32)))
-            spks = np.concatenate((spks, spk_i[:slen_i]))
-            #print('concatenating sil_mask shape: ', sil_mask.shape)
-            #print('with curr_ph_seq_mask shape: ', curr_ph_seq_mask.shape)
-            sil_mask = np.concatenate((sil_mask, curr_ph_seq_mask))
-    return preds, gtruths, spks, sil_mask
-
-def denorm_dur_preds_gtruth(preds, gtruths, spks, spk2durstats,
-                            q_classes):
-    # denorm based on spk_id stats
-    for ii, (spk_i, dur_i, y_i) in enumerate(zip(spks, gtruths, 
-                                                 preds)):
-        dur_stats = spk2durstats[spk_i]
-        #print('selected dur_stats {} for spk {}'.format(dur_stats, spk_i))
-        if q_classes:
-            kmeans = dur_stats
-            # map gtruths idxes to centroid values
-            ccs = kmeans.cluster_centers_
-            dur_cc = ccs[int(dur_i)][0]
-            #print('Groundtruth cc {} from dur {}'.format(dur_cc,
-            #                                             dur_i))
-            gtruths[ii] = dur_cc
-            # get max of predictions
-            #print('Argmax pred: ', y_i)
-            pred_cc = ccs[int(y_i)]
-            #print('Prediction cc {} from dur {}'.format(pred_cc,
-            #                                            y_i))
-            preds[ii] = pred_cc
-            #print('gtruth: {} s'.format(gtruths[ii]))
-            #print('pred: {} s'.format(preds[ii]))
-        else:
-            dur_min = dur_stats['min']
-            dur_max = dur_stats['max']
-            preds[ii] = denorm_minmax(y_i, dur_min, dur_max)
-            gtruths[ii] = denorm_minmax(dur_i, dur_min, dur_max)
-    return preds, gtruths
-
-
-def denorm_aco_preds_gtruth(preds, gtruths, spks, spk2acostats):
-    # denorm based on spk_id stats
-    for ii, (spk_i, aco_i, y_i) in enumerate(zip(spks, gtruths, 
-                                                 preds)):
-        aco_stats = spk2acostats[spk_i]
-        aco_stats_aco = aco_stats['aco']
-        #print('selected dur_stats {} for spk {}'.format(dur_stats, spk_i))
-        aco_min = aco_stats_aco['min']
-        aco_max = aco_stats_aco['max']
-        preds[ii] = denorm_minmax(y_i, aco_min, aco_max)
-        gtruths[ii] = denorm_minmax(aco_i, aco_min, aco_max)
-    return preds, gtruths
+class DenormTable(object):
+    """ Per-speaker de-normalization of a whole batch of predictions:
+        one gather of the speaker rows of the tables plus one fused
+        multiply-add, x = y * scale[spk] + offset[spk] (min-max stats),
+        or one gather of the centroid of every (spk, class) for
+        quantized durs. y and spks can be numpy arrays or torch tensors
+        (tables are then cached in their device).
+
+        # Arguments
+            scale: (num_spks, ...) max - min of every speaker.
+            offset: (num_spks, ...) min of every speaker.
+            centroids: (num_spks, num_classes) quantization centroids.
+    """
+
+    def __init__(self, scale=None, offset=None, centroids=None):
+        self.tables = {'scale':scale, 'offset':offset,
+                       'centroids':centroids}
+        self.num_spks = len(centroids if centroids is not None else scale)
+        self.dev_tables = {}
+
+    @classmethod
+    def from_aco_stats(cls, spk2acostats):
+        return cls.from_minmax(dict((spk_idx, aco_stats['aco'])
+                                    for spk_idx, aco_stats in \
+                                    spk2acostats.items()))
+
+    @classmethod
+    def from_dur_stats(cls, spk2durstats, q_classes=False):
+        if not q_classes:
+            return cls.from_minmax(spk2durstats)
+        # every speaker has a KMeans of its durs
+        num_spks = max(spk2durstats.keys()) + 1
+        num_ccs = max(len(kmeans.cluster_centers_)
+                      for kmeans in spk2durstats.values())
+        centroids = np.zeros((num_spks, num_ccs))
+        for spk_idx, kmeans in spk2durstats.items():
+            ccs = kmeans.cluster_centers_[:, 0]
+            centroids[spk_idx, :len(ccs)] = ccs
+        return cls(centroids=centroids)
+
+    @classmethod
+    def from_minmax(cls, spk2stats):
+        num_spks = max(spk2stats.keys()) + 1
+        stats_shape = np.shape(next(iter(spk2stats.values()))['min'])
+        scale = np.zeros((num_spks,) + stats_shape)
+        offset = np.zeros((num_spks,) + stats_shape)
+        for spk_idx, stats in spk2stats.items():
+            offset[spk_idx] = stats['min']
+            scale[spk_idx] = np.asarray(stats['max']) - stats['min']
+        return cls(scale, offset)
+
+    def table(self, name, like):
+        """ Table as a tensor in the device (and float dtype) of like """
+        dtype = like.dtype if like.is_floating_point() else torch.float32
+        key = (name, like.device, dtype)
+        if key not in self.dev_tables:
+            self.dev_tables[key] = torch.as_tensor(self.tables[name],
+                                                   dtype=dtype,
+                                                   device=like.device)
+        return self.dev_tables[key]
+
+    def __call__(self, y, spks):
+        """ De-normalize y, whose leading dims are those of spks """
+        if torch.is_tensor(y):
+            spks = spks.long()
+            if self.tables['centroids'] is not None:
+                return self.table('centroids', y)[spks, y.long()]
+            return torch.addcmul(self.table('offset', y)[spks], y,
+                                 self.table('scale', y)[spks])
+        spks = np.asarray(spks).astype(np.int64)
+        if self.tables['centroids'] is not None:
+            x = self.tables['centroids'][spks, np.asarray(y).astype(np.int64)]
+            return x.astype(np.float32)
+        x = y * self.tables['scale'][spks]
+        x += self.tables['offset'][spks]
+        return x.astype(y.dtype)
 
 def apply_pf(cc_pred, pf=1., n_feats=40):
     assert len(cc_pred.shape) == 2, cc_pred.shape
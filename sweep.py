@@ -0,0 +1,179 @@
+import argparse
+from musa.datasets import *
+from musa.sweep import *
+import random
+import json
+import os
+
+
+def build_datasets(opts):
+    """ Build (or load from the cache) the train and valid datasets once,
+        with every utterance whole: each job arranges its own windows
+    """
+    if opts.task == 'dur':
+        trainset = TCSTAR_dur(opts.cfg_spk, 'train',
+                              opts.lab_dir, opts.codebooks_dir,
+                              force_gen=opts.force_gen,
+                              norm_dur=True,
+                              exclude_train_spks=opts.exclude_train_spks,
+                              max_spk_samples=opts.max_samples,
+                              parse_workers=opts.parser_workers,
+                              cache_dir=opts.cache_dir,
+                              storage=opts.storage,
+                              return_arrays=True)
+        validset = TCSTAR_dur(opts.cfg_spk, 'valid',
+                              opts.lab_dir, opts.codebooks_dir,
+                              norm_dur=True,
+                              exclude_eval_spks=opts.exclude_eval_spks,
+                              max_spk_samples=opts.max_samples,
+                              parse_workers=opts.parser_workers,
+                              cache_dir=opts.cache_dir,
+                              storage=opts.storage,
+                              return_arrays=True)
+    else:
+        trainset = TCSTAR_aco(opts.cfg_spk, 'train',
+                              opts.aco_dir, opts.lab_dir,
+                              opts.codebooks_dir,
+                              force_gen=opts.force_gen,
+                              norm_aco=True,
+                              exclude_train_spks=opts.exclude_train_spks,
+                              max_spk_samples=opts.max_samples,
+                              parse_workers=opts.parser_workers,
+                              cache_dir=opts.cache_dir,
+                              storage=opts.storage,
+                              return_arrays=True)
+        validset = TCSTAR_aco(opts.cfg_spk, 'valid',
+                              opts.aco_dir, opts.lab_dir,
+                              opts.codebooks_dir,
+                              norm_aco=True,
+                              exclude_eval_spks=opts.exclude_eval_spks,
+                              max_spk_samples=opts.max_samples,
+                              parse_workers=opts.parser_workers,
+                              cache_dir=opts.cache_dir,
+                              storage=opts.storage,
+                              return_arrays=True)
+    return trainset, validset
+
+def main(opts, grid_types):
+    with open(os.path.join(opts.save_path,
+                           'sweep.opts'), 'w') as opts_f:
+        opts_f.write(json.dumps(vars(opts), indent=2))
+    # check the halving schedule before building anything
+    halving_budgets(opts.min_epochs, opts.epoch, opts.eta)
+    grid = parse_grid(opts.grid, grid_types)
+    configs = expand_grid(grid, opts.spks)
+    if len(configs) == 0:
+        configs = [{}]
+    print('Sweeping {} configs'.format(len(configs)))
+    # options of the jobs: the sweep ones, overridden by every config
+    base_opts = dict(vars(opts))
+    for name in ['grid', 'spks']:
+        del base_opts[name]
+    base_opts['spk'] = None
+    # no job dir is left from a previous sweep
+    job_rows(configs, base_opts)
+    trainset, validset = build_datasets(opts)
+    # the frame stores are moved to shared memory once, and every
+    # worker of the pool serves them from there
+    shared_dsets = {'train':SharedDataset(trainset),
+                    'valid':SharedDataset(validset)}
+    print('Shared {:.2f} MB of frames with the sweep '
+          'workers'.format(sum(shared.nbytes for shared in \
+                               shared_dsets.values()) / 1e6))
+    pool = sweep_pool(shared_dsets, opts.num_jobs, opts.threads_per_job,
+                      start_method=opts.start_method)
+    try:
+        rows = successive_halving(pool, configs, base_opts,
+                                  opts.min_epochs, opts.epoch, eta=opts.eta)
+    finally:
+        pool.close()
+        pool.join()
+        for shared in shared_dsets.values():
+            shared.close()
+    write_summary(rows, os.path.join(opts.save_path, 'summary.tsv'))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--task', type=str, default='dur',
+                        help='Models swept: dur (duration_rnn) or aco '
+                             '(acoustic_rnn) (Def: dur).')
+    parser.add_argument('--grid', type=str, default=[], nargs='+',
+                        help='Swept options, as option=v1,v2,... (e.g. '
+                             'lr=0.001,0.0005 rnn_size=128,256). Every '
+                             'combination is a config (Def: none, the '
+                             'base options only).')
+    parser.add_argument('--spks', type=str, default=None, nargs='+',
+                        help='Train every config as a single speaker '
+                             'model of each one of these speakers (Def: '
+                             'None, all the speakers together).')
+    parser.add_argument('--num_jobs', type=int, default=2,
+                        help='Configs trained concurrently (Def: 2).')
+    parser.add_argument('--threads_per_job', type=int, default=1,
+                        help='Torch/OpenMP threads of every job (Def: 1).')
+    parser.add_argument('--min_epochs', type=int, default=2,
+                        help='Epochs of the first successive halving rung: '
+                             'every rung keeps the best 1/eta configs and '
+                             'trains them eta times longer, up to --epoch '
+                             '(Def: 2).')
+    parser.add_argument('--eta', type=int, default=2,
+                        help='Successive halving reduction factor '
+                             '(Def: 2).')
+    parser.add_argument('--start_method', type=str, default='spawn',
+                        help='Start method of the workers: spawn, '
+                             'forkserver or fork (Def: spawn).')
+    parser.add_argument('--cfg_spk', type=str, default='cfg/tcstar.cfg')
+    parser.add_argument('--lab_dir', type=str, default='data/tcstar/lab')
+    parser.add_argument('--aco_dir', type=str, default='data/tcstar/aco')
+    parser.add_argument('--codebooks_dir', type=str,
+                        default='data/tcstar/codebooks.pkl')
+    parser.add_argument('--save_path', type=str, default='sweep_ckpt')
+    parser.add_argument('--force-gen', action='store_true',
+                        default=False)
+    parser.add_argument('--max_samples', type=int, default=None,
+                        help='Max samples per speaker in the loaders')
+    parser.add_argument('--parser_workers', type=int, default=4)
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Directory to cache the built datasets and '
+                             'reload them in later runs (Def: None).')
+    parser.add_argument('--storage', type=str, default='dense',
+                        help='Frame store of the datasets: dense or compact '
+                             '(Def: dense).')
+    parser.add_argument('--exclude_train_spks', type=str, default=[], nargs='+')
+    parser.add_argument('--exclude_eval_spks', type=str, default=[], nargs='+')
+    parser.add_argument('--epoch', type=int, default=50,
+                        help='Max epochs of the configs that reach the '
+                             'last rung (Def: 50).')
+    # base options of every job, also swept with --grid
+    job_args = parser.add_argument_group('job options')
+    job_args.add_argument('--rnn_size', type=int, default=256)
+    job_args.add_argument('--rnn_layers', type=int, default=1)
+    job_args.add_argument('--emb_size', type=int, default=256)
+    job_args.add_argument('--emb_layers', type=int, default=1)
+    job_args.add_argument('--emb_activation', type=str, default='Tanh')
+    job_args.add_argument('--dout', type=float, default=0.5)
+    job_args.add_argument('--lr', type=float, default=0.001)
+    job_args.add_argument('--optim', type=str, default='Adam')
+    job_args.add_argument('--loss', type=str, default='MSELoss',
+                          help='Options: PyTorch losses (Def: MSELoss)')
+    job_args.add_argument('--batch_size', type=int, default=50)
+    job_args.add_argument('--max_seq_len', type=int, default=None)
+    job_args.add_argument('--no_stateful', action='store_true', default=False)
+    job_args.add_argument('--patience', type=int, default=5)
+    job_args.add_argument('--log_freq', type=int, default=25)
+    job_args.add_argument('--device_prefetch', type=int, default=0,
+                          help='Num of train batches staged ahead by a '
+                               'background thread in every job (Def: 0).')
+    job_args.add_argument('--keep_last', type=int, default=1)
+    job_args.add_argument('--keep_best', type=int, default=1)
+    job_args.add_argument('--seed', type=int, default=1991)
+    job_args.add_argument('--cuda', default=False, action='store_true')
+
+    opts = parser.parse_args()
+    print('Parsed opts: ', json.dumps(vars(opts), indent=2))
+    # every job option can be swept, with its parser type
+    grid_types = dict((action.dest, action.type) for action in \
+                      job_args._group_actions if action.type is not None)
+    if not os.path.exists(opts.save_path):
+        os.makedirs(opts.save_path)
+    random.seed(opts.seed)
+    main(opts, grid_types)
@@ -54,8 +54,7 @@ def main(opts):
         if not opts.force_dur:
             print('-' * 30)
             print('Loading duration model: ', opts.dur_model)
-            dur_model = torch.load(opts.dur_model, 
-                                   map_location=lambda storage, loc: storage)
+            dur_model = load_model(opts.dur_model, map_location=device)
             print('[*] Loaded')
         else:
             print('[!] Dur model NOT loaded')
@@ -64,8 +63,7 @@ def main(opts):
         # build acoustic model and load weights
         print('-' * 30)
         print('Loading acoustic model: ', opts.aco_model)
-        aco_model = torch.load(opts.aco_model,
-                               map_location=lambda storage, loc: storage)
+        aco_model = load_model(opts.aco_model, map_location=device)
         print('[*] Loaded')
         #aco_model.load(opts.aco_model)
         print('>> idx2spk: ', json.dumps(idx2spk, indent=2))
@@ -74,17 +72,29 @@ def main(opts):
             if not opts.force_dur:
                 dur_model.to(device)
         print('aco_model: ', aco_model)
+        if opts.export_dir is not None:
+            # frozen inference graphs, loadable as --dur_model/--aco_model
+            if not os.path.exists(opts.export_dir):
+                os.makedirs(opts.export_dir)
+            if not opts.force_dur:
+                dur_model.export_compiled(os.path.join(opts.export_dir,
+                                                       'dur_model.pt'))
+            aco_model.export_compiled(os.path.join(opts.export_dir,
+                                                   'aco_model.pt'))
+            print('[*] Exported compiled models to ', opts.export_dir)
         # get lab file basename
         lab_fname = os.path.basename(opts.synthesize_lab)
         lab_bname, _ = os.path.splitext(lab_fname)
         if mcfg['model_type'] in ['satt', 'decsatt']:
             att_synthesize(dur_model, aco_model, opts.spk_id, spk2durstats, spk2acostats,
                            opts.save_path, lab_bname, opts.codebooks_dir, opts.synthesize_lab, 
-                           cuda=opts.cuda, force_dur=opts.force_dur, pf=opts.pf)
+                           cuda=opts.cuda, force_dur=opts.force_dur, pf=opts.pf,
+                           precision=opts.precision)
         else:
             synthesize(dur_model, aco_model, opts.spk_id, spk2durstats, spk2acostats,
                        opts.save_path, lab_bname, opts.codebooks_dir, opts.synthesize_lab, 
-                       cuda=opts.cuda, force_dur=opts.force_dur, pf=opts.pf)
+                       cuda=opts.cuda, force_dur=opts.force_dur, pf=opts.pf,
+                       precision=opts.precision)
 
 
 if __name__ == '__main__':
@@ -150,11 +160,18 @@ if __name__ == '__main__':
     parser.add_argument('--loader_workers', type=int, default=2)
     parser.add_argument('--parser_workers', type=int, default=4)
     parser.add_argument('--cuda', default=False, action='store_true')
+    parser.add_argument('--precision', type=str, default='fp32',
+                        choices=PRECISIONS,
+                        help='Precision of the dur and aco forward passes: '
+                             'fp32 or bf16 autocast (Def: fp32).')
     parser.add_argument('--dur_mulout', default=False, action='store_true')
     parser.add_argument('--aco_mulout', default=False, action='store_true')
     parser.add_argument('--exclude_train_spks', type=str, default=[], nargs='+')
     parser.add_argument('--exclude_eval_spks', type=str, default=[], nargs='+')
     parser.add_argument('--model_cfg', type=str, default=None)
+    parser.add_argument('--export_dir', type=str, default=None,
+                        help='Export the loaded models as compiled '
+                             'inference graphs to this dir (Def: None).')
 
     opts = parser.parse_args()
     print('Parsed opts: ', json.dumps(vars(opts), indent=2))
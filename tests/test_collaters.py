@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader
+from musa.datasets.collaters import varlen_dur_collate, varlen_aco_collate
+from musa.datasets.collaters import VarlenCollater
+from musa.datasets.storage import FrameWindow, CompactFrames
+from musa.utils import DevicePrefetcher
+
+
+LAB_DIM = 12
+
+def make_samples(seq_lens, out_dim=None, int_outs=False, seed=0):
+    """ The same random sequences as lists of (spk_idx, in, out) frames
+        and as FrameWindow samples, both with their (ph_ids, sil_flags)
+    """
+    rng = np.random.RandomState(seed)
+    seqs = []
+    wins = []
+    for seq_len in seq_lens:
+        spk_idx = rng.randint(0, 3)
+        # binary and real valued label columns
+        labs = np.concatenate((rng.randint(0, 2, (seq_len, LAB_DIM // 2)),
+                               rng.rand(seq_len, LAB_DIM // 2)),
+                              axis=1).astype(np.float32)
+        if int_outs:
+            outs = rng.randint(1, 10, seq_len).astype(np.int64)
+        elif out_dim is None:
+            outs = rng.rand(seq_len).astype(np.float32)
+        else:
+            outs = rng.rand(seq_len, out_dim).astype(np.float32)
+        phs = (rng.randint(1, 40, seq_len).astype(np.int64),
+               rng.rand(seq_len) < 0.2)
+        seqs.append(([(spk_idx, lab, out) for lab, out in zip(labs, outs)],
+                     phs))
+        wins.append((FrameWindow(spk_idx, labs, outs), phs))
+    return seqs, wins
+
+def assert_same_batch(batch, ref_batch):
+    assert len(batch) == len(ref_batch)
+    for tensor, ref_tensor in zip(batch, ref_batch):
+        assert tensor.dtype == ref_tensor.dtype
+        assert tensor.shape == ref_tensor.shape
+        assert torch.equal(tensor, ref_tensor)
+
+# longer batches first, so that the reused buffers hold stale frames
+# beyond the padding of the shorter ones
+BATCH_LENS = [[17, 5, 11], [9, 3], [4, 8, 2, 6], [20]]
+
+@pytest.mark.parametrize('int_outs', [False, True])
+def test_varlen_collater_dur(int_outs):
+    collater = VarlenCollater(num_buffers=2)
+    for b_idx, seq_lens in enumerate(BATCH_LENS):
+        seqs, wins = make_samples(seq_lens, int_outs=int_outs, seed=b_idx)
+        ref_batch = varlen_dur_collate(seqs)
+        assert_same_batch(collater(wins), ref_batch)
+        # FrameWindow samples of the former collate functions
+        assert_same_batch(varlen_dur_collate(wins), ref_batch)
+
+def test_varlen_collater_aco():
+    collater = VarlenCollater(num_buffers=2)
+    for b_idx, seq_lens in enumerate(BATCH_LENS):
+        seqs, wins = make_samples(seq_lens, out_dim=43, seed=b_idx)
+        ref_batch = varlen_aco_collate(seqs)
+        assert_same_batch(collater(wins), ref_batch)
+        assert_same_batch(varlen_aco_collate(wins), ref_batch)
+
+def test_varlen_collater_compact():
+    # compact frames are decoded into the padded batch as well
+    collater = VarlenCollater(num_buffers=1)
+    for b_idx, seq_lens in enumerate(BATCH_LENS):
+        _, wins = make_samples(seq_lens, out_dim=43, seed=b_idx)
+        wins = [(FrameWindow(win.spk_idx,
+                             CompactFrames.from_dense(win.in_frames),
+                             CompactFrames.from_dense(win.out_frames,
+                                                      scale_reals=True)),
+                 phs) for win, phs in wins]
+        assert_same_batch(collater(wins), varlen_aco_collate(wins))
+
+@pytest.mark.parametrize('num_buffers', [1, 2, 4])
+def test_varlen_collater_prefetch(num_buffers):
+    # batches held after the loader moved on keep their frames, whatever
+    # the size of the ring compared to the prefetch depth
+    wins = []
+    ref_batches = []
+    for b_idx, seq_lens in enumerate(BATCH_LENS):
+        seqs, b_wins = make_samples(seq_lens, out_dim=43, seed=b_idx)
+        wins.extend(b_wins)
+        ref_batches.append(varlen_aco_collate(seqs))
+    batch_idxs = []
+    for seq_lens in BATCH_LENS:
+        beg = sum(len(idxs) for idxs in batch_idxs)
+        batch_idxs.append(list(range(beg, beg + len(seq_lens))))
+    dloader = DataLoader(wins, batch_sampler=batch_idxs,
+                         collate_fn=VarlenCollater(num_buffers=num_buffers))
+    batches = list(DevicePrefetcher(dloader, depth=2))
+    assert len(batches) == len(ref_batches)
+    for batch, ref_batch in zip(batches, ref_batches):
+        assert_same_batch(batch, ref_batch)
@@ -0,0 +1,36 @@
+import numpy as np
+import torch
+from musa.core import eval_dur_epoch
+from musa.models import duration_rnn
+
+
+LAB_DIM = 10
+IDX2SPK = {0:'72', 1:'73'}
+SPK2DURSTATS = {0:{'min':0., 'max':0.5}, 1:{'min':0.1, 'max':0.3}}
+
+def spk_batches(num_batches=4, seq_len=7, batch_size=3, seed=0):
+    """ Time-major dur batches of a single speaker each, as the MO
+        sampler yields them
+    """
+    rng = np.random.RandomState(seed)
+    batches = []
+    for b_idx in range(num_batches):
+        spk_idx = b_idx % len(IDX2SPK)
+        slens = rng.randint(1, seq_len + 1, batch_size)
+        batches.append((torch.full((seq_len, batch_size), spk_idx,
+                                   dtype=torch.long),
+                        torch.rand(seq_len, batch_size, LAB_DIM),
+                        torch.rand(seq_len, batch_size),
+                        torch.from_numpy(slens),
+                        torch.zeros(seq_len, batch_size, dtype=torch.long),
+                        torch.zeros(seq_len, batch_size, dtype=torch.bool)))
+    return batches
+
+def test_eval_dur_mulout():
+    torch.manual_seed(0)
+    model = duration_rnn(LAB_DIM, 1, 8, 8, 1, 0., sigmoid_out=True,
+                         speakers=list(IDX2SPK.values()), mulout=True)
+    res = eval_dur_epoch(model, spk_batches(), 0, stats=SPK2DURSTATS,
+                         va_opts={'idx2spk':IDX2SPK, 'mulout':True})
+    assert sorted(k for k in res if k in IDX2SPK.values()) == ['72', '73']
+    assert np.isfinite(res['eval_total_dur_rmse'])
@@ -0,0 +1,190 @@
+import warnings
+import numpy as np
+import pytest
+from musa.metrics import rmse, afpr, mcd
+
+
+# Reference metrics: the former per-frame implementations of
+# musa/utils.py (np.asscalar replaced by .item())
+
+def ref_rmse(prediction, groundtruth, spks=None, idx2spk=None):
+    assert prediction.shape == groundtruth.shape
+    # global
+    D = np.sqrt(np.mean((groundtruth - prediction) ** 2, axis=0)).item()
+    if spks is not None:
+        spk_durs = {}
+        for (pred, gtruth, spk) in zip(prediction, groundtruth,
+                                       spks):
+            if str(spk) not in spk_durs:
+                spk_durs[str(spk)] = []
+            spk_durs[str(spk)].append((gtruth - pred) ** 2)
+        spks = (spk_durs.keys())
+        for spk in spks:
+            diffs = spk_durs[spk]
+            avg = np.mean(diffs, axis=0)
+            spk_durs[spk] = np.sqrt(avg).item()
+        # remake dict if idx2spk available
+        if idx2spk is not None:
+            nspk_durs = {}
+            for spk in spks:
+                nspk_durs[idx2spk[int(spk)]] = spk_durs[spk]
+            return D, nspk_durs
+        return D, spk_durs
+    else:
+        return D
+
+def ref_accuracy(prediction, groundtruth):
+    a = [not x for x in np.logical_xor(prediction,
+                                       groundtruth)]
+    a = list(map(float, a))
+    return np.sum(a) / len(a)
+
+def ref_fpr(prediction, groundtruth):
+    from sklearn.metrics import precision_score, recall_score, f1_score
+    p = precision_score(groundtruth, prediction)
+    r = recall_score(groundtruth, prediction)
+    f = f1_score(groundtruth, prediction)
+    return f, p, r
+
+def ref_afpr(prediction, groundtruth, spks=None, idx2spk=None):
+    assert prediction.shape == groundtruth.shape
+    if prediction.ndim == 1:
+        prediction = prediction.reshape(-1, 1)
+        groundtruth = groundtruth.reshape(-1, 1)
+    if spks is not None:
+        # recursively call afpr for each speaker
+        spk_uvs = {}
+        spk_res = {}
+        for (pred, gtruth, spk) in zip(prediction, groundtruth,
+                                       spks):
+            if str(spk) not in spk_uvs:
+                spk_uvs[str(spk)] = {'preds':[], 'gtruths':[]}
+            spk_uvs[str(spk)]['preds'].append(pred)
+            spk_uvs[str(spk)]['gtruths'].append(gtruth)
+        spks = (spk_uvs.keys())
+        for spk in spks:
+            spk_pred = np.array(spk_uvs[spk]['preds'])
+            spk_gtruth = np.array(spk_uvs[spk]['gtruths'])
+            spk_r = ref_afpr(spk_pred, spk_gtruth)
+            for k, v in spk_r.items():
+                if idx2spk is not None:
+                    spk_res['{}.{}'.format(k, idx2spk[int(spk)])] = v
+                else:
+                    spk_res['{}.{}'.format(k, spk)] = v
+        # compute global too
+        total_res = ref_afpr(prediction, groundtruth)
+        spk_res['total'] = {}
+        for k, v in total_res.items():
+            spk_res['{}.total'.format(k)] = v
+            spk_res['total']['{}.total'.format(k)] = v
+        return spk_res
+    else:
+        f, p, r = ref_fpr(prediction, groundtruth)
+        return {'A':ref_accuracy(prediction, groundtruth),
+                'F':f, 'P':p, 'R':r}
+
+def ref_mcd(prediction, groundtruth, spks=None, idx2spk=None):
+    assert prediction.shape == groundtruth.shape
+    if spks is not None:
+        # recursively call mcd for each speaker
+        spk_ccs = {}
+        spk_res = {}
+        for (pred, gtruth, spk) in zip(prediction, groundtruth,
+                                       spks):
+            if str(spk) not in spk_ccs:
+                spk_ccs[str(spk)] = {'preds':[], 'gtruths':[]}
+            spk_ccs[str(spk)]['preds'].append(pred)
+            spk_ccs[str(spk)]['gtruths'].append(gtruth)
+        spks = (spk_ccs.keys())
+        for spk in spks:
+            spk_pred = np.array(spk_ccs[spk]['preds'])
+            spk_gtruth = np.array(spk_ccs[spk]['gtruths'])
+            if idx2spk is not None:
+                spk_res[idx2spk[int(spk)]] = ref_mcd(spk_pred, spk_gtruth)
+            else:
+                spk_res[spk] = ref_mcd(spk_pred, spk_gtruth)
+        # compute global too
+        spk_res['total'] = ref_mcd(prediction, groundtruth)
+        return spk_res
+    else:
+        mcd_ = 0
+        for t in range(groundtruth.shape[0]):
+            acum = 0
+            for n in range(groundtruth.shape[1]):
+                acum += (groundtruth[t, n] - prediction[t, n]) ** 2
+            mcd_ += np.sqrt(acum)
+        # scale factor
+        alpha = ((10. * np.sqrt(2)) / (groundtruth.shape[0] * np.log(10)))
+        mcd_ = alpha * mcd_
+        return mcd_
+
+
+# random frames of 3 speakers, real valued ones in float64 so that the
+# float32 accumulations of the reference do not hide differences of
+# the formulas
+IDX2SPK = {0:'72', 1:'73', 2:'75'}
+
+def spk_frames(num_frames=300, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng, rng.randint(0, len(IDX2SPK), size=num_frames)
+
+def ref_afpr_quiet(*args, **kwargs):
+    # sklearn warns of the column vectors and the undefined P/R/F
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return ref_afpr(*args, **kwargs)
+
+def assert_close_results(res, ref_res):
+    if isinstance(ref_res, dict):
+        assert sorted(res.keys()) == sorted(ref_res.keys())
+        for k in ref_res:
+            assert_close_results(res[k], ref_res[k])
+    elif isinstance(ref_res, tuple):
+        assert len(res) == len(ref_res)
+        for val, ref_val in zip(res, ref_res):
+            assert_close_results(val, ref_val)
+    else:
+        assert res == pytest.approx(float(ref_res), rel=1e-9, abs=1e-12)
+
+@pytest.mark.parametrize('idx2spk', [None, IDX2SPK])
+def test_rmse(idx2spk):
+    rng, spks = spk_frames()
+    gtruth = rng.rand(len(spks))
+    pred = rng.rand(len(spks))
+    assert_close_results(rmse(pred, gtruth), ref_rmse(pred, gtruth))
+    assert_close_results(rmse(pred, gtruth, spks, idx2spk),
+                         ref_rmse(pred, gtruth, spks, idx2spk))
+
+@pytest.mark.parametrize('idx2spk', [None, IDX2SPK])
+def test_mcd(idx2spk):
+    rng, spks = spk_frames()
+    gtruth = rng.randn(len(spks), 40)
+    pred = rng.randn(len(spks), 40)
+    assert_close_results(mcd(pred, gtruth), ref_mcd(pred, gtruth))
+    assert_close_results(mcd(pred, gtruth, spks, idx2spk),
+                         ref_mcd(pred, gtruth, spks, idx2spk))
+
+@pytest.mark.parametrize('idx2spk', [None, IDX2SPK])
+def test_afpr(idx2spk):
+    rng, spks = spk_frames()
+    gtruth = rng.randint(0, 2, size=len(spks)).astype(np.float32)
+    pred = rng.randint(0, 2, size=len(spks)).astype(np.float32)
+    assert_close_results(afpr(pred, gtruth), ref_afpr_quiet(pred, gtruth))
+    assert_close_results(afpr(pred, gtruth, spks, idx2spk),
+                         ref_afpr_quiet(pred, gtruth, spks, idx2spk))
+
+def test_afpr_all_unvoiced():
+    # no voiced frames at all: P, R and F are undefined, and reported
+    # as 0 like sklearn does
+    rng, spks = spk_frames()
+    zeros = np.zeros(len(spks), dtype=np.float32)
+    assert_close_results(afpr(zeros, zeros), ref_afpr_quiet(zeros, zeros))
+    assert_close_results(afpr(zeros, zeros, spks, IDX2SPK),
+                         ref_afpr_quiet(zeros, zeros, spks, IDX2SPK))
+    # only one speaker without voiced frames, nor predicted ones
+    gtruth = rng.randint(0, 2, size=len(spks)).astype(np.float32)
+    pred = rng.randint(0, 2, size=len(spks)).astype(np.float32)
+    gtruth[spks == 1] = 0
+    pred[spks == 1] = 0
+    assert_close_results(afpr(pred, gtruth, spks, IDX2SPK),
+                         ref_afpr_quiet(pred, gtruth, spks, IDX2SPK))
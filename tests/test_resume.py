@@ -0,0 +1,99 @@
+import random
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.utils.data import Dataset, DataLoader
+from musa.core import train_engine, train_aco_epoch
+from musa.datasets.collaters import varlen_aco_collate
+from musa.datasets.sampler import BucketBatchSampler
+from musa.datasets.storage import FrameWindow
+from musa.models import acoustic_rnn
+
+
+LAB_DIM = 10
+ACO_DIM = 43
+
+class RandomCropDataset(Dataset):
+    """ Random utterances served as one random crop per epoch, so that
+        the loader draws from the python RNG for every sample
+    """
+
+    def __init__(self, num_utts=24, max_seq_len=12, seed=0):
+        rng = np.random.RandomState(seed)
+        self.max_seq_len = max_seq_len
+        self.utts = []
+        for _ in range(num_utts):
+            seq_len = rng.randint(4, 2 * max_seq_len)
+            self.utts.append((rng.rand(seq_len, LAB_DIM).astype(np.float32),
+                              rng.rand(seq_len, ACO_DIM).astype(np.float32)))
+
+    def window_lens(self):
+        return [min(len(labs), self.max_seq_len) for labs, _ in self.utts]
+
+    def __len__(self):
+        return len(self.utts)
+
+    def __getitem__(self, index):
+        labs, acos = self.utts[index]
+        beg = 0
+        if len(labs) > self.max_seq_len:
+            beg = random.randint(0, len(labs) - self.max_seq_len)
+        end = beg + min(len(labs), self.max_seq_len)
+        seq_len = end - beg
+        return FrameWindow(0, labs[beg:end], acos[beg:end]), \
+               (np.zeros(seq_len, dtype=np.int64),
+                np.zeros(seq_len, dtype=np.bool_))
+
+class Interrupted(Exception):
+    pass
+
+class InterruptingLoss(object):
+    """ MSE loss raising Interrupted at its stop_at-th call """
+
+    def __init__(self, stop_at=None):
+        self.calls = 0
+        self.stop_at = stop_at
+        self.criterion = nn.MSELoss()
+
+    def __call__(self, y, target):
+        self.calls += 1
+        if self.calls == self.stop_at:
+            raise Interrupted()
+        return self.criterion(y, target)
+
+SPK2ACOSTATS = {0:{'aco':{'min':np.zeros(ACO_DIM),
+                          'max':np.ones(ACO_DIM)}}}
+
+def train(save_path, stop_at=None, resume=False, epochs=2):
+    torch.manual_seed(0)
+    np.random.seed(0)
+    random.seed(0)
+    dset = RandomCropDataset()
+    dloader = DataLoader(dset, collate_fn=varlen_aco_collate,
+                         batch_sampler=BucketBatchSampler(dset.window_lens(),
+                                                          3))
+    model = acoustic_rnn(LAB_DIM, 8, 8, 2, 0.5)
+    opt = optim.Adam(model.parameters(), lr=0.01)
+    train_engine(model, dloader, opt, 2, train_aco_epoch,
+                 InterruptingLoss(stop_at), epochs, str(save_path),
+                 'aco_model.ckpt',
+                 tr_opts={'spk2acostats':SPK2ACOSTATS, 'prefetch':2},
+                 snapshot_every=2, resume=resume)
+    return model, len(dloader)
+
+def test_resume_mid_epoch(tmp_path):
+    ref_model, num_batches = train(tmp_path / 'ref')
+    # interrupted within the 2nd epoch, after its 2nd batch snapshot
+    with pytest.raises(Interrupted):
+        train(tmp_path / 'run', stop_at=num_batches + 4)
+    state = torch.load(tmp_path / 'run' / 'aco_model.ckpt.state',
+                       weights_only=False)
+    assert (state['epoch'], state['batch']) == (1, 2)
+    model, _ = train(tmp_path / 'run', resume=True)
+    for name, param in ref_model.state_dict().items():
+        assert torch.equal(param, model.state_dict()[name]), name
+    for loss_fname in ['tr_loss.npy', 'tr_mcd.npy']:
+        assert np.array_equal(np.load(tmp_path / 'ref' / loss_fname),
+                              np.load(tmp_path / 'run' / loss_fname))
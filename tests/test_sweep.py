@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from musa.sweep import halve, job_rows
+
+
+def rows_of(scores, stopped=(), spk=None):
+    rows = []
+    for i, score in enumerate(scores):
+        rows.append({'id':'job{}'.format(i), 'config':{'lr':i, 'spk':spk},
+                     'score':score, 'stopped':i in stopped, 'error':None})
+    return rows
+
+def test_halve_skips_stopped():
+    # the best config is out of patience: the next ones are kept instead
+    rows = rows_of([0.1, 0.5, 0.3, 0.4], stopped=(0,))
+    assert [row['id'] for row in halve(rows, 2)] == ['job2', 'job3']
+    # and failed ones are never kept
+    rows = rows_of([np.inf, 0.5], spk='72')
+    rows[0]['error'] = 'failed'
+    assert [row['id'] for row in halve(rows, 2)] == ['job1']
+
+def test_job_rows(tmp_path):
+    base_opts = {'save_path':str(tmp_path), 'rnn_size':16, 'spk':None}
+    configs = [{'lr':0.01}, {'lr':0.001}]
+    rows = job_rows(configs, base_opts)
+    ids = [row['id'] for row in rows]
+    assert len(set(ids)) == 2
+    # ids follow the options, not the order of the configs
+    assert [row['id'] for row in job_rows(configs[::-1], base_opts)] == \
+           ids[::-1]
+    (tmp_path / ids[1]).mkdir()
+    with pytest.raises(ValueError):
+        job_rows(configs, base_opts)
@@ -13,6 +13,17 @@ import os
 
 
 def get_data_loaders(opts):
+    if opts.fast_collate:
+        # windows are served as arrays and copied into reused buffers
+        pin_memory = opts.cuda and opts.loader_workers == 0
+        # a ring as deep as the batches held by the device prefetcher,
+        # which otherwise copies them so they are not overwritten
+        collate_fn = VarlenCollater(num_buffers=opts.device_prefetch + 2,
+                                    pin_memory=pin_memory)
+        va_collate_fn = VarlenCollater(pin_memory=pin_memory)
+    else:
+        collate_fn = varlen_aco_collate
+        va_collate_fn = varlen_aco_collate
     bsize = opts.batch_size
     if opts.no_stateful:
         bsize =None
@@ -26,18 +37,76 @@ def get_data_loaders(opts):
                           max_spk_samples=opts.max_samples,
                           mulout=opts.mulout,
                           norm_aco=True,
-                          exclude_train_spks=opts.exclude_train_spks)
+                          exclude_train_spks=opts.exclude_train_spks,
+                          window_mode=opts.window_mode,
+                          window_stride=opts.window_stride,
+                          cache_dir=opts.cache_dir,
+                          storage=opts.storage,
+                          prefetch_depth=opts.prefetch_depth,
+                          return_arrays=opts.fast_collate)
+    batch_sampler = None
+    sampler = None
+    shuffle = True
+    if opts.mo_packed and not opts.mulout:
+        raise ValueError('Packed MO batches (--mo_packed) require --mulout.')
     if opts.mulout:
-        sampler = MOSampler(trainset.len_by_spk(), trainset, opts.batch_size)
+        # every batch holds samples of a single speaker, or with
+        # mo_packed, the samples of all the speakers of a round
+        batch_sampler = MOSampler(trainset.len_by_spk(), trainset,
+                                  opts.batch_size, randomize_rounds=True,
+                                  temperature=opts.mo_temperature,
+                                  pack_rounds=opts.mo_packed)
+    elif opts.max_seq_len is not None and bsize is not None:
+        # serve the windows in stateful order: shuffling them would
+        # break the continuity of the hidden states between batches
+        sampler = StatefulSampler(trainset, opts.batch_size)
         shuffle = False
-    else:
-        sampler = None
-        shuffle = True
 
-    train_loader = DataLoader(trainset, batch_size=opts.batch_size, shuffle=shuffle,
-                              num_workers=opts.loader_workers, 
-                              sampler=sampler,
-                              collate_fn=varlen_aco_collate)
+    if opts.bucketing:
+        if opts.mulout or bsize is not None:
+            raise ValueError('Length bucketing requires non-stateful (--no_stateful) '
+                             'and non-MO training.')
+        # batch samples of similar lengths to reduce padding
+        batch_sampler = BucketBatchSampler(trainset.window_lens(),
+                                           opts.batch_size,
+                                           boundaries=opts.bucket_boundaries,
+                                           megabatch=opts.megabatch)
+    if opts.max_batch_frames is not None:
+        if opts.mulout or bsize is not None or opts.bucketing:
+            raise ValueError('Token budget batching requires non-stateful '
+                             '(--no_stateful), non-MO and non-bucketed '
+                             'training.')
+        if opts.model_type not in ['satt', 'decsatt']:
+            raise ValueError('Token budget batching is only available for '
+                             'the self-attention models (RNN states are '
+                             'kept for a fixed batch size).')
+        # fill every batch up to a budget of (squared) frames
+        batch_sampler = TokenBudgetBatchSampler(trainset.window_lens(),
+                                                opts.max_batch_frames,
+                                                cost=opts.batch_cost)
+    if opts.pack_len is not None:
+        if opts.mulout or bsize is not None:
+            raise ValueError('Sequence packing requires non-stateful '
+                             '(--no_stateful) and non-MO training.')
+        if opts.model_type != 'satt' or opts.conv_out:
+            raise ValueError('Sequence packing is only available for the '
+                             'satt model without conv_out (convolutions '
+                             'would mix the packed sequences).')
+        if opts.max_seq_len is None or opts.max_seq_len > opts.pack_len:
+            raise ValueError('Sequence packing requires max_seq_len <= '
+                             'pack_len.')
+        # batch samples are packed into rows of pack_len frames
+        collate_fn = PackingCollater(opts.pack_len)
+    if batch_sampler is not None:
+        train_loader = DataLoader(trainset, batch_sampler=batch_sampler,
+                                  num_workers=opts.loader_workers,
+                                  collate_fn=collate_fn)
+    else:
+        train_loader = DataLoader(trainset, batch_size=opts.batch_size,
+                                  shuffle=shuffle,
+                                  num_workers=opts.loader_workers, 
+                                  sampler=sampler,
+                                  collate_fn=collate_fn)
 
     val_dset = TCSTAR_aco(opts.cfg_spk, 'valid', opts.aco_dir,
                           opts.lab_dir, opts.codebooks_dir,
@@ -47,17 +116,31 @@ def get_data_loaders(opts):
                           parse_workers=opts.parser_workers,
                           max_seq_len=opts.max_seq_len,
                           batch_size=bsize,
-                          mulout=opts.mulout)
+                          mulout=opts.mulout,
+                          window_stride=opts.window_stride,
+                          cache_dir=opts.cache_dir,
+                          storage=opts.storage,
+                          prefetch_depth=opts.prefetch_depth,
+                          return_arrays=opts.fast_collate)
     # build validation dataset and loader
     if opts.mulout:
         va_sampler = MOSampler(val_dset.len_by_spk(), val_dset, opts.batch_size)
+        valid_loader = DataLoader(val_dset, batch_sampler=va_sampler,
+                                  num_workers=opts.loader_workers, 
+                                  collate_fn=va_collate_fn)
+    elif opts.max_batch_frames is not None:
+        va_sampler = TokenBudgetBatchSampler(val_dset.window_lens(),
+                                             opts.max_batch_frames,
+                                             cost=opts.batch_cost,
+                                             shuffle=False)
+        valid_loader = DataLoader(val_dset, batch_sampler=va_sampler,
+                                  num_workers=opts.loader_workers,
+                                  collate_fn=va_collate_fn)
     else:
-        va_sampler = None
-    valid_loader = DataLoader(val_dset, batch_size=opts.batch_size,
-                              shuffle=False,
-                              num_workers=opts.loader_workers, 
-                              sampler=va_sampler,
-                              collate_fn=varlen_aco_collate)
+        valid_loader = DataLoader(val_dset, batch_size=opts.batch_size,
+                                  shuffle=False,
+                                  num_workers=opts.loader_workers, 
+                                  collate_fn=va_collate_fn)
     return train_loader, valid_loader, trainset
 
 def main(opts):
@@ -108,10 +191,15 @@ def main(opts):
     patience = opts.patience
     tr_opts = {'spk2acostats':spk2acostats,
                'idx2spk':trainset.idx2spk}
+    tr_opts['prefetch'] = opts.device_prefetch
+    tr_opts['metric_every'] = opts.train_metric_every
     va_opts = {'idx2spk':trainset.idx2spk}
+    tr_opts['precision'] = opts.precision
+    va_opts['precision'] = opts.precision
     if opts.mulout:
         tr_opts['mulout'] = True
         va_opts['mulout'] = True
+        tr_opts['mo_packed'] = opts.mo_packed
     if opts.model_type == 'decsatt':
         tr_opts['decoder'] = True
         va_opts['decoder'] = True
@@ -128,7 +216,14 @@ def main(opts):
                  eval_patience=opts.patience,
                  cuda=opts.cuda,
                  va_opts=va_opts,
-                 log_writer=writer)
+                 log_writer=writer,
+                 keep_last=opts.keep_last,
+                 keep_best=opts.keep_best,
+                 snapshot_every=opts.snapshot_every,
+                 resume=opts.resume,
+                 eval_every=opts.eval_every,
+                 eval_batches=opts.eval_batches,
+                 full_eval_every=opts.full_eval_every)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -174,10 +269,98 @@ if __name__ == '__main__':
     parser.add_argument('--emb_activation', type=str, default='Tanh')
     parser.add_argument('--out_activation', type=str, default='Sigmoid')
     parser.add_argument('--max_seq_len', type=int, default=None)
+    parser.add_argument('--window_mode', type=str, default='stride',
+                        help='Non-stateful windowing of train utterances: '
+                             'stride or random (Def: stride).')
+    parser.add_argument('--window_stride', type=int, default=None,
+                        help='Hop of stride windows (Def: max_seq_len).')
     parser.add_argument('--loader_workers', type=int, default=2)
     parser.add_argument('--parser_workers', type=int, default=4)
+    parser.add_argument('--prefetch_depth', type=int, default=8,
+                        help='Num of lab/aco files read ahead by threads '
+                             'in every parser worker (Def: 8).')
+    parser.add_argument('--device_prefetch', type=int, default=2,
+                        help='Num of train batches staged ahead (copied to '
+                             'the device) by a background thread. 0 '
+                             'stages them synchronously (Def: 2).')
+    parser.add_argument('--keep_last', type=int, default=3,
+                        help='Num of latest epoch checkpoints kept '
+                             '(Def: 3).')
+    parser.add_argument('--keep_best', type=int, default=1,
+                        help='Num of best validation checkpoints kept '
+                             '(Def: 1).')
+    parser.add_argument('--snapshot_every', type=int, default=0,
+                        help='Write the training state every N train '
+                             'batches, besides at the end of every '
+                             'epoch (Def: 0, only at epoch ends).')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='Resume from the last training state '
+                             'written in save_path.')
+    parser.add_argument('--eval_every', type=int, default=0,
+                        help='Also validate every N train steps, with the '
+                             'patience and best checkpoints following '
+                             'these validations (Def: 0, only full '
+                             'validations at epoch ends).')
+    parser.add_argument('--eval_batches', type=int, default=None,
+                        help='Num of validation batches (a fixed, evenly '
+                             'spaced subset) of the --eval_every '
+                             'validations (Def: None, all of them).')
+    parser.add_argument('--full_eval_every', type=int, default=1,
+                        help='Run the full validation every N epochs, 0 '
+                             'for never (Def: 1).')
+    parser.add_argument('--precision', type=str, default='fp32',
+                        choices=PRECISIONS,
+                        help='Precision of the forward passes: fp32 or '
+                             'bf16 (autocast, with LayerNorm, softmax, '
+                             'losses and metrics in fp32) (Def: fp32).')
+    parser.add_argument('--train_metric_every', type=int, default=1,
+                        help='Accumulate the train MCD (in the device) '
+                             'every N batches. 0 disables it (Def: 1).')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Directory to cache the built datasets and '
+                             'reload them in later runs (Def: None).')
+    parser.add_argument('--bucketing', action='store_true', default=False,
+                        help='Batch non-stateful train samples of similar '
+                             'length together.')
+    parser.add_argument('--bucket_boundaries', type=int, nargs='+',
+                        default=None,
+                        help='Lengths splitting the buckets (Def: length '
+                             'quantiles).')
+    parser.add_argument('--megabatch', type=int, default=None,
+                        help='Sort bucket samples by length within chunks '
+                             'of this many batches (Def: None).')
+    parser.add_argument('--max_batch_frames', type=int, default=None,
+                        help='If specified, non-stateful batches are filled '
+                             'up to this budget of padded frames (see '
+                             '--batch_cost) instead of --batch_size '
+                             'samples (Def: None).')
+    parser.add_argument('--batch_cost', type=str, default='frames',
+                        help='Cost counted against --max_batch_frames: '
+                             'frames (num_seqs * max_len) or frames2 '
+                             '(num_seqs * max_len ** 2, for self-attention) '
+                             '(Def: frames).')
+    parser.add_argument('--pack_len', type=int, default=None,
+                        help='If specified, the train batch sequences are '
+                             'packed into rows of pack_len frames, attending '
+                             'only within themselves (satt model) '
+                             '(Def: None).')
+    parser.add_argument('--fast_collate', action='store_true', default=False,
+                        help='Serve samples as arrays and collate them '
+                             'into reused buffers.')
+    parser.add_argument('--storage', type=str, default='dense',
+                        help='Frame store of the datasets: dense or compact '
+                             '(bit-packed/float16, decoded at collate time) '
+                             '(Def: dense).')
     parser.add_argument('--cuda', default=False, action='store_true')
     parser.add_argument('--mulout', default=False, action='store_true')
+    parser.add_argument('--mo_temperature', type=float, default=None,
+                        help='If specified, the speaker of every MO batch is '
+                             'drawn with p ~ num_batches ** (1 / T) '
+                             '(Def: None, round-robin over speakers).')
+    parser.add_argument('--mo_packed', default=False, action='store_true',
+                        help='Pack the MO batches of all the speakers of a '
+                             'round into a single train step, every row '
+                             'routed to the output of its speaker.')
     parser.add_argument('--exclude_train_spks', type=str, default=[], nargs='+')
     parser.add_argument('--exclude_eval_spks', type=str, default=[], nargs='+')
     parser.add_argument('--model_type', type=str, default='rnn',
@@ -12,6 +12,20 @@ import os
 
 
 def get_data_loaders(opts):
+    if opts.fast_collate:
+        # windows are served as arrays and copied into reused buffers
+        pin_memory = opts.cuda and opts.loader_workers == 0
+        # a ring as deep as the batches held by the device prefetcher,
+        # which otherwise copies them so they are not overwritten
+        collate_fn = VarlenCollater(num_buffers=opts.device_prefetch + 2,
+                                    pin_memory=pin_memory)
+        va_collate_fn = VarlenCollater(pin_memory=pin_memory)
+    else:
+        collate_fn = varlen_dur_collate
+        va_collate_fn = varlen_dur_collate
+    bsize = opts.batch_size
+    if opts.no_stateful:
+        bsize = None
     trainset = TCSTAR_dur(opts.cfg_spk, 'train', 
                           opts.lab_dir, opts.codebooks_dir,
                           force_gen=opts.force_gen,
@@ -20,20 +34,50 @@ def get_data_loaders(opts):
                           max_spk_samples=opts.max_samples,
                           parse_workers=opts.parser_workers,
                           max_seq_len=opts.max_seq_len,
-                          batch_size=opts.batch_size,
+                          batch_size=bsize,
                           q_classes=None,
-                          mulout=opts.mulout)
+                          mulout=opts.mulout,
+                          cache_dir=opts.cache_dir,
+                          storage=opts.storage,
+                          prefetch_depth=opts.prefetch_depth,
+                          return_arrays=opts.fast_collate)
+    batch_sampler = None
+    sampler = None
+    shuffle = True
+    if opts.mo_packed and not opts.mulout:
+        raise ValueError('Packed MO batches (--mo_packed) require --mulout.')
     if opts.mulout:
-        sampler = MOSampler(trainset.len_by_spk(), trainset, opts.batch_size)
+        # every batch holds samples of a single speaker, or with
+        # mo_packed, the samples of all the speakers of a round
+        batch_sampler = MOSampler(trainset.len_by_spk(), trainset,
+                                  opts.batch_size, randomize_rounds=True,
+                                  temperature=opts.mo_temperature,
+                                  pack_rounds=opts.mo_packed)
+    elif opts.max_seq_len is not None and bsize is not None:
+        # serve the windows in stateful order: shuffling them would
+        # break the continuity of the hidden states between batches
+        sampler = StatefulSampler(trainset, opts.batch_size)
         shuffle = False
-    else:
-        sampler = None
-        shuffle = True
 
-    train_loader = DataLoader(trainset, batch_size=opts.batch_size, shuffle=shuffle,
-                              num_workers=opts.loader_workers, 
-                              sampler=sampler,
-                              collate_fn=varlen_dur_collate)
+    if opts.bucketing:
+        if opts.mulout or bsize is not None:
+            raise ValueError('Length bucketing requires non-stateful (--no_stateful) '
+                             'and non-MO training.')
+        # batch samples of similar lengths to reduce padding
+        batch_sampler = BucketBatchSampler(trainset.window_lens(),
+                                           opts.batch_size,
+                                           boundaries=opts.bucket_boundaries,
+                                           megabatch=opts.megabatch)
+    if batch_sampler is not None:
+        train_loader = DataLoader(trainset, batch_sampler=batch_sampler,
+                                  num_workers=opts.loader_workers,
+                                  collate_fn=collate_fn)
+    else:
+        train_loader = DataLoader(trainset, batch_size=opts.batch_size,
+                                  shuffle=shuffle,
+                                  num_workers=opts.loader_workers, 
+                                  sampler=sampler,
+                                  collate_fn=collate_fn)
 
     val_dset = TCSTAR_dur(opts.cfg_spk, 'valid',
                           opts.lab_dir, opts.codebooks_dir,
@@ -42,19 +86,24 @@ def get_data_loaders(opts):
                           max_spk_samples=opts.max_samples,
                           parse_workers=opts.parser_workers,
                           max_seq_len=opts.max_seq_len,
-                          batch_size=opts.batch_size,
+                          batch_size=bsize,
                           q_classes=None,
-                          mulout=opts.mulout)
+                          mulout=opts.mulout,
+                          cache_dir=opts.cache_dir,
+                          storage=opts.storage,
+                          prefetch_depth=opts.prefetch_depth,
+                          return_arrays=opts.fast_collate)
     # build validation dataset and loader
     if opts.mulout:
         va_sampler = MOSampler(val_dset.len_by_spk(), val_dset, opts.batch_size)
+        valid_loader = DataLoader(val_dset, batch_sampler=va_sampler,
+                                  num_workers=opts.loader_workers, 
+                                  collate_fn=va_collate_fn)
     else:
-        va_sampler = None
-    valid_loader = DataLoader(val_dset, batch_size=opts.batch_size,
-                              shuffle=False,
-                              num_workers=opts.loader_workers, 
-                              sampler=va_sampler,
-                              collate_fn=varlen_dur_collate)
+        valid_loader = DataLoader(val_dset, batch_size=opts.batch_size,
+                                  shuffle=False,
+                                  num_workers=opts.loader_workers, 
+                                  collate_fn=va_collate_fn)
     return train_loader, valid_loader, trainset
 
 def main(opts):
@@ -97,13 +146,18 @@ def main(opts):
     patience = opts.patience
     tr_opts = {'spk2durstats':spk2durstats,
                'idx2spk':trainset.idx2spk}
-    if opts.max_seq_len is not None:
+    if opts.max_seq_len is not None and not opts.no_stateful:
         # we have a stateful approach
         tr_opts['stateful'] = True
+    tr_opts['prefetch'] = opts.device_prefetch
+    tr_opts['metric_every'] = opts.train_metric_every
     va_opts = {'idx2spk':trainset.idx2spk}
+    tr_opts['precision'] = opts.precision
+    va_opts['precision'] = opts.precision
     if opts.mulout:
         tr_opts['mulout'] = True
         va_opts['mulout'] = True
+        tr_opts['mo_packed'] = opts.mo_packed
     if opts.q_classes is not None:
         va_opts['q_classes'] = True
     writer = SummaryWriter(os.path.join(opts.save_path,
@@ -118,7 +172,14 @@ def main(opts):
                  eval_patience=opts.patience,
                  cuda=opts.cuda,
                  va_opts=va_opts,
-                 log_writer=writer)
+                 log_writer=writer,
+                 keep_last=opts.keep_last,
+                 keep_best=opts.keep_best,
+                 snapshot_every=opts.snapshot_every,
+                 resume=opts.resume,
+                 eval_every=opts.eval_every,
+                 eval_batches=opts.eval_batches,
+                 full_eval_every=opts.full_eval_every)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -163,8 +224,77 @@ if __name__ == '__main__':
     parser.add_argument('--max_seq_len', type=int, default=None)
     parser.add_argument('--loader_workers', type=int, default=2)
     parser.add_argument('--parser_workers', type=int, default=4)
+    parser.add_argument('--prefetch_depth', type=int, default=8,
+                        help='Num of lab/aco files read ahead by threads '
+                             'in every parser worker (Def: 8).')
+    parser.add_argument('--device_prefetch', type=int, default=2,
+                        help='Num of train batches staged ahead (copied to '
+                             'the device) by a background thread. 0 '
+                             'stages them synchronously (Def: 2).')
+    parser.add_argument('--keep_last', type=int, default=3,
+                        help='Num of latest epoch checkpoints kept '
+                             '(Def: 3).')
+    parser.add_argument('--keep_best', type=int, default=1,
+                        help='Num of best validation checkpoints kept '
+                             '(Def: 1).')
+    parser.add_argument('--snapshot_every', type=int, default=0,
+                        help='Write the training state every N train '
+                             'batches, besides at the end of every '
+                             'epoch (Def: 0, only at epoch ends).')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='Resume from the last training state '
+                             'written in save_path.')
+    parser.add_argument('--eval_every', type=int, default=0,
+                        help='Also validate every N train steps, with the '
+                             'patience and best checkpoints following '
+                             'these validations (Def: 0, only full '
+                             'validations at epoch ends).')
+    parser.add_argument('--eval_batches', type=int, default=None,
+                        help='Num of validation batches (a fixed, evenly '
+                             'spaced subset) of the --eval_every '
+                             'validations (Def: None, all of them).')
+    parser.add_argument('--full_eval_every', type=int, default=1,
+                        help='Run the full validation every N epochs, 0 '
+                             'for never (Def: 1).')
+    parser.add_argument('--precision', type=str, default='fp32',
+                        choices=PRECISIONS,
+                        help='Precision of the forward passes: fp32 or '
+                             'bf16 (autocast, with LayerNorm, softmax, '
+                             'losses and metrics in fp32) (Def: fp32).')
+    parser.add_argument('--train_metric_every', type=int, default=1,
+                        help='Accumulate the train RMSE (in the device) '
+                             'every N batches. 0 disables it (Def: 1).')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Directory to cache the built datasets and '
+                             'reload them in later runs (Def: None).')
+    parser.add_argument('--no_stateful', action='store_true', default=False)
+    parser.add_argument('--bucketing', action='store_true', default=False,
+                        help='Batch non-stateful train samples of similar '
+                             'length together.')
+    parser.add_argument('--bucket_boundaries', type=int, nargs='+',
+                        default=None,
+                        help='Lengths splitting the buckets (Def: length '
+                             'quantiles).')
+    parser.add_argument('--megabatch', type=int, default=None,
+                        help='Sort bucket samples by length within chunks '
+                             'of this many batches (Def: None).')
+    parser.add_argument('--fast_collate', action='store_true', default=False,
+                        help='Serve samples as arrays and collate them '
+                             'into reused buffers.')
+    parser.add_argument('--storage', type=str, default='dense',
+                        help='Frame store of the datasets: dense or compact '
+                             '(bit-packed/float16, decoded at collate time) '
+                             '(Def: dense).')
     parser.add_argument('--cuda', default=False, action='store_true')
     parser.add_argument('--mulout', default=False, action='store_true')
+    parser.add_argument('--mo_temperature', type=float, default=None,
+                        help='If specified, the speaker of every MO batch is '
+                             'drawn with p ~ num_batches ** (1 / T) '
+                             '(Def: None, round-robin over speakers).')
+    parser.add_argument('--mo_packed', default=False, action='store_true',
+                        help='Pack the MO batches of all the speakers of a '
+                             'round into a single train step, every row '
+                             'routed to the output of its speaker.')
     parser.add_argument('--exclude_train_spks', type=str, default=[], nargs='+')
     parser.add_argument('--exclude_eval_spks', type=str, default=[], nargs='+')
 
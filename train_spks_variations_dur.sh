@@ -1,9 +1,7 @@
 #!/bin/bash
 
-# 72 speaker
-python main.py --train-dur --save_path ckpt_dur_bce_72_maxseqlen --batch_size 15 --cuda --dur_loss bce \
-	       --sigmoid_dur  --dur_max_seq_len 35 --dur_lr 0.001 --cfg_spk cfg/tcstar_72.cfg 
-
-# 73 speaker
-python main.py --train-dur --save_path ckpt_dur_bce_73_maxseqlen --batch_size 15 --cuda --dur_loss bce \
-	       --sigmoid_dur  --dur_max_seq_len 35 --dur_lr 0.001 --cfg_spk cfg/tcstar_73.cfg 
+# BCE duration models of the 72 and 73 speakers, trained concurrently on a
+# single copy of the dataset (see sweep.py)
+python sweep.py --task dur --save_path ckpt_dur_bce_maxseqlen --cfg_spk cfg/tcstar.cfg \
+	--spks 72 73 --num_jobs 2 --batch_size 15 --loss BCELoss --max_seq_len 35 \
+	--lr 0.001 --min_epochs 50 --epoch 50 --cuda